@@ -14,14 +14,18 @@ class VAE(object):
         self.lam = lam
         self.kld_loss = kld_loss
         self.l2_loss = tf.constant(0.0)
+        # 编码器的变量, 用预计算编码训练时不更新
+        self.variables = []
 
     def weight_variable(self, shape, name):
         weight = tf.get_variable(shape=shape, dtype=tf.float32, initializer=tf.glorot_uniform_initializer(), name=name)
+        self.variables.append(weight)
         return weight
 
     def bias_variable(self, shape, name):
         bias = tf.get_variable(shape=shape, initializer=tf.zeros_initializer(),
                                dtype=tf.float32, name=name)
+        self.variables.append(bias)
         return bias
 
     def vae_encoder(self, x):
@@ -56,10 +60,40 @@ class VAE(object):
         z = mu_encoder + tf.multiply(std_encoder, epsilon)
         return z
 
-    def get_vae_embbeding(self, x):
+    def get_vae_embbeding(self, x, cached=False):
+        """
+        :param cached: 为 True 时 mu / logvar 可以直接 feed 预先算好的编码 (self.mu_input / self.logvar_input),
+            这时编码器不执行, 图里只剩重参数化采样
+        """
         mu_encoder, log_encoder = self.vae_encoder(x)
+        # 离线预计算编码时 run 这两个
+        self.mu_encoder, self.logvar_encoder = mu_encoder, log_encoder
+        if cached:
+            mu_encoder = self.mu_input = tf.placeholder_with_default(
+                mu_encoder, shape=[None, self.latent_dim], name='vae_mu')
+            log_encoder = self.logvar_input = tf.placeholder_with_default(
+                log_encoder, shape=[None, self.latent_dim], name='vae_logvar')
         z = self.sampler(mu_encoder, log_encoder)
         KLD = -tf.reduce_mean(1 + log_encoder - tf.pow(mu_encoder, 2) - tf.exp(log_encoder),
                                               reduction_indices=1)
         loss = self.lam * self.l2_loss + self.kld_loss * tf.reduce_mean(KLD)
         return z, loss
+
+
+def precompute_codes(sess, vae, x, table, batch_size=8192):
+    """
+    对 photo 表的每一行跑一遍编码器
+    :param vae: 已经建好图的 VAE
+    :param x: 编码器的输入 placeholder
+    :param table: 视觉特征表, 第 i 行对应 photo_indices == i
+    :return: (mu, logvar), float32 [len(table), latent_dim]
+    """
+    mus, logvars = [], []
+    for lo in range(0, len(table), batch_size):
+        rows = np.arange(lo, min(lo + batch_size, len(table)))
+        mu, logvar = sess.run([vae.mu_encoder, vae.logvar_encoder], feed_dict={x: np.asarray(table[rows])})
+        mus.append(mu)
+        logvars.append(logvar)
+    if not mus:
+        return np.zeros([0, vae.latent_dim], np.float32), np.zeros([0, vae.latent_dim], np.float32)
+    return np.concatenate(mus), np.concatenate(logvars)
@@ -5,8 +5,14 @@ import tensorflow as tf
 import time
 import numpy as np
 
-from VAE_Encoder import VAE
-from utils import get_sample_num, new_variable_initializer, sklearn_shuffle
+from VAE_Encoder import VAE, precompute_codes
+from utils import get_sample_num, new_variable_initializer, VariableSnapshot, sparse_embedding_sum, embedding_l2_loss, REG_MODES, SideTable
+from utils import FieldEmbedding, field_attention_weights, field_attention
+import feature_store
+import input_pipeline
+import metrics
+import optimizers
+import visual_codec
 import os
 from tensorflow.python.ops import random_ops
 
@@ -18,11 +24,14 @@ class Model(object):
                  user_emb_feat,
                  dim_lda,
                  seed=1024,
-                 use_deep=True, deep_dims=(256, 128, 64), dim_hidden_out=(64, 32, 16), checkpoint_path=None):
+                 use_deep=True, deep_dims=(256, 128, 64), dim_hidden_out=(64, 32, 16), checkpoint_path=None, words_csr=None,
+                 photo_table=None, vae_cache=False, reg_mode='full'):
         self.att_reg = None
         self.seed = seed
         if checkpoint_path and checkpoint_path.count('/') < 2:
             raise ValueError('checkpoint_path must be dir/model_name format')
+        if reg_mode not in REG_MODES:
+            raise ValueError('reg_mode must be one of {}'.format(REG_MODES))
         self.checkpoint_path = checkpoint_path
         self.train_flag = True
         self.graph = tf.Graph()
@@ -45,6 +54,7 @@ class Model(object):
         self.dim_k = dim_k
         self.att_dim_k = att_dim_k
         self.reg = reg
+        self.reg_mode = reg_mode
         self.att_reg = att_reg
         self.lr = lr
         self.prefix = prefix
@@ -57,6 +67,17 @@ class Model(object):
         self.num_faces_cols = 31
         self.dim_usr_cf_emb = 96  # 用户协同过滤embedding维度
 
+        # 按 photo_indices 预先建好的词 CSR, 为 None 时从 batch 的 words 列现算
+        self.words_csr = words_csr
+        # photo 级别的特征表 {'visual': ..., 'words_lda': ..., 'one_hots': ..., 'face_num': ...},
+        # 第 i 行对应 photo_indices == i, 给出的特征按 batch 的 photo_indices 取, 不再需要每行各存一份
+        self.photo_table = photo_table
+        # 为 True 时训练可以 feed 每个 photo 预先算好的 VAE mu / logvar, 跳过 2048->1024->96 的编码器
+        if vae_cache and (photo_table is None or 'visual' not in photo_table):
+            raise ValueError('vae_cache needs photo_table with a visual table')
+        self.vae_cache = vae_cache
+        self.vae_codes = None
+        self.variable_snapshot = None
         self._build_graph()
 
     def _get_optimizer_loss(self, ):
@@ -75,7 +96,7 @@ class Model(object):
 
         self.user_indices = tf.placeholder(shape=[None], dtype=tf.float32, name='user_indices')  # [batch_size]
 
-        self.item_words_indices_a = tf.placeholder(shape=[None, 2], dtype=tf.float32,
+        self.item_words_indices_a = tf.placeholder(shape=[None, 2], dtype=tf.int64,
                                                    name='item_words_indices_a')  # [num_indices, dim]
 
         self.item_words_values_a = tf.placeholder(shape=[None], dtype=tf.float32,
@@ -109,6 +130,12 @@ class Model(object):
 
     def _create_weights(self):
 
+        # 预训练的用户特征表, 值在 compile 时 feed 进变量, 不作为常量写进图
+        self.user_emb_table = SideTable(self.user_emb_feat, name='user_emb_feat')
+        # 表的值只由 SideTable 持有, 第一次 load 后释放
+        self.user_emb_feat = None
+        self.side_tables = [self.user_emb_table]
+
         # Embedding
         self.Wu_Emb = tf.get_variable(shape=[self.num_user, self.dim_k], initializer=tf.glorot_uniform_initializer(),
                                       dtype=tf.float32, name='user_embedding')
@@ -125,12 +152,9 @@ class Model(object):
                                          initializer=tf.glorot_uniform_initializer(),
                                          dtype=tf.float32, name='LDA_embedding')
 
-        self.W_one_hots = []
-        for i in range(len(self.one_hots_dims)):
-            W_temp = tf.get_variable(shape=[self.one_hots_dims[i], self.dim_k],
-                                     initializer=tf.glorot_uniform_initializer(),
-                                     dtype=tf.float32, name='one_hot_{}'.format(i))
-            self.W_one_hots.append(W_temp)
+        # 各 one-hot 字段拼成一张表, 按字段偏移取行
+        self.one_hots_field = FieldEmbedding(self.one_hots_dims, self.dim_k, name='one_hots')
+        self.W_one_hots = self.one_hots_field.table
 
         self.W_Ctx = tf.get_variable(shape=[self.dim_num_feat, self.dim_k],
                                      initializer=tf.glorot_uniform_initializer(),
@@ -145,12 +169,8 @@ class Model(object):
                                         initializer=tf.glorot_uniform_initializer(),
                                         dtype=tf.float32, name='context_attention')
 
-        self.Woh_Att = []
-        for i in range(len(self.one_hots_dims)):
-            W_temp = tf.get_variable(shape=[self.dim_k, self.att_dim_k],
-                                     initializer=tf.glorot_uniform_initializer(),
-                                     dtype=tf.float32, name='oh_attention_{}'.format(i))
-            self.Woh_Att.append(W_temp)
+        self.Woh_Att = field_attention_weights(len(self.one_hots_dims), self.dim_k, self.att_dim_k,
+                                               name='oh_attention')
 
         self.WW_Att = tf.get_variable(shape=[self.dim_k, self.att_dim_k],
                                       initializer=tf.glorot_uniform_initializer(),
@@ -194,12 +214,8 @@ class Model(object):
             self.Wwords_deep_emb = tf.get_variable(shape=[self.num_words, self.dim_k],
                                                    initializer=tf.glorot_uniform_initializer(),
                                                    dtype=tf.float32, name='words_deep_emb')
-            self.W_deep_one_hots = []
-            for i in range(len(self.one_hots_dims)):
-                W_temp = tf.get_variable(shape=[self.one_hots_dims[i], self.dim_k],
-                                         initializer=tf.glorot_uniform_initializer(),
-                                         dtype=tf.float32, name='deep_one_hot_{}'.format(i))
-                self.W_deep_one_hots.append(W_temp)
+            self.deep_one_hots_field = FieldEmbedding(self.one_hots_dims, self.dim_k, name='deep_one_hots')
+            self.W_deep_one_hots = self.deep_one_hots_field.table
 
     def _batch_norm_layer(self, x, train_phase, scope_bn):
         with tf.variable_scope(scope_bn):
@@ -235,8 +251,7 @@ class Model(object):
             # 用户隐向量
             self.Usr_Emb = tf.nn.embedding_lookup(self.Wu_Emb,
                                                   tf.cast(self.user_indices, tf.int32))  # [batch_size, dim_k]
-            self.Usr_Feat = tf.nn.embedding_lookup(self.user_emb_feat,
-                                                   tf.cast(self.user_indices, tf.int32))  # [batch_size, dim_cf_emb]
+            self.Usr_Feat = self.user_emb_table.lookup(self.user_indices)  # [batch_size, dim_cf_emb]
 
             self.bias_usr_feat_emb = tf.get_variable(shape=[self.dim_k], initializer=tf.zeros_initializer(),
                                                      dtype=tf.float32,
@@ -261,7 +276,7 @@ class Model(object):
 
         # 物品的向量表示
         with tf.name_scope('item_express'):
-            self.I_Wds_a = tf.SparseTensor(indices=tf.cast(self.item_words_indices_a, dtype=np.int64),
+            self.I_Wds_a = tf.SparseTensor(indices=self.item_words_indices_a,
                                            values=self.item_words_values_a,
                                            dense_shape=[tf.cast(self.batch_size, dtype=np.int64), self.num_words])
             self.att_u_a = tf.matmul(self.Usr_Emb, self.Wu_oh_Att)  # [batch_size, dim_att]
@@ -270,8 +285,8 @@ class Model(object):
             self.bias_wds_emb = tf.get_variable(shape=[self.dim_k], initializer=tf.zeros_initializer(),
                                                 dtype=tf.float32,
                                                 name='bias_wds_emb')
-            self.I_Wds_Emb_a = tf.sparse_tensor_dense_matmul(self.I_Wds_a,
-                                                             self.Wwords_Emb) + self.bias_wds_emb  # [batch_size, dim_k]
+            self.I_Wds_Emb_a = sparse_embedding_sum(self.I_Wds_a,
+                                                    self.Wwords_Emb) + self.bias_wds_emb  # [batch_size, dim_k]
             self.I_Wds_Emb_a = tf.nn.relu(self.I_Wds_Emb_a)
 
             self.att_I_Wds = tf.matmul(self.I_Wds_Emb_a, self.WW_Att)  # 词的attention
@@ -279,8 +294,9 @@ class Model(object):
             self.att_I_Wds = tf.matmul(self.att_I_Wds, self.w_oh_Att) + self.c_oh_Att
             self.att_oh.append(self.att_I_Wds)
 
-            vae_encoder = VAE(input_dim=2048, hidden_encoder_dim=1024, latent_dim=96, lam=0.001, kld_loss=0.001)
-            self.I_visual_Emb, self.vae_loss = vae_encoder.get_vae_embbeding(self.visual_emb_feat)
+            self.vae_encoder = VAE(input_dim=2048, hidden_encoder_dim=1024, latent_dim=96, lam=0.001, kld_loss=0.001)
+            self.I_visual_Emb, self.vae_loss = self.vae_encoder.get_vae_embbeding(self.visual_emb_feat,
+                                                                                  cached=self.vae_cache)
             # TODO
             self.I_visual_Emb = self._batch_norm_layer(self.I_visual_Emb, self.train_phase, 'vis_bn')
             # self.I_visual_Emb = tf.layers.dropout(self.I_visual_Emb, self.dropout_emb)
@@ -299,41 +315,31 @@ class Model(object):
             self.att_I_LDA = tf.matmul(self.att_I_LDA, self.w_oh_Att) + self.c_oh_Att
             self.att_oh.append(self.att_I_LDA)
 
-            self.I_One_hot_a = []
-            for i in range(len(self.one_hots_dims)):
-                I_Emb_temp_a = tf.nn.embedding_lookup(self.W_one_hots[i],
-                                                      tf.cast(self.one_hots_a[:, i],
-                                                              tf.int32))  # [batch_size, dim_k]
-                att_oh_temp = tf.matmul(I_Emb_temp_a, self.Woh_Att[i])  # [batch_size, att_dim_k]
-                att_temp = tf.nn.relu(
-                    self.att_u_a + self.att_ctx + att_oh_temp + self.b_oh_Att)  # [batch_size, att_dim_k]
-                att_temp = tf.matmul(att_temp, self.w_oh_Att) + self.c_oh_Att  # [batch_size, 1]
-                self.att_oh.append(att_temp)
-                self.I_One_hot_a.append(I_Emb_temp_a)
+            self.I_One_hot_a = self.one_hots_field.lookup(self.one_hots_a)  # [batch_size, num_one_hots, dim_k]
+            self.att_oh.append(field_attention(self.I_One_hot_a, self.Woh_Att, self.att_u_a + self.att_ctx,
+                                               self.b_oh_Att, self.w_oh_Att, self.c_oh_Att))  # [batch_size, num_one_hots]
             self.att_oh = tf.nn.softmax(tf.concat(self.att_oh, axis=1))  # [batch_size, oh_dim] 第一列是词attention
             self.I_Wds_Emb_a = self.I_Wds_Emb_a * self.att_oh[:, 0:1]
             self.I_visual_Emb = self.I_visual_Emb * self.att_oh[:, 1:2]
             self.I_LDA_Emb = self.I_LDA_Emb * self.att_oh[:, 2:3]
-            for i in range(3, len(self.one_hots_dims) + 3):
-                self.I_One_hot_a[i - 3] = self.I_One_hot_a[i - 3] * self.att_oh[:, i:i + 1]
-            self.Item_Expr_a = tf.add_n(self.I_One_hot_a + [self.I_visual_Emb, self.I_Wds_Emb_a, self.I_LDA_Emb])
+            self.I_One_hot_a = self.I_One_hot_a * tf.expand_dims(self.att_oh[:, 3:], 2)
+            self.Item_Expr_a = tf.add_n([tf.reduce_sum(self.I_One_hot_a, axis=1),
+                                         self.I_visual_Emb, self.I_Wds_Emb_a, self.I_LDA_Emb])
 
         with tf.name_scope('deep'):
             if self.use_deep:
                 self.Usr_emb_deep = tf.nn.embedding_lookup(self.Wu_deep_emb,
                                                            tf.cast(self.user_indices, tf.int32))  # [batch_size, dim_k]
-                self.I_Wds_emb_deep = tf.sparse_tensor_dense_matmul(self.I_Wds_a,
-                                                                    self.Wwords_deep_emb)  # [batch_size, dim_k]
-                self.I_one_hot_deep = []
-                for i in range(len(self.one_hots_dims)):
-                    I_Emb_temp_a = tf.nn.embedding_lookup(self.W_deep_one_hots[i], tf.cast(self.one_hots_a[:, i],
-                                                                                           tf.int32))  # [batch_size, dim_k]
-                    self.I_one_hot_deep.append(I_Emb_temp_a)
+                self.I_Wds_emb_deep = sparse_embedding_sum(self.I_Wds_a,
+                                                           self.Wwords_deep_emb)  # [batch_size, dim_k]
+                # [batch_size, num_one_hots * dim_k], 与逐字段 concat 的顺序相同
+                self.I_one_hot_deep = tf.reshape(self.deep_one_hots_field.lookup(self.one_hots_a),
+                                                 [-1, len(self.one_hots_dims) * self.dim_k])
 
                 # self.deep_input = tf.concat([self.num_features, self.Usr_Feat, self.face_num, self.visual_emb_feat],
                 #                             axis=1)  # [batch_size, input_dim]
                 self.deep_input = tf.concat(
-                    [self.num_features, self.visual_emb_feat] + self.I_one_hot_deep, axis=1)
+                    [self.num_features, self.visual_emb_feat, self.I_one_hot_deep], axis=1)
                 # 输入加入batch_norm
                 # self.deep_input = self._batch_norm_layer(self.deep_input, self.train_phase, 'input_bn')
                 for i, deep_dim in enumerate(self.deep_dims):
@@ -385,6 +391,13 @@ class Model(object):
             #         self.y_ui_a += self.deep_output
             #     self.y_ui_a = tf.nn.sigmoid(self.y_ui_a)
 
+    def _lookup_ids(self):
+        """
+        embedding 表的 name -> batch 里取到的行号, reg_mode 不为 full 时只对这些行做 L2
+        用户和 one-hot 的正则本来就加在取出来的向量上, 这里只有词表
+        """
+        return {self.Wwords_Emb.name: self.item_words_indices_a[:, 1]}
+
     def _create_loss(self):
 
         self.biases = [self.bias, self.bu,
@@ -396,20 +409,22 @@ class Model(object):
         #                self.W_LDA_emb] + self.W_one_hots + self.biases
 
         self.params = [self.Usr_Emb, self.Wwords_Emb, self.W_Ctx, self.W_usr_feat_emb,
-                       self.W_LDA_emb, ] + self.I_One_hot_a + self.biases
+                       self.W_LDA_emb, self.I_One_hot_a] + self.biases
 
         self.att_params = [self.WW_Att, self.W_visual_Att, self.Wu_oh_Att, self.Wctx_Att, self.W_LDA_Att,
                            self.w_oh_Att,
                            self.w_in_prd_att,
                            self.W_in_prd_att,
-                           ] + self.Woh_Att
+                           self.Woh_Att]
 
         self.loss = tf.keras.losses.categorical_crossentropy(self.labels, self.y_ui_a)
         # self.loss = tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(
         #     labels=self.labels, logits=self.y_ui_a))
         # 正则项
+        self.lookup_ids = self._lookup_ids()
         for param in self.params:
-            self.loss = tf.add(self.loss, self.reg * tf.nn.l2_loss(param))
+            self.loss = tf.add(self.loss, self.reg * embedding_l2_loss(param, self.lookup_ids.get(param.name),
+                                                                       self.reg_mode))
         for param in self.att_params:
             self.loss = tf.add(self.loss, self.att_reg * tf.nn.l2_loss(param))
             # self.optimizer = tf.train.AdamOptimizer(0.001).minimize(self.loss)
@@ -431,6 +446,8 @@ class Model(object):
         optimizer_dict = {'sgd': tf.train.GradientDescentOptimizer(self.lr),
                           'adam': tf.train.AdamOptimizer(self.lr),
                           'adagrad': tf.train.AdagradOptimizer(self.lr),
+                          'lazy_adam': optimizers.LazyAdamOptimizer(self.lr),
+                          'row_adagrad': optimizers.RowAdagradOptimizer(self.lr),
                           # 'adagradda':tf.train.AdagradDAOptimizer(),
                           'rmsprop': tf.train.RMSPropOptimizer(self.lr),
                           'moment': tf.train.MomentumOptimizer(self.lr, 0.9),
@@ -468,17 +485,33 @@ class Model(object):
         # restore_saver.restore(self.sess, ckpt_path)
         self.saver.restore(self.sess, ckpt_path)
 
+    def snapshot(self):
+        """
+        记下所有变量 (包括优化器的 slot) 的当前值, 之后用 restore_snapshot 一次写回,
+        逐用户微调时代替每次 load_model 读检查点
+        """
+        if self.variable_snapshot is None:
+            self.variable_snapshot = VariableSnapshot(self.sess)
+        self.variable_snapshot.capture()
+
+    def restore_snapshot(self):
+        if self.variable_snapshot is None:
+            raise ValueError('call snapshot() before restore_snapshot()')
+        self.variable_snapshot.restore()
+
     def compile(self, optimizer='sgd', metrics=None,
-                only_init_new=False, ):
+                only_init_new=False, emb_optimizer=None):
         """
         compile the model with optimizer and loss function
         :param optimizer:str or predefined optimizer in tensorflow
-        ['sgd','adam','adagrad','rmsprop','moment','ftrl']
+        ['sgd','adam','adagrad','rmsprop','moment','ftrl','lazy_adam','row_adagrad']
         :param loss: str  not used
         :param metrics: str ['logloss','mse','mean_squared_error','logloss_with_logits']
         :param loss_weights:
         :param sample_weight_mode:
         :param only_init_new bool
+        :param emb_optimizer: embedding 表单独用的优化器, 如 'lazy_adam' / 'row_adagrad',
+            其余参数仍用 optimizer; 为 None 时全部用 optimizer
         :return:
         """
         # TODO: 添加loss
@@ -489,8 +522,17 @@ class Model(object):
             update_ops = self.graph.get_collection(tf.GraphKeys.UPDATE_OPS)
             with tf.control_dependencies(update_ops):  # for the use of BN
                 self.op = self._create_optimizer(optimizer)
-                self.optimizer = self.op.minimize(
-                    loss=self._get_optimizer_loss(), global_step=self.global_step)  # 创建优化器
+                self.emb_op = None if emb_optimizer is None else self._create_optimizer(emb_optimizer)
+                emb_names = list(self.lookup_ids)
+                self.optimizer = optimizers.minimize(
+                    self._get_optimizer_loss(), self.op, self.emb_op, global_step=self.global_step,
+                    emb_names=emb_names)  # 创建优化器
+                if self.vae_cache:
+                    # feed 预计算编码时编码器不执行, 只更新编码器以外的变量
+                    self.optimizer_cached = optimizers.minimize(
+                        self._get_optimizer_loss(), self.op, self.emb_op, global_step=self.global_step,
+                        var_list=[var for var in tf.trainable_variables() if var not in self.vae_encoder.variables],
+                        emb_names=emb_names)
                 # 执行初始化操作
             self.saver = tf.train.Saver()  # saver要定义在所有变量定义结束之后，且在计算图中
             if only_init_new is False:
@@ -501,22 +543,26 @@ class Model(object):
                 init_op = new_variable_initializer(
                     self.sess)  # 如果更换了优化器，需要重新初始化一些变量
             self.sess.run(init_op)
+            for table in self.side_tables:
+                table.load(self.sess)
 
     def _item_words_indices_and_values(self, input_data):
-        def func(input):
-            for ix, words in enumerate(input):
-                for word in words:
-                    yield [ix, word]
-
-        indices = list(func(input_data['words']))
-        indices = np.asarray(indices, np.uint16)
-        values = np.ones([indices.shape[0]], dtype=np.int8)
-        if len(indices) == 0:
-            return np.zeros([1, 2], np.int8), np.zeros([1], np.int8)
-        return indices, values
+        if self.words_csr is not None:
+            words = self.words_csr.take(input_data['photo_indices'].values)
+        else:
+            words = feature_store.RaggedColumn.from_list(input_data['words'].tolist())
+        indices = words.coo_indices()
+        if indices.shape[0] == 0:
+            return np.zeros([1, 2], np.int64), np.zeros([1], np.float32)
+        return indices, np.ones([indices.shape[0]], np.float32)
 
     def fit(self, input_data, batch_size=1024, epochs=50, validation_data=None, shuffle=True, initial_epoch=0,
-            min_display=50, max_iter=-1, drop_out_deep=0.5, drop_out_emb=0.6, save_path=None, test_data=None, ):
+            min_display=50, max_iter=-1, drop_out_deep=0.5, drop_out_emb=0.6, save_path=None, test_data=None,
+            num_threads=2, prefetch=2, vae_finetune_every=2):
+        """
+        :param vae_finetune_every: vae_cache 时每隔几个 epoch 端到端训练一次编码器, 之后重新计算编码,
+            其余 epoch 用预计算的编码; 为 0 时编码器不再训练 (如已从检查点恢复)
+        """
 
         n_samples = get_sample_num(input_data)
         iters = (n_samples - 1) // batch_size + 1
@@ -534,18 +580,21 @@ class Model(object):
         for i in range(epochs):
             if i < initial_epoch:
                 continue
-            if shuffle:
-                input_data = sklearn_shuffle(input_data, random_state=np.random.randint(2018))
-            for j in range(iters):
-                if isinstance(input_data, list):
-                    batch_x = [
-                        item[j * batch_size:(j + 1) * batch_size] for item in input_data]
-                elif isinstance(input_data, pd.DataFrame):
-                    batch_x = input_data.iloc[j * batch_size:(j + 1) * batch_size, :]
-                else:
-                    batch_x = input_data[j * batch_size:(j + 1) * batch_size]
-                loss = self.train_on_batch(
-                    batch_x)
+            finetune = not self.vae_cache or (vae_finetune_every > 0 and
+                                               (i - initial_epoch) % vae_finetune_every == 0)
+            if not finetune and self.vae_codes is None:
+                self.refresh_vae_codes()
+            vae_codes = None if finetune else self.vae_codes
+            # 打乱只生成行号, 切片和转 numpy 都在预取线程里做
+            batches = input_pipeline.batch_rows(n_samples, batch_size, shuffle,
+                                                np.random.randint(2018) if shuffle else None)
+            prefetcher = input_pipeline.Prefetcher(
+                lambda j: self._batch_arrays(input_data.iloc[batches[j]], vae_codes), iters,
+                num_threads=num_threads, capacity=prefetch)
+            epoch_start, epoch_samples = time.time(), 0
+            for j, arrays in enumerate(prefetcher):
+                loss = self._run_train_step(arrays)
+                epoch_samples += arrays['labels'].shape[0]
                 if j % min_display == 0:
                     tr_loss = loss
                     self.tr_loss_list.append(tr_loss)
@@ -570,42 +619,86 @@ class Model(object):
                 if (i * iters) + j == max_iter:
                     stop_flag = True
                     break
+            prefetcher.close()
+            epoch_time = time.time() - epoch_start
+            print("Epoch {0: 2d}: {1: 0.0f} samples/sec, input wait {2: 0.1f}s of {3: 0.1f}s".format(
+                i, epoch_samples / max(epoch_time, 1e-6), prefetcher.wait_time, epoch_time))
+            if self.vae_cache and finetune:
+                # 编码器更新过, 下一个用编码的 epoch 开始前重新计算
+                self.vae_codes = None
             self._save_preds(test_data, self.preds, save_path)
             if stop_flag:
                 break
 
-    def train_on_batch(self, input_data):  # fit a batch
-        user_ids = input_data['user_indices'].values
+    def _photo_feature(self, input_data, key, col):
+        if self.photo_table is not None and key in self.photo_table:
+            return np.asarray(self.photo_table[key][input_data['photo_indices'].values])
+        return feature_store.frame_matrix(input_data, col)
+
+    def refresh_vae_codes(self, batch_size=8192):
+        """
+        用当前的编码器对 photo 表每一行算一次 mu / logvar, 训练时按 photo_indices 取
+        """
+        start = time.time()
+        self.vae_codes = precompute_codes(self.sess, self.vae_encoder, self.visual_emb_feat,
+                                          self.photo_table['visual'], batch_size)
+        print('refreshed vae codes of {} photos in {: 0.1f}s'.format(self.vae_codes[0].shape[0], time.time() - start))
 
-        labels = input_data['click'].values
-        onehots_1 = input_data['face_cols_01'].tolist()
-        # onehots_2 = input_data[[col for col in input_data if '_01' in col]].values
-        onehots = np.concatenate([onehots_1], axis=1)
+    def _batch_arrays(self, input_data, vae_codes=None):
+        """
+        把一个 batch 的 DataFrame 转成 feed 用的 numpy 数组, 不涉及 session, 可以在后台线程里调用
+        :param vae_codes: (mu, logvar), 给出时 VAE 编码器的输出用预计算的编码代替
+        """
         item_words_indices, item_words_values = self._item_words_indices_and_values(input_data)
-        visual_emb_feat = input_data['visual'].tolist()
-        words_lda = input_data['topics'].tolist()
-        # num_features = np.asarray(input_data['context'].tolist())
-        num_features = input_data[ctx_cols].values
-        face_cols_num = input_data['face_cols_num'].tolist()
+        arrays = {
+            'user_indices': input_data['user_indices'].values,
+            'labels': input_data['click'].values if 'click' in input_data else None,
+            'one_hots': self._photo_feature(input_data, 'one_hots', 'face_cols_01'),
+            'item_words_indices': item_words_indices,
+            'item_words_values': item_words_values,
+            'words_lda': self._photo_feature(input_data, 'words_lda', 'topics'),
+            'num_features': input_data[ctx_cols].values,
+            'face_num': self._photo_feature(input_data, 'face_num', 'face_cols_num'),
+        }
+        if vae_codes is None or self.use_deep:
+            # deep 部分直接拼接 2048 维视觉特征, 用预计算编码时也要取, 跳过的只是 VAE 编码器
+            arrays['visual'] = self._photo_feature(input_data, 'visual', 'visual')
+        if vae_codes is not None:
+            photo_indices = input_data['photo_indices'].values
+            arrays['vae_mu'], arrays['vae_logvar'] = vae_codes[0][photo_indices], vae_codes[1][photo_indices]
+        return arrays
+
+    def _feed_dict(self, arrays, train):
         feed_dict_ = {
-            self.user_indices: user_ids,
-            self.visual_emb_feat: visual_emb_feat,
-            self.item_words_indices_a: item_words_indices,
-            self.item_words_values_a: item_words_values,
-            self.words_lda: words_lda,
-            self.labels: labels,
-            self.one_hots_a: onehots,
-            self.batch_size: user_ids.shape[0],
-            self.num_features: num_features,
-            self.face_num: face_cols_num,
-            self.dropout_deep: self.drop_out_deep_on_train,
-            self.dropout_emb: self.drop_out_emb_on_train,
-            self.train_phase: True,
+            self.user_indices: arrays['user_indices'],
+            self.item_words_indices_a: arrays['item_words_indices'],
+            self.item_words_values_a: arrays['item_words_values'],
+            self.words_lda: arrays['words_lda'],
+            self.one_hots_a: arrays['one_hots'],
+            self.batch_size: arrays['user_indices'].shape[0],
+            self.num_features: arrays['num_features'],
+            self.face_num: arrays['face_num'],
+            self.dropout_deep: self.drop_out_deep_on_train if train else 0,
+            self.dropout_emb: self.drop_out_emb_on_train if train else 0,
+            self.train_phase: train,
         }
-        # batch_size = self.sess.run([self.batch_size], feed_dict=feed_dict_)
-        y, loss, _ = self.sess.run([self.y_ui_a, self.loss, self.optimizer], feed_dict=feed_dict_)
+        if 'vae_mu' in arrays:
+            feed_dict_[self.vae_encoder.mu_input] = arrays['vae_mu']
+            feed_dict_[self.vae_encoder.logvar_input] = arrays['vae_logvar']
+        if 'visual' in arrays:
+            feed_dict_[self.visual_emb_feat] = arrays['visual']
+        if train:
+            feed_dict_[self.labels] = arrays['labels']
+        return feed_dict_
+
+    def _run_train_step(self, arrays):
+        optimizer = self.optimizer_cached if 'vae_mu' in arrays else self.optimizer
+        y, loss, _ = self.sess.run([self.y_ui_a, self.loss, optimizer], feed_dict=self._feed_dict(arrays, True))
         return loss
 
+    def train_on_batch(self, input_data):  # fit a batch
+        return self._run_train_step(self._batch_arrays(input_data))
+
     # def train_on_batch(self, data, split=1):
     #     loss_sum = 0
     #     for input_data in np.array_split(data, split):
@@ -648,29 +741,7 @@ class Model(object):
         pass
 
     def scoreAUC(self, labels, probs):
-        i_sorted = sorted(range(len(probs)), key=lambda i: probs[i],
-                          reverse=True)
-        auc_temp = 0.0
-        TP = 0.0
-        TP_pre = 0.0
-        FP = 0.0
-        FP_pre = 0.0
-        P = 0
-        N = 0
-        last_prob = probs[i_sorted[0]] + 1.0
-        for i in range(len(probs)):
-            if last_prob != probs[i_sorted[i]]:
-                auc_temp += (TP + TP_pre) * (FP - FP_pre) / 2.0
-                TP_pre = TP
-                FP_pre = FP
-                last_prob = probs[i_sorted[i]]
-            if labels[i_sorted[i]] == 1:
-                TP = TP + 1
-            else:
-                FP = FP + 1
-        auc_temp += (TP + TP_pre) * (FP - FP_pre) / 2.0
-        auc = auc_temp / (TP * FP)
-        return auc
+        return metrics.auc(labels, probs)
 
     def evaluate(self, input_data, split=60, cache=True):
         """
@@ -681,93 +752,33 @@ class Model(object):
         :param val_size:
         :return: mean loss
         """
-        labels_lst = []
-        preds_lst = []
+        # 分桶累加近似 AUC, 不保存每条预测
+        accumulator = metrics.AUCAccumulator()
         for it, data in enumerate(np.array_split(input_data, split)):
             if cache and it in self.val_datas:
-                labels, item_words_indices, item_words_values, user_ids, visual_emb_feat, words_lda, onehots, num_features, face_cols_num = \
-                    self.val_datas[it]
+                arrays = self.val_datas[it]
             else:
-                user_ids = data['user_indices'].values
-                visual_emb_feat = data['visual'].tolist()
-                words_lda = data['topics'].tolist()
-                labels = data['click'].values
-                onehots_1 = data['face_cols_01'].tolist()
-                # onehots_2 = data[[col for col in data if '_01' in col]].values
-                onehots = np.concatenate([onehots_1], axis=1)
-                item_words_indices, item_words_values = self._item_words_indices_and_values(data)
-                # num_features = data[[col for col in data if '_N' in col]].values
-                # num_features = np.asarray(data['context'].tolist())
-                num_features = data[ctx_cols].values
-                face_cols_num = data['face_cols_num'].tolist()
-
-            feed_dict_ = {
-                self.user_indices: user_ids,
-                self.visual_emb_feat: visual_emb_feat,
-                self.words_lda: words_lda,
-                self.item_words_indices_a: item_words_indices,
-                self.item_words_values_a: item_words_values,
-                self.one_hots_a: onehots,
-                self.batch_size: user_ids.shape[0],
-                self.num_features: num_features,
-                self.face_num: face_cols_num,
-                self.dropout_deep: 0,
-                self.dropout_emb: 0,
-                self.train_phase: False
-
-            }
+                arrays = self._batch_arrays(data)
             if cache:
-                self.val_datas[it] = [labels, item_words_indices, item_words_values, user_ids, visual_emb_feat,
-                                      words_lda, onehots,
-                                      num_features, face_cols_num]
-            pred = self.sess.run([self.y_ui_a], feed_dict=feed_dict_)
-            labels_lst.extend(labels)
-            preds_lst.extend(pred[0])
+                self.val_datas[it] = arrays
+            pred = self.sess.run([self.y_ui_a], feed_dict=self._feed_dict(arrays, False))
+            accumulator.update(arrays['labels'], pred[0])
         if cache:
             for col in input_data:
                 if 'click' not in col:
                     del input_data[col]
-        return -self.scoreAUC(labels_lst, preds_lst)
+        return -accumulator.auc()
 
     def pred_prob(self, input_data, split=60, cache=True):
         preds_lst = []
         for it, data in enumerate(np.array_split(input_data, split)):
             if cache and it in self.test_datas:
-                item_words_indices, item_words_values, user_ids, visual_emb_feat, words_lda, onehots, num_features, face_cols_num = \
-                    self.test_datas[
-                        it]
+                arrays = self.test_datas[it]
             else:
-                user_ids = data['user_indices'].values
-                visual_emb_feat = data['visual'].tolist()
-                onehots_1 = data['face_cols_01'].tolist()
-                words_lda = data['topics'].tolist()
-                onehots = np.concatenate([onehots_1, ], axis=1)
-                # num_features = np.asarray(data['context'].tolist())
-                num_features = data[ctx_cols].values
-                item_words_indices, item_words_values = self._item_words_indices_and_values(data)
-                face_cols_num = data['face_cols_num'].tolist()
-
-            feed_dict_ = {
-                self.user_indices: user_ids,
-                self.visual_emb_feat: visual_emb_feat,
-                self.item_words_indices_a: item_words_indices,
-                self.item_words_values_a: item_words_values,
-                self.words_lda: words_lda,
-                self.one_hots_a: onehots,
-                self.batch_size: user_ids.shape[0],
-                self.num_features: num_features,
-                self.face_num: face_cols_num,
-                self.dropout_deep: 0,
-                self.dropout_emb: 0,
-                self.train_phase: False,
-            }
+                arrays = self._batch_arrays(data)
             if cache:
-                self.test_datas[it] = [item_words_indices, item_words_values, user_ids, visual_emb_feat,
-                                       words_lda,
-                                       onehots,
-                                       num_features,
-                                       face_cols_num]
-            pred = self.sess.run([self.y_ui_a], feed_dict=feed_dict_)
+                self.test_datas[it] = arrays
+            pred = self.sess.run([self.y_ui_a], feed_dict=self._feed_dict(arrays, False))
             preds_lst.extend(pred[0])
         if cache:
             for col in input_data:
@@ -786,48 +797,56 @@ if __name__ == '__main__':
     user_embs = pd.read_pickle('../model/user_emb.pkl')
     user_embs = user_embs.sort_values(['user_indices'])
     user_embs = np.array(user_embs['user_emb'].tolist(), np.float32)
-    visual_train1 = pd.read_pickle('../data/visual/visual_feature_train_1.pkl')
-    visual_train2 = pd.read_pickle('../data/visual/visual_feature_train_2.pkl')
-    # visual_train = pd.read_pickle('../data/visual_feature/visual_feature_train.pkl')
-    visual_test = pd.read_pickle('../data/visual/visual_feature_test.pkl')
-    # visual_test = pd.read_pickle('../data/visual_feature/visual_feature_test.pkl')
-
-    visual_train = pd.concat([visual_train1, visual_train2], ignore_index=True, sort=False)
-    print('loaded visual...')
-    # print(visual_embs.shape[0], 'photos...')
-    # print(visual_embs['pid'].nunique(), 'unique photos...')
-
-    val_data = pd.read_pickle('../data/val_data.pkl')
-    train_data = pd.read_pickle('../data/train_data.pkl')
-    test_data = pd.read_pickle('../data/test_data.pkl')
-    # empty = np.zeros(shape=[6])
-    # for df in [train_data, test_data, val_data]:
-    #     df['topics'] = df['topics'].apply(lambda lst: empty if pd.isna(lst) is True else lst)
-
-    train_data, val_data = [pd.merge(df, visual_train, 'left', 'pid') for df in
-                            [train_data, val_data]]
-    test_data = pd.merge(test_data, visual_test, 'left', 'pid')
+    # 视觉特征由 preprocessing/concat_visual_feature.py 按 photo 表顺序写成 memmap
+    visual_embs = visual_codec.open_table('../data/visual/photo_visual.npy')
+    # 压缩存储 (visual_codec.py 压成 pq 编码读进内存, 按 batch 解码), 与原表的精度对比过后再切换:
+    # visual_embs = visual_codec.open_table('../data/visual/photo_visual_pq')
+    print('loaded visual...', visual_embs.shape)
+
+    # 只读模型用到的列, ctx_ 连续特征列从存储的列名里挑
+    ctx_cols = [col for col in feature_store.FeatureStore('../data/train_data').columns
+                if 'ctx_' in col and 'ctx_01' not in col]
+    # 交互数据只读 id 和交互级别的列, photo 级别的特征按 photo_indices 从 photo 表里取
+    data_columns = ['uid', 'pid', 'user_indices', 'photo_indices', 'click'] + ctx_cols
+    val_data = feature_store.read_frame('../data/val_data', data_columns)
+    train_data = feature_store.read_frame('../data/train_data', data_columns)
+    test_data = feature_store.read_frame('../data/test_data', data_columns)
+
+    photo_store = feature_store.FeatureStore('../data/photo_features')
+    photo_table = {
+        'visual': visual_embs,
+        'words_lda': photo_store['topics'],
+        'one_hots': photo_store['face_cols_01'],
+        'face_num': photo_store['face_cols_num'],
+    }
 
     one_hots_dims = []
-    face_cols = np.array(train_data['face_cols_01'].tolist(), np.uint16)
+    face_cols = np.asarray(photo_store['face_cols_01'], np.uint16)
     one_hots_dims.extend((face_cols.max(axis=0) + 1))
     print('one_hot_dims:', one_hots_dims)
 
     # dim_num_feat = val_data.ix[0, 'context'].shape[0]
-    ctx_cols = [col for col in train_data.columns if 'ctx_' in col and 'ctx_01' not in col]
     dim_num_feat = len(ctx_cols)
     print('ctx_cols:', ctx_cols)
 
+    words_csr = photo_store['words']
+
     model_params = {
         'num_user': 37821,
         'num_recent_item': 30,
         'num_words': 152092,
         'dim_num_feat': dim_num_feat,
         'one_hots_dims': one_hots_dims,
+        'words_csr': words_csr,
+        'photo_table': photo_table,
+        # True 时编码器隔几个 epoch 端到端训练一次, 其余 epoch 用每个 photo 预计算的 mu / logvar
+        'vae_cache': False,
         'dim_k': 96,
         'att_dim_k': 16,
         'dim_hidden_out': (512, 256, 128, 64),
         'reg': 0.002,
+        # full 整表做 L2, batch / batch_freq 只对 batch 里取到的行做 L2, 梯度保持稀疏
+        'reg_mode': 'full',
         'att_reg': 0.2,
         'user_emb_feat': user_embs,
         'dim_lda': 6,
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""
+评估指标: 向量化的 AUC, 按用户分组的 AUC, 以及分批累积的近似 AUC
+"""
+from __future__ import print_function, division
+import numpy as np
+
+
+def _tie_averaged_ranks(sorted_values, group_starts=None):
+    """
+    已排序数组的秩 (从 1 开始), 相同取值取平均秩
+    :param group_starts: 若给出, 秩在每个分组内部重新从 1 开始
+    """
+    n = sorted_values.shape[0]
+    run_start = np.r_[True, sorted_values[1:] != sorted_values[:-1]]
+    if group_starts is not None:
+        run_start |= group_starts
+    run_idx = np.cumsum(run_start) - 1
+    starts = np.flatnonzero(run_start)
+    ends = np.r_[starts[1:], n]
+    # 一段并列值占据位置 [start, end), 平均秩 = (start + 1 + end) / 2
+    ranks = ((starts + 1 + ends) / 2.0)[run_idx]
+    if group_starts is not None:
+        ranks -= np.flatnonzero(group_starts)[np.cumsum(group_starts) - 1]
+    return ranks
+
+
+def auc(labels, probs):
+    """
+    基于秩的 AUC, O(n log n), 并列分数按平均秩处理 (与梯形法一致)
+    """
+    labels = np.asarray(labels).ravel()
+    probs = np.asarray(probs, dtype=np.float64).ravel()
+    pos = labels == 1
+    num_pos = pos.sum()
+    num_neg = labels.shape[0] - num_pos
+    if num_pos == 0 or num_neg == 0:
+        return np.nan
+    order = np.argsort(probs, kind='mergesort')
+    ranks = _tie_averaged_ranks(probs[order])
+    pos_rank_sum = ranks[pos[order]].sum()
+    return (pos_rank_sum - num_pos * (num_pos + 1) / 2.0) / (num_pos * num_neg)
+
+
+def group_auc(uids, labels, probs, weighted=True, return_groups=False):
+    """
+    按用户分组的 AUC, 只做一次 (uid, prob) 排序, 分组统计用 reduceat 完成.
+    只有正样本或只有负样本的用户不参与平均
+    :param weighted: True 按用户样本数加权, 否则简单平均
+    :param return_groups: 同时返回 (uid, 每个用户的 auc, 样本数)
+    """
+    uids = np.asarray(uids).ravel()
+    labels = np.asarray(labels).ravel()
+    probs = np.asarray(probs, dtype=np.float64).ravel()
+    order = np.lexsort((probs, uids))
+    uids, labels, probs = uids[order], labels[order] == 1, probs[order]
+    group_start = np.r_[True, uids[1:] != uids[:-1]]
+    starts = np.flatnonzero(group_start)
+    # prob 相同但 uid 不同的相邻样本不能算作并列
+    ranks = _tie_averaged_ranks(probs, group_start)
+    sizes = np.diff(np.r_[starts, uids.shape[0]])
+    num_pos = np.add.reduceat(labels.astype(np.int64), starts)
+    num_neg = sizes - num_pos
+    pos_rank_sum = np.add.reduceat(np.where(labels, ranks, 0.0), starts)
+    valid = (num_pos > 0) & (num_neg > 0)
+    aucs = np.full(starts.shape[0], np.nan)
+    aucs[valid] = (pos_rank_sum[valid] - num_pos[valid] * (num_pos[valid] + 1) / 2.0) / (
+        num_pos[valid] * num_neg[valid])
+    weights = sizes[valid] if weighted else np.ones(valid.sum())
+    gauc = np.sum(aucs[valid] * weights) / np.sum(weights) if valid.any() else np.nan
+    if return_groups:
+        return gauc, (uids[starts], aucs, sizes)
+    return gauc
+
+
+class AUCAccumulator(object):
+    """
+    固定分桶的正负样本直方图, 可以一个 batch 一个 batch 地累加,
+    不保存每条预测也能给出近似 AUC (误差随桶数增加而减小)
+    """
+
+    def __init__(self, num_bins=2 ** 16):
+        self.num_bins = num_bins
+        self.reset()
+
+    def reset(self):
+        self.pos_hist = np.zeros(self.num_bins, np.int64)
+        self.neg_hist = np.zeros(self.num_bins, np.int64)
+
+    def update(self, labels, probs):
+        labels = np.asarray(labels).ravel()
+        probs = np.asarray(probs, dtype=np.float64).ravel()
+        bins = np.clip((probs * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        pos = labels == 1
+        self.pos_hist += np.bincount(bins[pos], minlength=self.num_bins)
+        self.neg_hist += np.bincount(bins[~pos], minlength=self.num_bins)
+
+    def auc(self):
+        num_pos = self.pos_hist.sum()
+        num_neg = self.neg_hist.sum()
+        if num_pos == 0 or num_neg == 0:
+            return np.nan
+        # 每个正样本: 更低桶里的负样本记 1, 同桶的记 0.5
+        neg_below = np.cumsum(self.neg_hist) - self.neg_hist
+        area = np.sum(self.pos_hist * (neg_below + 0.5 * self.neg_hist))
+        return area / (num_pos * num_neg)
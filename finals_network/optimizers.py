@@ -0,0 +1,140 @@
+# coding=utf-8
+"""
+embedding 表用的优化器:
+    LazyAdamOptimizer       稀疏梯度只更新 batch 里出现的行的 m / v, 其余行不动; 省的是每步的计算,
+                            m / v 仍是两张与表同样大的 slot, 优化器内存与 AdamOptimizer 相同
+    RowAdagradOptimizer     每行一个累加器 (取该行梯度平方的均值), slot 只有 [num_rows, 1],
+                            要减少 embedding 表优化器的内存用这个
+
+minimize 可以让 embedding 表和其余的 dense 参数用不同的优化器, 梯度只算一次.
+"""
+import tensorflow as tf
+
+
+class LazyAdamOptimizer(tf.train.AdamOptimizer):
+    """
+    dense 梯度同 AdamOptimizer; IndexedSlices 梯度只更新出现的行, 偏差修正仍用全局的 beta power.
+    ref 变量和 resource 变量都走同样的按行更新; slot 大小与 AdamOptimizer 相同
+    """
+
+    def _apply_sparse(self, grad, var):
+        return self._apply_rows(grad.values, var, grad.indices)
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self._apply_rows(grad, var, indices)
+
+    def _apply_rows(self, values, var, indices):
+        """
+        indices 里的重复行号已由 Optimizer 合并
+        """
+        dtype = var.dtype.base_dtype
+        beta1_power, beta2_power = [tf.cast(power, dtype) for power in self._get_beta_accumulators()]
+        lr_t = tf.cast(self._lr_t, dtype)
+        beta1_t = tf.cast(self._beta1_t, dtype)
+        beta2_t = tf.cast(self._beta2_t, dtype)
+        epsilon_t = tf.cast(self._epsilon_t, dtype)
+        lr = lr_t * tf.sqrt(1 - beta2_power) / (1 - beta1_power)
+
+        m = self.get_slot(var, 'm')
+        m_t = tf.scatter_update(m, indices, beta1_t * tf.gather(m, indices) + (1 - beta1_t) * values,
+                                use_locking=self._use_locking)
+        v = self.get_slot(var, 'v')
+        v_t = tf.scatter_update(v, indices, beta2_t * tf.gather(v, indices) + (1 - beta2_t) * tf.square(values),
+                                use_locking=self._use_locking)
+        m_t_rows = tf.gather(m_t, indices)
+        v_t_rows = tf.gather(v_t, indices)
+        var_update = tf.scatter_sub(var, indices, lr * m_t_rows / (tf.sqrt(v_t_rows) + epsilon_t),
+                                    use_locking=self._use_locking)
+        return tf.group(var_update, m_t, v_t)
+
+
+class RowAdagradOptimizer(tf.train.Optimizer):
+    """
+    按行的 Adagrad: 累加器是每行梯度平方在其余维上的均值, 一行共用一个学习率
+    1 维的变量 (如 bias) 退化为普通 Adagrad
+    """
+
+    def __init__(self, learning_rate, initial_accumulator_value=0.1, use_locking=False, name='RowAdagrad'):
+        if initial_accumulator_value <= 0.0:
+            raise ValueError('initial_accumulator_value must be positive: {}'.format(initial_accumulator_value))
+        super(RowAdagradOptimizer, self).__init__(use_locking, name)
+        self._learning_rate = learning_rate
+        self._initial_accumulator_value = initial_accumulator_value
+        self._lr_t = None
+
+    @staticmethod
+    def _row_axes(var):
+        return list(range(1, var.get_shape().ndims))
+
+    def _create_slots(self, var_list):
+        for var in var_list:
+            shape = var.get_shape().as_list()
+            shape = shape[:1] + [1] * (len(shape) - 1)
+            self._get_or_make_slot_with_initializer(
+                var, tf.constant_initializer(self._initial_accumulator_value, dtype=var.dtype.base_dtype),
+                tf.TensorShape(shape), var.dtype.base_dtype, 'accumulator', self._name)
+
+    def _prepare(self):
+        self._lr_t = tf.convert_to_tensor(self._learning_rate, name='learning_rate')
+
+    def _row_square(self, grad, var):
+        axes = self._row_axes(var)
+        if not axes:
+            return tf.square(grad)
+        return tf.reduce_mean(tf.square(grad), axis=axes, keepdims=True)
+
+    def _apply_dense(self, grad, var):
+        lr = tf.cast(self._lr_t, var.dtype.base_dtype)
+        acc = self.get_slot(var, 'accumulator')
+        acc_t = tf.assign_add(acc, self._row_square(grad, var), use_locking=self._use_locking)
+        return tf.assign_sub(var, lr * grad / tf.sqrt(acc_t), use_locking=self._use_locking)
+
+    def _resource_apply_dense(self, grad, var):
+        return self._apply_dense(grad, var)
+
+    def _apply_sparse(self, grad, var):
+        return self._apply_rows(grad.values, var, grad.indices)
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        return self._apply_rows(grad, var, indices)
+
+    def _apply_rows(self, values, var, indices):
+        """
+        indices 里的重复行号已由 Optimizer 合并
+        """
+        lr = tf.cast(self._lr_t, var.dtype.base_dtype)
+        acc = self.get_slot(var, 'accumulator')
+        acc_t = tf.scatter_add(acc, indices, self._row_square(values, var), use_locking=self._use_locking)
+        return tf.scatter_sub(var, indices, lr * values / tf.sqrt(tf.gather(acc_t, indices)),
+                              use_locking=self._use_locking)
+
+
+def minimize(loss, optimizer, emb_optimizer=None, var_list=None, emb_names=(), global_step=None):
+    """
+    emb_optimizer 为 None 时同 optimizer.minimize; 否则 embedding 表用 emb_optimizer, 其余变量用 optimizer,
+    优化器只为自己负责的变量建 slot
+    :param emb_names: 算作 embedding 表的变量名; 梯度为 IndexedSlices 的变量也算,
+        reg_mode 为 full 时整表的正则让梯度变成 dense, 需要在这里列出
+    """
+    if emb_optimizer is None:
+        return optimizer.minimize(loss, global_step=global_step, var_list=var_list)
+    if var_list is None:
+        var_list = tf.trainable_variables()
+    grads_and_vars = [(grad, var) for grad, var in zip(tf.gradients(loss, var_list), var_list) if grad is not None]
+    if not grads_and_vars:
+        raise ValueError('no gradients provided for any variable')
+    emb, dense = [], []
+    for grad, var in grads_and_vars:
+        if isinstance(grad, tf.IndexedSlices) or var.name in emb_names:
+            emb.append((grad, var))
+        else:
+            dense.append((grad, var))
+    update_ops = []
+    if emb:
+        update_ops.append(emb_optimizer.apply_gradients(emb))
+    if dense:
+        update_ops.append(optimizer.apply_gradients(dense))
+    if global_step is None:
+        return tf.group(*update_ops)
+    with tf.control_dependencies(update_ops):
+        return tf.assign_add(global_step, 1)
@@ -0,0 +1,215 @@
+# coding=utf-8
+"""
+视觉特征压缩存储, 三种方式:
+    float16     每维 2 字节
+    int8        每维一个字节, 每一维各自的 offset / scale
+    pq          乘积量化, 向量切成 num_subspaces 段, 每段存一个 uint8 码字编号, 码本用 k-means 训练
+
+压缩后的目录:
+    codes.npy   编码后的矩阵, 行顺序与原矩阵相同
+    codec.npz   mode 和解码需要的参数 (offset / scale 或 codebooks)
+
+CompressedTable 按行号取数时才解码, 可以直接放进模型的 photo_table, 在 batch 构造时解码.
+"""
+from __future__ import print_function, division
+import os
+import sys
+
+import numpy as np
+
+MODES = ('float16', 'int8', 'pq')
+
+
+def _iter_rows(num_rows, chunk_rows):
+    for lo in range(0, num_rows, chunk_rows):
+        yield lo, min(lo + chunk_rows, num_rows)
+
+
+def fit_int8(data, chunk_rows=2 ** 16):
+    """
+    :return: (offset, scale), float32 [dim], 编码为 round((x - offset) / scale), 范围 [-127, 127]
+    """
+    mn = np.full(data.shape[1], np.inf, np.float32)
+    mx = np.full(data.shape[1], -np.inf, np.float32)
+    for lo, hi in _iter_rows(data.shape[0], chunk_rows):
+        chunk = np.asarray(data[lo:hi], np.float32)
+        mn = np.minimum(mn, chunk.min(axis=0))
+        mx = np.maximum(mx, chunk.max(axis=0))
+    offset = (mx + mn) / 2
+    scale = np.maximum((mx - mn) / 2 / 127, np.finfo(np.float32).tiny)
+    return offset.astype(np.float32), scale.astype(np.float32)
+
+
+def _assign(x, codebooks, chunk_rows=1024):
+    """
+    每段取最近的码字
+    :param x: [n, num_subspaces, sub_dim]
+    :param codebooks: [num_subspaces, num_codes, sub_dim]
+    :return: int64 [n, num_subspaces]
+    """
+    norms = np.sum(codebooks ** 2, axis=2)
+    codes = np.empty(x.shape[:2], np.int64)
+    for lo, hi in _iter_rows(x.shape[0], chunk_rows):
+        # ||x - c||^2 去掉与 c 无关的 ||x||^2
+        dist = norms[None] - 2 * np.einsum('nmd,mkd->nmk', x[lo:hi], codebooks)
+        codes[lo:hi] = dist.argmin(axis=2)
+    return codes
+
+
+def fit_pq(sample, num_subspaces=256, num_codes=256, num_iter=20, seed=2018):
+    """
+    每段独立做 k-means
+    :param sample: float32 [n, dim], 训练码本用的样本, dim 需要能被 num_subspaces 整除
+    :return: codebooks, float32 [num_subspaces, num_codes, dim // num_subspaces]
+    """
+    sample = np.asarray(sample, np.float32)
+    n, dim = sample.shape
+    if dim % num_subspaces:
+        raise ValueError('dim {} is not divisible by num_subspaces {}'.format(dim, num_subspaces))
+    if num_codes > 256:
+        raise ValueError('num_codes must fit in uint8, got {}'.format(num_codes))
+    if n < num_codes:
+        raise ValueError('need at least {} samples, got {}'.format(num_codes, n))
+    rng = np.random.RandomState(seed)
+    x = sample.reshape(n, num_subspaces, -1)
+    codebooks = x[rng.choice(n, num_codes, replace=False)].transpose(1, 0, 2).copy()
+    seg = np.arange(num_subspaces)[None, :]
+    for it in range(num_iter):
+        codes = _assign(x, codebooks)
+        # 每段每个码字的样本数和向量和, 展平成 num_subspaces * num_codes 个桶一起 bincount
+        flat = (seg * num_codes + codes).ravel()
+        counts = np.bincount(flat, minlength=num_subspaces * num_codes).reshape(num_subspaces, num_codes)
+        sums = np.stack([np.bincount(flat, weights=x[:, :, d].ravel(), minlength=num_subspaces * num_codes)
+                         for d in range(x.shape[2])], axis=1).reshape(num_subspaces, num_codes, -1)
+        empty = counts == 0
+        codebooks = np.where(empty[:, :, None], codebooks, sums / np.maximum(counts, 1)[:, :, None])
+        # 空的码字重新随机取一个样本
+        m_idx, k_idx = np.nonzero(empty)
+        codebooks[m_idx, k_idx] = x[rng.randint(n, size=m_idx.shape[0]), m_idx]
+        codebooks = codebooks.astype(np.float32)
+        print('pq iter {}, {} empty codes'.format(it, m_idx.shape[0]))
+    return codebooks
+
+
+def encode(data, mode, params):
+    """
+    :param data: float32 [n, dim]
+    :param params: fit_int8 / fit_pq 的结果, float16 时为 None
+    """
+    data = np.asarray(data, np.float32)
+    if mode == 'float16':
+        return data.astype(np.float16)
+    if mode == 'int8':
+        offset, scale = params
+        return np.clip(np.rint((data - offset) / scale), -127, 127).astype(np.int8)
+    if mode == 'pq':
+        return _assign(data.reshape(data.shape[0], params.shape[0], -1), params).astype(np.uint8)
+    raise ValueError('unknown mode {}, expected one of {}'.format(mode, MODES))
+
+
+def decode(codes, mode, params):
+    """
+    :return: float32 [n, dim]
+    """
+    codes = np.asarray(codes)
+    if mode == 'float16':
+        return codes.astype(np.float32)
+    if mode == 'int8':
+        offset, scale = params
+        return codes.astype(np.float32) * scale + offset
+    if mode == 'pq':
+        return params[np.arange(params.shape[0]), codes.astype(np.int64)].reshape(codes.shape[0], -1)
+    raise ValueError('unknown mode {}, expected one of {}'.format(mode, MODES))
+
+
+def compress(src_path, out_dir, mode, sample_rows=2 ** 16, chunk_rows=2 ** 16, seed=2018, **pq_params):
+    """
+    把 .npy 视觉矩阵按块压缩到 out_dir
+    :param sample_rows: pq 训练码本的随机样本行数
+    """
+    if mode not in MODES:
+        raise ValueError('unknown mode {}, expected one of {}'.format(mode, MODES))
+    data = np.load(src_path, mmap_mode='r')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    arrays = {'mode': np.array(mode)}
+    params = None
+    if mode == 'int8':
+        params = fit_int8(data, chunk_rows)
+        arrays['offset'], arrays['scale'] = params
+    elif mode == 'pq':
+        rows = np.random.RandomState(seed).choice(data.shape[0], min(sample_rows, data.shape[0]), replace=False)
+        params = fit_pq(data[np.sort(rows)], seed=seed, **pq_params)
+        arrays['codebooks'] = params
+    first = encode(data[:1], mode, params)
+    codes = np.lib.format.open_memmap(os.path.join(out_dir, 'codes.npy'), mode='w+', dtype=first.dtype,
+                                      shape=(data.shape[0], first.shape[1]))
+    for lo, hi in _iter_rows(data.shape[0], chunk_rows):
+        codes[lo:hi] = encode(data[lo:hi], mode, params)
+    codes.flush()
+    np.savez(os.path.join(out_dir, 'codec.npz'), **arrays)
+    print('{}: {:.1f} MB -> {:.1f} MB'.format(mode, data.nbytes / 2 ** 20, codes.nbytes / 2 ** 20))
+
+
+class CompressedTable(object):
+    """
+    压缩后的视觉矩阵, table[rows] 返回解码后的 float32 [len(rows), dim]
+    """
+
+    def __init__(self, path, mmap_mode=None):
+        """
+        :param mmap_mode: None 时编码整体读进内存, 'r' 时按需从磁盘读
+        """
+        with np.load(os.path.join(path, 'codec.npz')) as codec:
+            self.mode = str(codec['mode'])
+            if self.mode == 'int8':
+                self.params = (codec['offset'], codec['scale'])
+            elif self.mode == 'pq':
+                self.params = codec['codebooks']
+            else:
+                self.params = None
+        self.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode=mmap_mode)
+        dim = self.codes.shape[1] * (self.params.shape[2] if self.mode == 'pq' else 1)
+        self.shape = (self.codes.shape[0], dim)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        rows = np.asarray(rows)
+        codes = self.codes[rows.reshape(-1)]
+        return decode(codes, self.mode, self.params).reshape(rows.shape + (self.shape[1],))
+
+
+def open_table(path, mmap_mode='r'):
+    """
+    .npy 原始矩阵直接 mmap, 压缩目录返回 CompressedTable (编码读进内存)
+    """
+    if os.path.isdir(path):
+        return CompressedTable(path)
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def reconstruction_report(src_path, table, sample_rows=2 ** 14, seed=2018):
+    """
+    随机取样本行, 比较原矩阵和解码结果
+    :return: dict, 相对平方误差和余弦相似度的均值
+    """
+    data = np.load(src_path, mmap_mode='r')
+    rows = np.sort(np.random.RandomState(seed).choice(data.shape[0], min(sample_rows, data.shape[0]),
+                                                      replace=False))
+    origin = np.asarray(data[rows], np.float32)
+    decoded = table[rows]
+    err = np.sum((origin - decoded) ** 2, axis=1)
+    norm = np.sum(origin ** 2, axis=1)
+    cos = np.sum(origin * decoded, axis=1) / np.maximum(
+        np.sqrt(norm * np.sum(decoded ** 2, axis=1)), np.finfo(np.float32).tiny)
+    return {'relative_mse': float(np.sum(err) / max(np.sum(norm), np.finfo(np.float32).tiny)),
+            'mean_cosine': float(np.mean(cos))}
+
+
+if __name__ == '__main__':
+    # python visual_codec.py ../data/visual/photo_visual.npy ../data/visual/photo_visual_pq pq
+    src, out, mode = sys.argv[1:4]
+    compress(src, out, mode)
+    print(mode, reconstruction_report(src, CompressedTable(out)))
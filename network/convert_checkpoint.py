@@ -0,0 +1,68 @@
+# coding=utf-8
+"""
+旧检查点的转换: one-hot 字段原来每个字段一个变量 (one_hot_<i>, oh_attention_<i> 等),
+现在合并成一个变量 (见 utils.FieldEmbedding / field_attention_weights),
+按字段的表沿第 0 维拼接, attention 矩阵叠成 [num_fields, dim_k, att_dim_k], 优化器的 slot 一并转换
+"""
+from __future__ import print_function
+import re
+
+import numpy as np
+import tensorflow as tf
+
+# 旧变量名前缀 -> (合并后的变量名, 拼接方式)
+FUSED_FIELDS = {
+    'one_hot': ('one_hots', 'concat'),
+    'deep_one_hot': ('deep_one_hots', 'concat'),
+    'ctx_oh': ('ctx_oh', 'concat'),
+    'oh_attention': ('oh_attention', 'stack'),
+    'oh_ctx_attention': ('oh_ctx_attention', 'stack'),
+}
+_FIELD_PATTERN = re.compile(r'^({})_(\d+)(/.*)?$'.format('|'.join(sorted(FUSED_FIELDS, key=len, reverse=True))))
+
+
+def fused_values(ckpt_path):
+    """
+    读旧检查点, 按字段存的变量 (及其 slot) 合并, 其余变量原样保留
+    :return: dict, 变量名 -> ndarray
+    """
+    reader = tf.train.load_checkpoint(ckpt_path)
+    values, fields = {}, {}
+    for name in reader.get_variable_to_shape_map():
+        match = _FIELD_PATTERN.match(name)
+        if match is None:
+            values[name] = reader.get_tensor(name)
+        else:
+            prefix, index, suffix = match.groups()
+            fields.setdefault((prefix, suffix or ''), {})[int(index)] = reader.get_tensor(name)
+    for (prefix, suffix), tensors in fields.items():
+        if sorted(tensors) != list(range(len(tensors))):
+            raise ValueError('fields of {}{} are not contiguous: {}'.format(prefix, suffix, sorted(tensors)))
+        new_name, mode = FUSED_FIELDS[prefix]
+        tensors = [tensors[i] for i in range(len(tensors))]
+        values[new_name + suffix] = np.concatenate(tensors, axis=0) if mode == 'concat' else np.stack(tensors, axis=0)
+    return values
+
+
+def convert_fused_fields(ckpt_path, new_ckpt_path):
+    """
+    旧检查点转成合并变量名的新检查点, 只写变量不写 meta graph
+    :return: 新检查点的路径
+    """
+    values = fused_values(ckpt_path)
+    with tf.Graph().as_default():
+        feed_dict, var_list = {}, {}
+        # 变量先于它的 slot (one_hots 先于 one_hots/Adam) 建, 免得 name scope 被改名; 保存时的键仍按 var_list 的键
+        for name in sorted(values):
+            value = values[name]
+            placeholder = tf.placeholder(tf.as_dtype(value.dtype), value.shape)
+            var_list[name] = tf.Variable(placeholder, trainable=False, name=name)
+            feed_dict[placeholder] = value
+        saver = tf.train.Saver(var_list)
+        with tf.Session() as sess:
+            sess.run(tf.variables_initializer(list(var_list.values())), feed_dict=feed_dict)
+            return saver.save(sess, new_ckpt_path, write_meta_graph=False)
+
+
+if __name__ == '__main__':
+    print(convert_fused_fields('../model/lda_modelbest.ckpt-14487', '../model/lda_modelbest_fused.ckpt-14487'))
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+训练输入流水线: 后台线程按顺序组装 batch (切片 + 转 numpy), 通过有界队列预取,
+训练线程只负责 feed 和 sess.run. sess.run 期间会释放 GIL, 下一个 batch 的组装
+与当前 batch 的计算重叠进行.
+"""
+from __future__ import print_function, division
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+_DONE = object()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+def batch_rows(n_samples, batch_size, shuffle=False, random_state=None):
+    """
+    把一个 epoch 切成若干 batch 的行号
+    :param shuffle: 为 True 时先打乱, 打乱方式与 sklearn.utils.shuffle 一致
+    :param random_state: int 随机种子
+    :return: [np.ndarray], 每个元素是一个 batch 的行号
+    """
+    rows = np.arange(n_samples)
+    if shuffle:
+        np.random.RandomState(random_state).shuffle(rows)
+    return [rows[start:start + batch_size] for start in range(0, n_samples, batch_size)]
+
+
+class Prefetcher(object):
+    """
+    按顺序产出 make_batch(0), make_batch(1), ... make_batch(num_batches - 1).
+    第 j 个 batch 由第 j % num_threads 个线程组装, 每个线程最多领先 capacity 个 batch,
+    所以输出顺序与串行执行完全一致.
+    """
+
+    def __init__(self, make_batch, num_batches, num_threads=2, capacity=2):
+        if num_threads < 1 or capacity < 1:
+            raise ValueError('num_threads and capacity must be positive')
+        self.make_batch = make_batch
+        self.num_batches = num_batches
+        self.num_threads = num_threads
+        # 训练线程等数据的累计时间, 接近 0 说明输入不再是瓶颈
+        self.wait_time = 0.
+        self._stop = threading.Event()
+        self._queues = [queue.Queue(maxsize=capacity) for _ in range(num_threads)]
+        self._threads = [threading.Thread(target=self._work, args=(t,)) for t in range(num_threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _work(self, t):
+        q = self._queues[t]
+        for j in range(t, self.num_batches, self.num_threads):
+            try:
+                item = self.make_batch(j)
+            except Exception as e:
+                self._put(q, _Failure(e))
+                return
+            if not self._put(q, item):
+                return
+        self._put(q, _DONE)
+
+    def __iter__(self):
+        try:
+            for j in range(self.num_batches):
+                start = time.time()
+                item = self._queues[j % self.num_threads].get()
+                self.wait_time += time.time() - start
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
@@ -1,57 +1,102 @@
 from __future__ import division, print_function
+import os
+import sys
+
 import pandas as pd
 import numpy as np
 from network_text_lda import Model
+import convert_checkpoint
+import feature_store
+import key_index
+import metrics
+import visual_codec
 import tensorflow as tf
 
 
-def yield_uid(train_data, val_data, test_data):
-    total = train_data.shape[0]
-    train_data, val_data, test_data = [df.sort_values(['uid']) for df in [train_data, val_data, test_data]]
-    print('sorted data...')
-    tr_len, val_len, te_len = [df.shape[0] for df in [train_data, val_data, test_data]]
-    train_data.index, val_data.index, test_data.index = [range(df.shape[0]) for df in [train_data, val_data, test_data]]
-    tr_last, val_last, te_last, tr_idx, val_idx, te_idx = [0] * 6
-    # tr_last, val_last, te_last= [0] * 3
-    last_uid = train_data.loc[0, 'uid']
-    while tr_idx != tr_len - 1:
-        tr_temp, te_temp, val_temp = None, None, None
-        for tr_idx in xrange(tr_last + 1, tr_len):
-            if train_data.loc[tr_idx, 'uid'] != last_uid:
-                print('===========train uid: {:.2f} {} {}-{}'.format(tr_idx / total, train_data.loc[tr_idx, 'uid'],
-                                                                     tr_last, tr_idx))
-                tr_temp = train_data.loc[tr_last:tr_idx - 1, :]
-                tr_last = tr_idx
-                break
-        for te_idx in xrange(te_last + 1, te_len):
-            if test_data.loc[te_idx, 'uid'] != last_uid:
-                if test_data.loc[te_idx, 'uid'] != train_data.loc[tr_idx, 'uid']:
-                    print('[WORNING] train and test uid are not same!!!')
-                print(
-                    '===========test uid: {:.2f} {} {}-{}'.format(tr_idx / total, test_data.loc[te_idx, 'uid'], te_last,
-                                                                  te_idx))
-                te_temp = test_data.loc[te_last:te_idx - 1, :]
-                te_last = te_idx
-                break
-        for val_idx in xrange(val_last + 1, val_len):
-            if val_data.loc[val_idx, 'uid'] != last_uid:
-                if val_data.loc[val_idx, 'uid'] == train_data.loc[tr_idx, 'uid']:
-                    print('===========valid uid: {:.2f} {} {}-{}'.format(tr_idx / total, val_data.loc[val_idx, 'uid'],
-                                                                         val_last, val_idx))
-                    val_temp = val_data.loc[val_last:val_idx - 1, :]
-                    val_last = val_idx
-                    break
-                else:
-                    val_idx -= 1
-                    val_temp = None
-                    break
-        last_uid = train_data.loc[tr_idx, 'uid']
-        if tr_temp is not None:
-            yield tr_temp, te_temp, val_temp
-    yield train_data.loc[tr_last:, :], test_data.loc[te_last:, :], val_data.loc[val_last:, :]
+def yield_uid(train_data, val_data, test_data, val_index=None, te_index=None):
+    """
+    按用户产出 (训练, 测试, 验证) 的行, 用户没有测试或验证数据时对应为 None
+    :param val_index: 验证集按 uid 的 KeyIndex, 行号对应 val_data 的位置 (val_data 须是按存储的行顺序整表读出的);
+        为 None 时现建, te_index 同
+    """
+    tr_index = key_index.KeyIndex.build(train_data['uid'].values)
+    if val_index is None:
+        val_index = key_index.KeyIndex.build(val_data['uid'].values)
+    if te_index is None:
+        te_index = key_index.KeyIndex.build(test_data['uid'].values)
+    for name, index, df in [('val', val_index, val_data), ('test', te_index, test_data)]:
+        if index.order.shape[0] != df.shape[0]:
+            raise ValueError('{} index covers {} rows, frame has {}'.format(name, index.order.shape[0], df.shape[0]))
+    te_pos, val_pos = te_index.positions(tr_index.keys), val_index.positions(tr_index.keys)
+    total = len(tr_index)
+    for i, uid in enumerate(tr_index.keys):
+        tr_rows = tr_index.rows_at(i)
+        print('===========uid: {:.2f} {} {} rows'.format(i / total, uid, tr_rows.shape[0]))
+        te_temp = test_data.iloc[te_index.rows_at(te_pos[i])] if te_pos[i] >= 0 else None
+        val_temp = val_data.iloc[val_index.rows_at(val_pos[i])] if val_pos[i] >= 0 else None
+        if te_temp is None:
+            print('[WORNING] train and test uid are not same!!!')
+        yield train_data.iloc[tr_rows], te_temp, val_temp
     print('finished yield')
 
 
+def adapt_per_user(model, train_data, val_data, test_data):
+    """
+    逐用户微调整个网络后预测, 每个用户微调前从内存快照恢复所有变量 (包括 adam 的 slot)
+    :return: (val_uids, val_labels, val_preds, te_uids, te_pids, te_preds)
+    """
+    val_uids, val_labels, val_preds = [], [], []
+    te_uids, te_pids, te_preds = [], [], []
+    model.snapshot()
+    # 验证 / 测试集是从 ../data/val_data, ../data/test_data 存储按原顺序整表读出的, 行号与预处理时建好的
+    # uid 索引一致, 直接读索引; 训练集拼上了验证集, 索引现建
+    val_index = key_index.load_store_index('../data/val_data', 'uid')
+    te_index = key_index.load_store_index('../data/test_data', 'uid')
+    for tr_df, te_df, val_df in yield_uid(train_data, val_data, test_data, val_index, te_index):
+        model.restore_snapshot()
+        model.drop_out_deep_on_train = 0.5
+        model.drop_out_emb_on_train = 0.5
+        model.train_on_batch(tr_df, 10)
+        if val_df is not None:
+            try:
+                val_score = model.evaluate(val_df, split=1, cache=False)
+                val_pred = model.pred_prob(val_df, split=1, cache=False)
+                val_label = val_df['click'].as_matrix()
+                val_preds.extend(val_pred)
+                val_labels.extend(val_label)
+                val_uids.extend(val_df['uid'].tolist())
+                print('val_score:', val_score, '...')
+            except Exception as e:
+                print(e)
+        if te_df is not None:
+            te_pred = model.pred_prob(te_df, split=1, cache=False)
+            te_preds.extend(te_pred)
+            te_uids.extend(te_df['uid'].tolist())
+            te_pids.extend(te_df['pid'].tolist())
+        del tr_df, te_df, val_df
+    # 恢复到微调前, 之后还可以接着跑 adapt_batched 对比
+    model.restore_snapshot()
+    return val_uids, val_labels, val_preds, te_uids, te_pids, te_preds
+
+
+def adapt_batched(model, train_data, val_data, test_data, epochs=3):
+    """
+    所有用户混在一起, 只微调用户参数, 然后整体预测一遍
+    :return: 同 adapt_per_user
+    """
+    model.compile_adaptation(optimizer='adagrad', lr=0.01)
+    model.adapt_users(train_data, batch_size=4096, epochs=epochs)
+    val_preds = model.pred_prob(val_data, cache=False)
+    te_preds = model.pred_prob(test_data, cache=False)
+    return (val_data['uid'].tolist(), val_data['click'].values.tolist(), val_preds,
+            test_data['uid'].tolist(), test_data['pid'].tolist(), te_preds)
+
+
+def report_val(name, model, val_uids, val_labels, val_preds):
+    print('{} total_val_score:'.format(name), model.scoreAUC(val_labels, val_preds))
+    print('{} total_val_uauc:'.format(name), metrics.group_auc(val_uids, val_labels, val_preds))
+
+
 if __name__ == '__main__':
     user_embs = pd.read_pickle('../model/user_emb.pkl')
     user_embs = user_embs.sort_values(['user_indices'])
@@ -72,25 +117,42 @@ if __name__ == '__main__':
     # test_data.to_pickle('../data/test_data_merged.pkl')
     # val_data.to_pickle('../data/val_data_merged.pkl')
 
-    train_data = pd.read_pickle('../data/train_data_merged.pkl')
-    val_data = pd.read_pickle('../data/val_data_merged.pkl')
-    test_data = pd.read_pickle('../data/test_data_merged.pkl')
-    train_data = pd.concat([train_data, val_data])
+    # 视觉特征由 preprocessing/concat_visual_feature.py 按 photo 表顺序写成 memmap
+    visual_embs = visual_codec.open_table('../data/visual/photo_visual.npy')
+    print('visual:', visual_embs.shape)
+
+    # 交互数据只读 id 和交互级别的列, photo 级别的特征按 photo_indices 从 photo 表里取
+    data_columns = ['uid', 'pid', 'user_indices', 'photo_indices', 'click', 'context']
+    train_data = feature_store.read_frame('../data/train_data', data_columns)
+    val_data = feature_store.read_frame('../data/val_data', data_columns)
+    test_data = feature_store.read_frame('../data/test_data', data_columns)
+    train_data = pd.concat([train_data, val_data], ignore_index=True)
 
+    photo_store = feature_store.FeatureStore('../data/photo_features')
+    photo_table = {
+        'visual': visual_embs,
+        'words_lda': photo_store['topics'],
+        'one_hots': photo_store['face_cols_01'],
+        'face_num': photo_store['face_cols_num'],
+    }
     one_hots_dims = []
-    face_cols = np.array(train_data['face_cols_01'].tolist())
+    face_cols = np.asarray(photo_store['face_cols_01'])
     one_hots_dims.extend((face_cols.max(axis=0) + 1))
     print('one_hot_dims:', one_hots_dims)
 
-    dim_num_feat = val_data.ix[0, 'context'].shape[0]
+    dim_num_feat = feature_store.frame_matrix(val_data, 'context').shape[1]
     print('dim_num_feat:', dim_num_feat)
 
+    words_csr = photo_store['words']
+
     model_params = {
         'num_user': 15141,
         'num_recent_item': 30,
         'num_words': 119637,
         'dim_num_feat': dim_num_feat,
         'one_hots_dims': one_hots_dims,
+        'words_csr': words_csr,
+        'photo_table': photo_table,
         'dim_k': 96,
         'att_dim_k': 16,
         'dim_hidden_out': (256, 128, 64, 32),
@@ -106,8 +168,6 @@ if __name__ == '__main__':
     }
     model_ori = Model(**model_params)
     model_ori.compile(optimizer='adam')
-    val_preds = []
-    val_labels = []
     # vars = []
     # with model_ori.graph.as_default():
     #     for var in tf.global_variables():
@@ -116,38 +176,26 @@ if __name__ == '__main__':
     # model = Model(**model_params)
     # model.compile(optimizer='adam')
     model = model_ori
-    te_uids = []
-    te_pids = []
-    te_preds = []
-    # cnt = 1
-    for tr_df, te_df, val_df in yield_uid(train_data, val_data, test_data):
-        model.load_model('../model/lda_modelbest.ckpt-14487.meta', ckpt_path='../model/lda_modelbest.ckpt-14487')
-        # with model.graph.as_default():
-        #     for vf, vt in zip(vars, tf.global_variables()):
-        #         tf.assign(vt, vf)
-        model.drop_out_deep_on_train = 0.5
-        model.drop_out_emb_on_train = 0.5
-        model.train_on_batch(tr_df, 10)
-        if val_df is not None:
-            try:
-                val_score = model.evaluate(val_df, split=1, cache=False)
-                val_pred = model.pred_prob(val_df, split=1, cache=False)
-                val_label = val_df['click'].as_matrix()
-                val_preds.extend(val_pred)
-                val_labels.extend(val_label)
-                print('val_score:', val_score, '...')
-            except Exception as e:
-                print(e)
-        te_pred = model.pred_prob(te_df, split=1, cache=False)
-        te_preds.extend(te_pred)
-        te_uids.extend(te_df['uid'].tolist())
-        te_pids.extend(te_df['pid'].tolist())
-        del tr_df, te_df, val_df
-        # if cnt % 1000 == 0:
-        #     pd.DataFrame({'uid': te_uids, 'pid': te_pids, 'preds': te_preds}).to_pickle(
-        #         '../model/tmp/peruser_reg001_lr001_{}.pkl'.format(tr_df.iloc[0, :]['uid']))
-        #     te_uids, te_pids, te_preds = list(), list(), list()
-        # cnt += 1
+    # 检查点是按字段存 one-hot 变量时保存的, 先转成合并后的变量名
+    fused_ckpt_path = '../model/lda_modelbest_fused.ckpt-14487'
+    if not os.path.exists(fused_ckpt_path + '.index'):
+        convert_checkpoint.convert_fused_fields('../model/lda_modelbest.ckpt-14487', fused_ckpt_path)
+    model.load_model('../model/lda_modelbest.ckpt-14487.meta', ckpt_path=fused_ckpt_path)
+    # 'per_user': 逐用户微调整个网络; 'batched': 所有用户混在一起只微调用户参数;
+    # 'compare': 从同一个检查点先后跑两种, 打印各自的验证集 AUC / uAUC, 测试集预测仍用 per_user 的.
+    # 两种的验证集 AUC 对比一致之前默认仍用 per_user
+    adapt_mode = sys.argv[1] if len(sys.argv) > 1 else 'per_user'
+    if adapt_mode not in ('per_user', 'batched', 'compare'):
+        raise ValueError('unknown adapt mode: {}'.format(adapt_mode))
+    if adapt_mode == 'batched':
+        val_uids, val_labels, val_preds, te_uids, te_pids, te_preds = adapt_batched(model, train_data, val_data,
+                                                                                    test_data)
+    else:
+        val_uids, val_labels, val_preds, te_uids, te_pids, te_preds = adapt_per_user(model, train_data, val_data,
+                                                                                     test_data)
     pd.DataFrame({'uid': te_uids, 'pid': te_pids, 'preds': te_preds}).to_pickle(
-        '../model/peruser_reg001_lr001.pkl')
-    print('total_val_score:', model.scoreAUC(val_labels, val_preds))
+        '../model/peruser_reg001_lr001.pkl' if adapt_mode != 'batched' else '../model/batched_adagrad_lr001.pkl')
+    report_val(adapt_mode if adapt_mode != 'compare' else 'per_user', model, val_uids, val_labels, val_preds)
+    if adapt_mode == 'compare':
+        batched_val = adapt_batched(model, train_data, val_data, test_data)[:3]
+        report_val('batched', model, *batched_val)
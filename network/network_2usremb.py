@@ -6,7 +6,11 @@ import time
 import numpy as np
 
 from VAE_Encoder import VAE
-from utils import get_sample_num, new_variable_initializer, sklearn_shuffle
+from utils import get_sample_num, new_variable_initializer, sklearn_shuffle, sparse_embedding_sum, embedding_l2_loss, REG_MODES, SideTable
+from utils import FieldEmbedding, field_attention_weights, field_attention
+import feature_store
+import metrics
+import optimizers
 import os
 from tensorflow.python.ops import random_ops
 
@@ -18,11 +22,13 @@ class Model(object):
                  user_emb_feat,
                  dim_lda,
                  seed=1024,
-                 use_deep=True, deep_dims=(256, 128, 64), dim_hidden_out=(64, 32, 16), checkpoint_path=None):
+                 use_deep=True, deep_dims=(256, 128, 64), dim_hidden_out=(64, 32, 16), checkpoint_path=None, words_csr=None, reg_mode='full'):
         self.att_reg = None
         self.seed = seed
         if checkpoint_path and checkpoint_path.count('/') < 2:
             raise ValueError('checkpoint_path must be dir/model_name format')
+        if reg_mode not in REG_MODES:
+            raise ValueError('reg_mode must be one of {}'.format(REG_MODES))
         self.checkpoint_path = checkpoint_path
         self.train_flag = True
         self.graph = tf.Graph()
@@ -45,6 +51,7 @@ class Model(object):
         self.dim_k = dim_k
         self.att_dim_k = att_dim_k
         self.reg = reg
+        self.reg_mode = reg_mode
         self.att_reg = att_reg
         self.lr = lr
         self.prefix = prefix
@@ -55,6 +62,8 @@ class Model(object):
         self.user_emb_feat = user_emb_feat
         self.dim_lda = dim_lda
 
+        # 按 photo_indices 预先建好的词 CSR, 为 None 时从 batch 的 words 列现算
+        self.words_csr = words_csr
         self._build_graph()
 
     def _get_optimizer_loss(self, ):
@@ -73,7 +82,7 @@ class Model(object):
 
         self.user_indices = tf.placeholder(shape=[None], dtype=tf.float32, name='user_indices')  # [batch_size]
 
-        self.item_words_indices_a = tf.placeholder(shape=[None, 2], dtype=tf.float32,
+        self.item_words_indices_a = tf.placeholder(shape=[None, 2], dtype=tf.int64,
                                                    name='item_words_indices_a')  # [num_indices, dim]
 
         self.item_words_values_a = tf.placeholder(shape=[None], dtype=tf.float32,
@@ -107,6 +116,12 @@ class Model(object):
 
     def _create_weights(self):
 
+        # 预训练的用户特征表, 值在 compile 时 feed 进变量, 不作为常量写进图
+        self.user_emb_table = SideTable(self.user_emb_feat, name='user_emb_feat')
+        # 表的值只由 SideTable 持有, 第一次 load 后释放
+        self.user_emb_feat = None
+        self.side_tables = [self.user_emb_table]
+
         # Embedding
         self.Wu_Emb_a = tf.get_variable(shape=[self.num_user, self.dim_k], initializer=tf.glorot_uniform_initializer(),
                                       dtype=tf.float32, name='user_embedding_a')
@@ -129,12 +144,9 @@ class Model(object):
                                          initializer=tf.glorot_uniform_initializer(),
                                          dtype=tf.float32, name='LDA_embedding')
 
-        self.W_one_hots = []
-        for i in range(len(self.one_hots_dims)):
-            W_temp = tf.get_variable(shape=[self.one_hots_dims[i], self.dim_k],
-                                     initializer=tf.glorot_uniform_initializer(),
-                                     dtype=tf.float32, name='one_hot_{}'.format(i))
-            self.W_one_hots.append(W_temp)
+        # 各 one-hot 字段拼成一张表, 按字段偏移取行
+        self.one_hots_field = FieldEmbedding(self.one_hots_dims, self.dim_k, name='one_hots')
+        self.W_one_hots = self.one_hots_field.table
 
         self.W_Ctx = tf.get_variable(shape=[self.dim_num_feat, self.dim_k],
                                      initializer=tf.glorot_uniform_initializer(),
@@ -149,12 +161,8 @@ class Model(object):
                                         initializer=tf.glorot_uniform_initializer(),
                                         dtype=tf.float32, name='context_attention')
 
-        self.Woh_Att = []
-        for i in range(len(self.one_hots_dims)):
-            W_temp = tf.get_variable(shape=[self.dim_k, self.att_dim_k],
-                                     initializer=tf.glorot_uniform_initializer(),
-                                     dtype=tf.float32, name='oh_attention_{}'.format(i))
-            self.Woh_Att.append(W_temp)
+        self.Woh_Att = field_attention_weights(len(self.one_hots_dims), self.dim_k, self.att_dim_k,
+                                               name='oh_attention')
 
         self.WW_Att = tf.get_variable(shape=[self.dim_k, self.att_dim_k],
                                       initializer=tf.glorot_uniform_initializer(),
@@ -191,13 +199,13 @@ class Model(object):
 
         self.params = [self.Wu_Emb_a, self.Wu_Emb_b, self.Wwords_Emb, self.W_Ctx, self.W_usr_feat_emb_a, self.W_usr_feat_emb_b, self.W_LDA_emb, self.bias_u,
                        self.bias,
-                       self.c_oh_Att + self.b_oh_Att + self.b_in_prd_att] + self.W_one_hots
+                       self.c_oh_Att + self.b_oh_Att + self.b_in_prd_att, self.W_one_hots]
 
         self.att_params = [self.WW_Att, self.W_visual_Att, self.Wu_oh_Att, self.Wctx_Att, self.W_LDA_Att,
                            self.w_oh_Att,
                            self.w_in_prd_att,
                            self.W_in_prd_att,
-                           ] + self.Woh_Att
+                           self.Woh_Att]
 
         # deep 参数
         if self.use_deep:
@@ -208,12 +216,8 @@ class Model(object):
             self.Wwords_deep_emb = tf.get_variable(shape=[self.num_words, self.dim_k],
                                                    initializer=tf.glorot_uniform_initializer(),
                                                    dtype=tf.float32, name='words_deep_emb')
-            self.W_deep_one_hots = []
-            for i in range(len(self.one_hots_dims)):
-                W_temp = tf.get_variable(shape=[self.one_hots_dims[i], self.dim_k],
-                                         initializer=tf.glorot_uniform_initializer(),
-                                         dtype=tf.float32, name='deep_one_hot_{}'.format(i))
-                self.W_deep_one_hots.append(W_temp)
+            self.deep_one_hots_field = FieldEmbedding(self.one_hots_dims, self.dim_k, name='deep_one_hots')
+            self.W_deep_one_hots = self.deep_one_hots_field.table
 
     def _batch_norm_layer(self, x, train_phase, scope_bn):
         with tf.variable_scope(scope_bn):
@@ -249,8 +253,7 @@ class Model(object):
             # 用户隐向量a
             self.Usr_Emb_a = tf.nn.embedding_lookup(self.Wu_Emb_a,
                                                   tf.cast(self.user_indices, tf.int32))  # [batch_size, dim_k]
-            self.Usr_Feat_a = tf.nn.embedding_lookup(self.user_emb_feat,
-                                                   tf.cast(self.user_indices, tf.int32))  # [batch_size, 128]
+            self.Usr_Feat_a = self.user_emb_table.lookup(self.user_indices)  # [batch_size, 128]
 
             self.Usr_Feat_Emb_a = tf.matmul(self.Usr_Feat_a, self.W_usr_feat_emb_a)  # [batch_size, dim_k]
             self.Usr_Feat_Emb_a = tf.nn.relu(self.Usr_Feat_Emb_a)
@@ -262,8 +265,7 @@ class Model(object):
             # 用户隐向量b
             self.Usr_Emb_b = tf.nn.embedding_lookup(self.Wu_Emb_b,
                                                   tf.cast(self.user_indices, tf.int32))  # [batch_size, dim_k]
-            self.Usr_Feat_b = tf.nn.embedding_lookup(self.user_emb_feat,
-                                                   tf.cast(self.user_indices, tf.int32))  # [batch_size, 128]
+            self.Usr_Feat_b = self.user_emb_table.lookup(self.user_indices)  # [batch_size, 128]
 
             self.Usr_Feat_Emb_b = tf.matmul(self.Usr_Feat_b, self.W_usr_feat_emb_b)  # [batch_size, dim_k]
             self.Usr_Feat_Emb_b = tf.nn.relu(self.Usr_Feat_Emb_b)
@@ -280,13 +282,13 @@ class Model(object):
 
         # 物品的向量表示
         with tf.name_scope('item_express'):
-            self.I_Wds_a = tf.SparseTensor(indices=tf.cast(self.item_words_indices_a, dtype=np.int64),
+            self.I_Wds_a = tf.SparseTensor(indices=self.item_words_indices_a,
                                            values=self.item_words_values_a,
                                            dense_shape=[tf.cast(self.batch_size, dtype=np.int64), self.num_words])
             self.att_u_a = tf.matmul(self.Usr_Emb_a, self.Wu_oh_Att)  # [batch_size, dim_k]
             self.att_ctx = tf.matmul(self.Ctx_Emb, self.Wctx_Att)
             self.att_oh = []
-            self.I_Wds_Emb_a = tf.sparse_tensor_dense_matmul(self.I_Wds_a, self.Wwords_Emb)  # [batch_size, dim_k]
+            self.I_Wds_Emb_a = sparse_embedding_sum(self.I_Wds_a, self.Wwords_Emb)  # [batch_size, dim_k]
             self.I_Wds_Emb_a = tf.nn.relu(self.I_Wds_Emb_a)
 
             self.att_I_Wds = tf.matmul(self.I_Wds_Emb_a, self.WW_Att)  # 词的attention
@@ -310,41 +312,31 @@ class Model(object):
             self.att_I_LDA = tf.matmul(self.att_I_LDA, self.w_oh_Att) + self.c_oh_Att
             self.att_oh.append(self.att_I_LDA)
 
-            self.I_One_hot_a = []
-            for i in range(len(self.one_hots_dims)):
-                I_Emb_temp_a = tf.nn.embedding_lookup(self.W_one_hots[i],
-                                                      tf.cast(self.one_hots_a[:, i],
-                                                              tf.int32))  # [batch_size, dim_k]
-                att_oh_temp = tf.matmul(I_Emb_temp_a, self.Woh_Att[i])  # [batch_size, att_dim_k]
-                att_temp = tf.nn.relu(
-                    self.att_u_a + self.att_ctx + att_oh_temp + self.b_oh_Att)  # [batch_size, att_dim_k]
-                att_temp = tf.matmul(att_temp, self.w_oh_Att) + self.c_oh_Att  # [batch_size, 1]
-                self.att_oh.append(att_temp)
-                self.I_One_hot_a.append(I_Emb_temp_a)
+            self.I_One_hot_a = self.one_hots_field.lookup(self.one_hots_a)  # [batch_size, num_one_hots, dim_k]
+            self.att_oh.append(field_attention(self.I_One_hot_a, self.Woh_Att, self.att_u_a + self.att_ctx,
+                                               self.b_oh_Att, self.w_oh_Att, self.c_oh_Att))  # [batch_size, num_one_hots]
             self.att_oh = tf.nn.softmax(tf.concat(self.att_oh, axis=1))  # [batch_size, oh_dim] 第一列是词attention
             self.I_Wds_Emb_a = self.I_Wds_Emb_a * self.att_oh[:, 0:1]
             self.I_visual_Emb = self.I_visual_Emb * self.att_oh[:, 1:2]
             self.I_LDA_Emb = self.I_LDA_Emb * self.att_oh[:, 2:3]
-            for i in range(3, len(self.one_hots_dims) + 3):
-                self.I_One_hot_a[i - 3] = self.I_One_hot_a[i - 3] * self.att_oh[:, i:i + 1]
-            self.Item_Expr_a = tf.add_n(self.I_One_hot_a + [self.I_visual_Emb, self.I_Wds_Emb_a, self.I_LDA_Emb])
+            self.I_One_hot_a = self.I_One_hot_a * tf.expand_dims(self.att_oh[:, 3:], 2)
+            self.Item_Expr_a = tf.add_n([tf.reduce_sum(self.I_One_hot_a, axis=1),
+                                         self.I_visual_Emb, self.I_Wds_Emb_a, self.I_LDA_Emb])
 
         with tf.name_scope('deep'):
             if self.use_deep:
                 self.Usr_emb_deep = tf.nn.embedding_lookup(self.Wu_deep_emb,
                                                            tf.cast(self.user_indices, tf.int32))  # [batch_size, dim_k]
-                self.I_Wds_emb_deep = tf.sparse_tensor_dense_matmul(self.I_Wds_a,
-                                                                    self.Wwords_deep_emb)  # [batch_size, dim_k]
-                self.I_one_hot_deep = []
-                for i in range(len(self.one_hots_dims)):
-                    I_Emb_temp_a = tf.nn.embedding_lookup(self.W_deep_one_hots[i], tf.cast(self.one_hots_a[:, i],
-                                                                                           tf.int32))  # [batch_size, dim_k]
-                    self.I_one_hot_deep.append(I_Emb_temp_a)
+                self.I_Wds_emb_deep = sparse_embedding_sum(self.I_Wds_a,
+                                                           self.Wwords_deep_emb)  # [batch_size, dim_k]
+                # [batch_size, num_one_hots * dim_k], 与逐字段 concat 的顺序相同
+                self.I_one_hot_deep = tf.reshape(self.deep_one_hots_field.lookup(self.one_hots_a),
+                                                 [-1, len(self.one_hots_dims) * self.dim_k])
 
                 # self.deep_input = tf.concat([self.num_features, self.Usr_Feat, self.face_num, self.visual_emb_feat],
                 #                             axis=1)  # [batch_size, input_dim]
                 self.deep_input = tf.concat(
-                    [self.num_features, self.visual_emb_feat] + self.I_one_hot_deep, axis=1)
+                    [self.num_features, self.visual_emb_feat, self.I_one_hot_deep], axis=1)
                 # 输入加入batch_norm
                 # self.deep_input = self._batch_norm_layer(self.deep_input, self.train_phase, 'input_bn')
                 for i, deep_dim in enumerate(self.deep_dims):
@@ -397,13 +389,27 @@ class Model(object):
             #         self.y_ui_a += self.deep_output
             #     self.y_ui_a = tf.nn.sigmoid(self.y_ui_a)
 
+    def _lookup_ids(self):
+        """
+        embedding 表的 name -> batch 里取到的行号, reg_mode 不为 full 时只对这些行做 L2
+        """
+        user_ids = tf.cast(self.user_indices, tf.int32)
+        lookup_ids = {self.Wu_Emb_a.name: user_ids,
+                      self.Wu_Emb_b.name: user_ids,
+                      self.bias_u.name: user_ids,
+                      self.Wwords_Emb.name: self.item_words_indices_a[:, 1]}
+        lookup_ids[self.W_one_hots.name] = self.one_hots_field.ids(self.one_hots_a)
+        return lookup_ids
+
     def _create_loss(self):
         self.loss = tf.keras.losses.categorical_crossentropy(self.labels, self.y_ui_a)
         # self.loss = tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(
         #     labels=self.labels, logits=self.y_ui_a))
         # 正则项
+        self.lookup_ids = self._lookup_ids()
         for param in self.params:
-            self.loss = tf.add(self.loss, self.reg * tf.nn.l2_loss(param))
+            self.loss = tf.add(self.loss, self.reg * embedding_l2_loss(param, self.lookup_ids.get(param.name),
+                                                                       self.reg_mode))
         for param in self.att_params:
             self.loss = tf.add(self.loss, self.att_reg * tf.nn.l2_loss(param))
             # self.optimizer = tf.train.AdamOptimizer(0.001).minimize(self.loss)
@@ -425,6 +431,8 @@ class Model(object):
         optimizer_dict = {'sgd': tf.train.GradientDescentOptimizer(self.lr),
                           'adam': tf.train.AdamOptimizer(self.lr),
                           'adagrad': tf.train.AdagradOptimizer(self.lr),
+                          'lazy_adam': optimizers.LazyAdamOptimizer(self.lr),
+                          'row_adagrad': optimizers.RowAdagradOptimizer(self.lr),
                           # 'adagradda':tf.train.AdagradDAOptimizer(),
                           'rmsprop': tf.train.RMSPropOptimizer(self.lr),
                           'moment': tf.train.MomentumOptimizer(self.lr, 0.9),
@@ -462,16 +470,18 @@ class Model(object):
         restore_saver.restore(self.sess, ckpt_path)
 
     def compile(self, optimizer='sgd', metrics=None,
-                only_init_new=False, ):
+                only_init_new=False, emb_optimizer=None):
         """
         compile the model with optimizer and loss function
         :param optimizer:str or predefined optimizer in tensorflow
-        ['sgd','adam','adagrad','rmsprop','moment','ftrl']
+        ['sgd','adam','adagrad','rmsprop','moment','ftrl','lazy_adam','row_adagrad']
         :param loss: str  not used
         :param metrics: str ['logloss','mse','mean_squared_error','logloss_with_logits']
         :param loss_weights:
         :param sample_weight_mode:
         :param only_init_new bool
+        :param emb_optimizer: embedding 表单独用的优化器, 如 'lazy_adam' / 'row_adagrad',
+            其余参数仍用 optimizer; 为 None 时全部用 optimizer
         :return:
         """
         # TODO: 添加loss
@@ -482,8 +492,11 @@ class Model(object):
             update_ops = self.graph.get_collection(tf.GraphKeys.UPDATE_OPS)
             with tf.control_dependencies(update_ops):  # for the use of BN
                 self.op = self._create_optimizer(optimizer)
-                self.optimizer = self.op.minimize(
-                    loss=self._get_optimizer_loss(), global_step=self.global_step)  # 创建优化器
+                self.emb_op = None if emb_optimizer is None else self._create_optimizer(emb_optimizer)
+                emb_names = list(self.lookup_ids)
+                self.optimizer = optimizers.minimize(
+                    self._get_optimizer_loss(), self.op, self.emb_op, global_step=self.global_step,
+                    emb_names=emb_names)  # 创建优化器
                 # 执行初始化操作
             self.saver = tf.train.Saver()  # saver要定义在所有变量定义结束之后，且在计算图中
             if only_init_new is False:
@@ -494,17 +507,18 @@ class Model(object):
                 init_op = new_variable_initializer(
                     self.sess)  # 如果更换了优化器，需要重新初始化一些变量
             self.sess.run(init_op)
+            for table in self.side_tables:
+                table.load(self.sess)
 
     def _item_words_indices_and_values(self, input_data):
-        def func(input):
-            for ix, words in enumerate(input):
-                for word in words:
-                    yield [ix, word]
-
-        indices = list(func(input_data['words']))
-        indices = np.asarray(indices)
-        values = np.ones([indices.shape[0]])
-        return indices, values
+        if self.words_csr is not None:
+            words = self.words_csr.take(input_data['photo_indices'].values)
+        else:
+            words = feature_store.RaggedColumn.from_list(input_data['words'].tolist())
+        indices = words.coo_indices()
+        if indices.shape[0] == 0:
+            return np.zeros([1, 2], np.int64), np.zeros([1], np.float32)
+        return indices, np.ones([indices.shape[0]], np.float32)
 
     def fit(self, input_data, batch_size=1024, epochs=50, validation_data=None, shuffle=True, initial_epoch=0,
             min_display=50, max_iter=-1, drop_out_deep=0.5, drop_out_emb=0.6, save_path=None, test_data=None, ):
@@ -568,15 +582,15 @@ class Model(object):
         user_ids = input_data['user_indices'].as_matrix()
 
         labels = input_data['click'].as_matrix()
-        onehots_1 = np.asarray(input_data['face_cols_01'].tolist())
+        onehots_1 = feature_store.frame_matrix(input_data, 'face_cols_01')
         # onehots_2 = input_data[[col for col in input_data if '_01' in col]].as_matrix()
         onehots = np.concatenate([onehots_1], axis=1)
         item_words_indices, item_words_values = self._item_words_indices_and_values(input_data)
-        visual_emb_feat = np.asarray(input_data['visual'].tolist())
-        words_lda = np.asarray(input_data['topics'].tolist())
+        visual_emb_feat = feature_store.frame_matrix(input_data, 'visual')
+        words_lda = feature_store.frame_matrix(input_data, 'topics')
         # num_features = input_data[[col for col in input_data if '_N' in col]].as_matrix()
-        num_features = np.asarray(input_data['context'].tolist())
-        face_cols_num = np.asarray(input_data['face_cols_num'].tolist())
+        num_features = feature_store.frame_matrix(input_data, 'context')
+        face_cols_num = feature_store.frame_matrix(input_data, 'face_cols_num')
         feed_dict_ = {
             self.user_indices: user_ids,
             self.visual_emb_feat: visual_emb_feat,
@@ -603,29 +617,7 @@ class Model(object):
         pass
 
     def scoreAUC(self, labels, probs):
-        i_sorted = sorted(range(len(probs)), key=lambda i: probs[i],
-                          reverse=True)
-        auc_temp = 0.0
-        TP = 0.0
-        TP_pre = 0.0
-        FP = 0.0
-        FP_pre = 0.0
-        P = 0
-        N = 0
-        last_prob = probs[i_sorted[0]] + 1.0
-        for i in range(len(probs)):
-            if last_prob != probs[i_sorted[i]]:
-                auc_temp += (TP + TP_pre) * (FP - FP_pre) / 2.0
-                TP_pre = TP
-                FP_pre = FP
-                last_prob = probs[i_sorted[i]]
-            if labels[i_sorted[i]] == 1:
-                TP = TP + 1
-            else:
-                FP = FP + 1
-        auc_temp += (TP + TP_pre) * (FP - FP_pre) / 2.0
-        auc = auc_temp / (TP * FP)
-        return auc
+        return metrics.auc(labels, probs)
 
     def evaluate(self, input_data):
         """
@@ -636,24 +628,24 @@ class Model(object):
         :param val_size:
         :return: mean loss
         """
-        labels_lst = []
-        preds_lst = []
+        # 分桶累加近似 AUC, 不保存每条预测
+        accumulator = metrics.AUCAccumulator()
         for it, data in enumerate(np.array_split(input_data, 40)):
             if it in self.val_datas:
                 labels, item_words_indices, item_words_values, user_ids, visual_emb_feat,words_lda, onehots, num_features, face_cols_num = \
                     self.val_datas[it]
             else:
                 user_ids = data['user_indices'].as_matrix()
-                visual_emb_feat = np.asarray(data['visual'].tolist())
-                words_lda = np.asarray(data['topics'].tolist())
+                visual_emb_feat = feature_store.frame_matrix(data, 'visual')
+                words_lda = feature_store.frame_matrix(data, 'topics')
                 labels = data['click'].as_matrix()
-                onehots_1 = np.asarray(data['face_cols_01'].tolist())
+                onehots_1 = feature_store.frame_matrix(data, 'face_cols_01')
                 # onehots_2 = data[[col for col in data if '_01' in col]].as_matrix()
                 onehots = np.concatenate([onehots_1], axis=1)
                 item_words_indices, item_words_values = self._item_words_indices_and_values(data)
                 # num_features = data[[col for col in data if '_N' in col]].as_matrix()
-                num_features = np.asarray(data['context'].tolist())
-                face_cols_num = np.asarray(data['face_cols_num'].tolist())
+                num_features = feature_store.frame_matrix(data, 'context')
+                face_cols_num = feature_store.frame_matrix(data, 'face_cols_num')
 
             feed_dict_ = {
                 self.user_indices: user_ids,
@@ -674,9 +666,8 @@ class Model(object):
                                   num_features,
                                   face_cols_num]
             pred = self.sess.run([self.y_ui_a], feed_dict=feed_dict_)
-            labels_lst.extend(labels)
-            preds_lst.extend(pred[0])
-        return -self.scoreAUC(labels_lst, preds_lst)
+            accumulator.update(labels, pred[0])
+        return -accumulator.auc()
 
     def pred_prob(self, input_data):
         preds_lst = []
@@ -687,13 +678,13 @@ class Model(object):
                         it]
             else:
                 user_ids = data['user_indices'].as_matrix()
-                visual_emb_feat = np.asarray(data['visual'].tolist())
-                onehots_1 = np.asarray(data['face_cols_01'].tolist())
-                words_lda = np.asarray(data['topics'].tolist())
+                visual_emb_feat = feature_store.frame_matrix(data, 'visual')
+                onehots_1 = feature_store.frame_matrix(data, 'face_cols_01')
+                words_lda = feature_store.frame_matrix(data, 'topics')
                 onehots = np.concatenate([onehots_1, ], axis=1)
-                num_features = np.asarray(data['context'].tolist())
+                num_features = feature_store.frame_matrix(data, 'context')
                 item_words_indices, item_words_values = self._item_words_indices_and_values(data)
-                face_cols_num = np.asarray(data['face_cols_num'].tolist())
+                face_cols_num = feature_store.frame_matrix(data, 'face_cols_num')
 
             feed_dict_ = {
                 self.user_indices: user_ids,
@@ -733,30 +724,36 @@ if __name__ == '__main__':
     # visual_embs = visual_embs.sort_values(['photo_indices'])
     # visual_embs = np.array(visual_embs['visual'].tolist())
 
-    val_data = pd.read_pickle('../data/val_data.pkl')
-    train_data = pd.read_pickle('../data/train_data.pkl')
-    test_data = pd.read_pickle('../data/test_data.pkl')
+    data_columns = ['uid', 'pid', 'user_indices', 'photo_indices', 'click', 'words', 'topics', 'context', 'face_cols_01', 'face_cols_num']
+    val_data = feature_store.read_frame('../data/val_data', data_columns)
+    train_data = feature_store.read_frame('../data/train_data', data_columns)
+    test_data = feature_store.read_frame('../data/test_data', data_columns)
 
     train_data, test_data, val_data = [pd.merge(df, visual_embs, 'left', 'pid') for df in
                                        [train_data, test_data, val_data]]
     one_hots_dims = []
-    face_cols = np.array(train_data['face_cols_01'].tolist())
+    face_cols = feature_store.frame_matrix(train_data, 'face_cols_01')
     one_hots_dims.extend((face_cols.max(axis=0) + 1))
     print('one_hot_dims:', one_hots_dims)
 
-    dim_num_feat = val_data.ix[0, 'context'].shape[0]
+    dim_num_feat = feature_store.frame_matrix(val_data, 'context').shape[1]
     print('dim_num_feat:', dim_num_feat)
 
+    words_csr = feature_store.FeatureStore('../data/photo_features')['words']
+
     model_params = {
         'num_user': 15141,
         'num_recent_item': 30,
         'num_words': 119637,
         'dim_num_feat': dim_num_feat,
         'one_hots_dims': one_hots_dims,
+        'words_csr': words_csr,
         'dim_k': 96,
         'att_dim_k': 16,
         'dim_hidden_out': (256, 128, 64, 32),
         'reg': 0.001,
+        # full 整表做 L2, batch / batch_freq 只对 batch 里取到的行做 L2, 梯度保持稀疏
+        'reg_mode': 'full',
         'att_reg': 0.1,
         'user_emb_feat': user_embs,
         'dim_lda': 6,
@@ -1,9 +1,11 @@
 import pandas as pd
 
+import feature_store
+
 from network_nopair import Model
 
 if __name__ == '__main__':
-    val_data = pd.read_pickle('../data/val_data.pkl')
+    val_data = feature_store.read_frame('../data/val_data')
     one_hots_dims = []
     for col in val_data:
         if '_01' in col:
@@ -37,7 +39,7 @@ if __name__ == '__main__':
     # print(pd.np.array(a)[0, 1:2, 507:509])
     #
     # print(a)
-    trian_data = pd.read_pickle('../data/train_data.pkl')
+    trian_data = feature_store.read_frame('../data/train_data')
     fit_params = {
         'input_data': trian_data,
         'batch_size': 2048,
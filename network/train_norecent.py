@@ -1,13 +1,15 @@
 import pandas as pd
 import numpy as np
+
+import feature_store
 from network_norecent import Model
 
 if __name__ == '__main__':
-    val_data = pd.read_pickle('../data/val_data.pkl')
-    train_data = pd.read_pickle('../data/train_data.pkl')
-    test_data = pd.read_pickle('../data/test_data.pkl')
+    val_data = feature_store.read_frame('../data/val_data')
+    train_data = feature_store.read_frame('../data/train_data')
+    test_data = feature_store.read_frame('../data/test_data')
     one_hots_dims = []
-    face_cols = np.array(train_data['face_cols'].tolist())
+    face_cols = feature_store.frame_matrix(train_data, 'face_cols')
     one_hots_dims.extend((face_cols.max(axis=0) + 1))
     # for col in val_data:
     #     if '_01' in col:
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from sklearn.model_selection import train_test_split
 from sklearn.utils import shuffle
@@ -44,6 +45,171 @@ def new_variable_initializer(sess):
     # sess.run(init_new_vars_op)
 
 
+def sparse_embedding_sum(sp_weights, params):
+    """
+    与 tf.sparse_tensor_dense_matmul(sp_weights, params) 结果相同, 但写成 gather + segment sum,
+    params 的梯度是 IndexedSlices, 优化器只更新 batch 里出现的行
+    :param sp_weights: SparseTensor [batch_size, num_rows], indices 为 (行, params 的行号)
+    """
+    rows, ids = sp_weights.indices[:, 0], sp_weights.indices[:, 1]
+    emb = tf.nn.embedding_lookup(params, ids) * tf.expand_dims(sp_weights.values, 1)
+    return tf.unsorted_segment_sum(emb, rows, sp_weights.dense_shape[0])
+
+
+REG_MODES = ('full', 'batch', 'batch_freq')
+
+
+def embedding_l2_loss(params, ids=None, reg_mode='full'):
+    """
+    embedding 表的 L2 正则
+    :param ids: batch 里取到的行号, 为 None 时按整表算
+    :param reg_mode: full 整表; batch 只算 batch 里出现过的行, 每行一次;
+        batch_freq 每次出现算一次, 即按行在 batch 里出现的次数加权.
+        后两种的梯度是 IndexedSlices, 每步的开销只和 batch 大小有关
+    """
+    if reg_mode not in REG_MODES:
+        raise ValueError('reg_mode must be one of {}, got {}'.format(REG_MODES, reg_mode))
+    if ids is None or reg_mode == 'full':
+        return tf.nn.l2_loss(params)
+    ids = tf.reshape(ids, [-1])
+    if reg_mode == 'batch':
+        ids, _ = tf.unique(ids)
+    return tf.nn.l2_loss(tf.gather(params, ids))
+
+
+def block_initializer(block_sizes, initializer=None):
+    """
+    沿第 0 维拼接的变量按块分别初始化, 每块的形状为 [block_sizes[i]] + shape[1:],
+    与每块单独建变量时的初始化分布相同 (glorot 的 fan 按块计算)
+    """
+    initializer = tf.glorot_uniform_initializer() if initializer is None else initializer
+
+    def _initializer(shape, dtype=tf.float32, partition_info=None):
+        return tf.concat([initializer([size] + list(shape[1:]), dtype) for size in block_sizes], axis=0)
+
+    return _initializer
+
+
+class FieldEmbedding(object):
+    """
+    多个 one-hot 字段共用一张拼接的表, 第 i 个字段的编号加上 offsets[i] 后在表里取行,
+    一次 gather 得到 [batch_size, num_fields, dim_k]
+    """
+
+    def __init__(self, field_dims, dim_k, name):
+        self.field_dims = [int(dim) for dim in field_dims]
+        self.offsets = np.cumsum([0] + self.field_dims[:-1]).astype(np.int32)
+        self.table = tf.get_variable(shape=[sum(self.field_dims), dim_k], initializer=block_initializer(self.field_dims),
+                                     dtype=tf.float32, name=name)
+
+    def ids(self, fields):
+        """
+        :param fields: [batch_size, num_fields] 各字段的编号
+        :return: int32 [batch_size, num_fields], 在拼接表里的行号
+        """
+        return tf.cast(fields, tf.int32) + self.offsets
+
+    def lookup(self, fields):
+        return tf.nn.embedding_lookup(self.table, self.ids(fields))
+
+
+def field_attention_weights(num_fields, dim_k, att_dim_k, name):
+    """
+    每个字段一个 [dim_k, att_dim_k] 的 attention 矩阵, 叠成 [num_fields, dim_k, att_dim_k]
+    """
+    return tf.get_variable(shape=[num_fields, dim_k, att_dim_k], initializer=block_initializer([1] * num_fields),
+                           dtype=tf.float32, name=name)
+
+
+def field_attention(field_emb, W_att, query, b_att, w_att, c_att):
+    """
+    所有字段的 attention 打分一次算完, 第 i 列等于 relu(query + field_emb[:, i] W_att[i] + b_att) w_att + c_att
+    :param field_emb: [batch_size, num_fields, dim_k]
+    :param W_att: [num_fields, dim_k, att_dim_k]
+    :param query: [batch_size, att_dim_k], 各字段共用的部分
+    :return: [batch_size, num_fields]
+    """
+    num_fields, _, att_dim_k = W_att.get_shape().as_list()
+    att = tf.transpose(tf.matmul(tf.transpose(field_emb, [1, 0, 2]), W_att), [1, 0, 2])  # [batch_size, num_fields, att_dim_k]
+    att = tf.nn.relu(tf.expand_dims(query, 1) + att + b_att)
+    return tf.reshape(tf.matmul(tf.reshape(att, [-1, att_dim_k]), w_att), [-1, num_fields]) + c_att
+
+
+class SideTable(object):
+    """
+    不训练的查找表 (预训练的用户向量, 用户喜好均值等). 值通过 [None, dim] 的 placeholder feed 给变量的 initializer,
+    不作为常量写进 GraphDef, .meta 的大小与表的行数无关; 变量不加入 GLOBAL_VARIABLES, 不进检查点,
+    重新 compile 时的全局初始化也不会覆盖它. 构造时给的表第一次 load 进 session 后就释放, 之后只存在 session 里;
+    换一张新表 (行数可以不同, 列数须相同) 也只需要 load, 不用重建图
+    """
+
+    def __init__(self, values, name):
+        values = np.asarray(values, np.float32)
+        if values.ndim != 2:
+            raise ValueError('{} must be a 2-D table, got shape {}'.format(name, values.shape))
+        self.name = name
+        self.dim = values.shape[1]
+        self.pending = values
+        self.sess = None
+        self.placeholder = tf.placeholder(tf.float32, shape=[None, self.dim], name=name + '_value')
+        self.variable = tf.Variable(self.placeholder, trainable=False, collections=[], validate_shape=False,
+                                    name=name)
+
+    def load(self, sess, values=None):
+        """
+        :param values: 新的表, 为 None 时用构造时给的表; 构造时的表已经载入过 sess 时什么都不做
+        """
+        if values is None:
+            if self.pending is None:
+                if sess is self.sess:
+                    return
+                raise ValueError('{} was released after loading, pass values to load it into another session'
+                                 .format(self.name))
+            values = self.pending
+        else:
+            values = np.asarray(values, np.float32)
+            if values.ndim != 2 or values.shape[1] != self.dim:
+                raise ValueError('expected shape [None, {}], got {}'.format(self.dim, values.shape))
+        sess.run(self.variable.initializer, feed_dict={self.placeholder: values})
+        self.pending = None
+        self.sess = sess
+
+    def lookup(self, ids):
+        ids = tf.cast(ids, tf.int32)
+        emb = tf.nn.embedding_lookup(self.variable, ids)
+        # validate_shape=False 的变量没有静态形状, 补上列数
+        emb.set_shape(ids.get_shape().concatenate([self.dim]))
+        return emb
+
+
+class VariableSnapshot(object):
+    """
+    一组变量的快照, 值存在图里的影子变量中 (不加入 GLOBAL_VARIABLES, 不会被 Saver 保存或全局初始化),
+    capture / restore 各是一个 group 起来的 assign op, 不读写磁盘, 也不会让图继续变大
+    """
+
+    def __init__(self, sess, variables=None):
+        """
+        :param variables: 默认所有 global variables, 包括优化器的 slot 和 global_step
+        """
+        self.sess = sess
+        with sess.graph.as_default():
+            self.variables = list(tf.global_variables() if variables is None else variables)
+            with tf.name_scope('snapshot'):
+                self.shadows = [tf.Variable(tf.zeros(var.get_shape(), var.dtype.base_dtype), trainable=False,
+                                            collections=[], name=var.op.name.replace('/', '_'))
+                                for var in self.variables]
+                self.capture_op = tf.group(*[shadow.assign(var) for shadow, var in zip(self.shadows, self.variables)])
+                self.restore_op = tf.group(*[var.assign(shadow) for shadow, var in zip(self.shadows, self.variables)])
+        sess.run([shadow.initializer for shadow in self.shadows])
+
+    def capture(self):
+        self.sess.run(self.capture_op)
+
+    def restore(self):
+        self.sess.run(self.restore_op)
+
+
 def get_sample_num(x):
     if isinstance(x, list):
         return x[0].shape[0]
@@ -4,6 +4,8 @@ import pandas as pd
 import numpy as np
 import os
 
+import feature_store
+
 if __name__ == '__main__':
     files = ['next_time_diff.pkl', 'pre_time_diff.pkl', 'user_batch_cnt_pre8min.pkl', 'user_cnt_pre8min.pkl',
              'user_photo_total_cnt.pkl', 'batch_photo_cnt.pkl', 'photo_batch_cnt_pre1day.pkl']
@@ -28,4 +30,4 @@ if __name__ == '__main__':
     ctx_cols_01.index = df_ctx.index
     df_ctx = pd.concat([df_ctx, ctx_cols_01], axis=1)
     print(df_ctx)
-    df_ctx.to_pickle('../data/context_feature.pkl')
+    feature_store.write_frame(df_ctx, '../data/context_feature')
@@ -1,23 +1,32 @@
 import sys
-import os
-import pandas as pd
+
 import numpy as np
+import pandas as pd
 
-if __name__ == '__main__':
-    # tr_visual = pd.read_pickle('./visual_feature_train.pkl')
-    # te_visual = pd.read_pickle('./visual_feature_test.pkl')
-    path = sys.argv[1]
-    outpath = sys.argv[2]
-    dfs = []
-    for f in os.listdir(path):
-        file_path = os.path.join(path, f)
-        dfs.append(pd.read_pickle(file_path))
-        print('loaded file:', file_path)
+import feature_store
+from proc_visual_feature import load_visual
 
-    visual = pd.concat(dfs, ignore_index=True)
-    visual.columns = ['pid', 'visual']
-    v1, v2 = np.array_split(visual, 2)
-    print('concated.')
-    print(visual.describe())
-    v1.to_pickle(outpath+'_1.pkl')
-    v2.to_pickle(outpath+'_2.pkl')
+if __name__ == '__main__':
+    # 把 proc_visual_feature 抽取的各个目录按 photo 表的 pid 顺序合成一个矩阵, 模型按 photo_indices 直接取行
+    # python concat_visual_feature.py ../data/photo_features ../data/visual/photo_visual.npy ../data/visual/train ../data/visual/test
+    photo_path, outpath = sys.argv[1], sys.argv[2]
+    photo_pids = np.asarray(feature_store.FeatureStore(photo_path)['pid'])
+    out = None
+    found = np.zeros(photo_pids.shape[0], bool)
+    for path in sys.argv[3:]:
+        pids, visual = load_visual(path)
+        if out is None:
+            out = np.lib.format.open_memmap(outpath, mode='w+', dtype=np.float32,
+                                            shape=(photo_pids.shape[0], visual.shape[1]))
+        positions = pd.Index(pids).get_indexer(photo_pids)
+        rows = np.flatnonzero((positions >= 0) & ~found)
+        # 按抽取结果的行顺序读, 顺序访问 memmap
+        order = np.argsort(positions[rows], kind='mergesort')
+        rows = rows[order]
+        for lo in range(0, rows.shape[0], 2 ** 16):
+            chunk = rows[lo:lo + 2 ** 16]
+            out[chunk] = visual[positions[chunk]]
+        found[rows] = True
+        print('loaded dir:', path, rows.shape[0], 'photos')
+    out.flush()
+    print('concated.', np.sum(~found), 'photos without visual feature')
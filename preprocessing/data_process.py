@@ -16,6 +16,10 @@ import sklearn.preprocessing as preprocessing
 from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
 from sklearn.decomposition import LatentDirichletAllocation
 
+import face_features
+import feature_store
+import ingest_interaction
+import segment_stats
 import time_utils as time_utils
 
 
@@ -28,39 +32,21 @@ def trans_face_vec():
     df_test_face = pd.read_csv('../../data/test/test_face.txt', header=None, names=['photo_id', 'face_vec'], sep='\t')
     df_face = pd.concat([df_train_face, df_test_face], axis=0, ignore_index=True)
 
-    df_face['face_vec'] = df_face['face_vec'].apply(lambda vec: np.array(json.loads(vec)))
-    df_face['face_num'] = df_face['face_vec'].apply(len)
-    df_face['female_num'] = df_face['face_vec'].apply(lambda vec: sum(vec[:, 1]))
-    df_face['male_num'] = df_face['face_num'] - df_face['female_num']
-
-    df_face['max_age'] = df_face['face_vec'].apply(lambda vec: max(vec[:, 2]))
-    df_face['min_age'] = df_face['face_vec'].apply(lambda vec: min(vec[:, 2]))
-
-    # df_face['face_proportion'] = df_face['face_vec'].apply(lambda vec: sum(vec[:, 0]))
-    df_face['male_face_proportion'] = df_face['face_vec'].apply(
-        lambda vec: int(100*sum([v[0] for v in vec if v[1] == 1])))
-    df_face['female_face_proportion'] = df_face['face_vec'].apply(
-        lambda vec: int(100*sum([v[0] for v in vec if v[1] == 0])))
-
-    # df_face['max_face_score'] = df_face['face_vec'].apply(lambda vec: max(vec[:, 3]))
-    df_face['min_face_score'] = df_face['face_vec'].apply(lambda vec: min(vec[:, 3]))
-    df_face['mean_face_score'] = df_face['face_vec'].apply(lambda vec: sum(vec[:, 3])/len(vec))
-    df_face['male_max_face_score'] = df_face['face_vec'].apply(lambda vec: max([v[3] for v in vec if v[1] == 1] + [0]))
-    df_face['female_max_face_score'] = df_face['face_vec'].apply(lambda vec: max([v[3] for v in vec if v[1] == 0] + [0]))
-
-
-    del df_face['face_vec']
-    del df_face['face_num']
+    offsets, faces = face_features.parse_faces(df_face['face_vec'].tolist())
+    df_face = pd.concat([df_face[['photo_id']], face_features.face_summary(offsets, faces)], axis=1)
 
     print(df_face)
     return df_face
 
 def trans_interaction():
-    df_train_interaction = pd.read_csv('../../data/train/train_interaction.txt',
-                                       names=['user_id', 'photo_id', 'click', 'like', 'follow', 'time',
-                                              'playing_time', 'duration_time'], header=None, sep='\t')
-    df_test_interaction = pd.read_csv('../../data/test/test_interaction.txt',
-                                      names=['user_id', 'photo_id', 'time', 'duration_time'], header=None, sep='\t')
+    # 交互数据流式导入特征存储 (已导入的文件跳过), 再以紧凑类型读出
+    columns = {'uid': 'user_id', 'pid': 'photo_id'}
+    ingest_interaction.ingest('../../data/train/train_interaction.txt', '../../data/train_interaction',
+                              ingest_interaction.TRAIN_SCHEMA)
+    ingest_interaction.ingest('../../data/test/test_interaction.txt', '../../data/test_interaction',
+                              ingest_interaction.TEST_SCHEMA)
+    df_train_interaction = feature_store.load_frame('../../data/train_interaction').rename(columns=columns)
+    df_test_interaction = feature_store.load_frame('../../data/test_interaction').rename(columns=columns)
     df_data = pd.concat([df_train_interaction, df_test_interaction], axis=0, ignore_index=True)
     df_data['instance_id'] = np.arange(df_data.shape[0])
 
@@ -160,23 +146,23 @@ def trans_interaction():
     return df_data
 
 def cnt_user_like_feats(df_data):
-    print('cnt_user_like_face_feats')
-    df_train_click = df_data[df_data['click']==1].fillna(0)
-    df_train_true_like = df_data[(df_data['click'] == 1) & (df_data['play_proportion'] > 0.1)].fillna(0)
+    """
+    用户喜欢 (点击且播放比例 > 0.1) 的 photo 的人脸特征均值, 以及点击过的 photo 的时间特征均值,
+    缺失值按 0 计, 没有这类记录的用户为 nan
+    """
+    print('cnt_user_like_feats')
     use_face_feats = ['female_num', 'male_num', 'max_age', 'min_age', 'male_face_proportion', 'female_face_proportion',
                       'male_max_face_score', 'female_max_face_score', 'min_face_score', 'mean_face_score']
-    for feat in use_face_feats:
-        user_like_ave_face_feat = df_train_true_like.groupby(['user_id'], as_index=False)[feat].agg({'user_like_ave_{}'.format(feat): 'mean'})
-        df_data = pd.merge(df_data, user_like_ave_face_feat, on=['user_id'], how='left')
-        print(user_like_ave_face_feat)
-
-    print('cnt_user_like_redc_feats')
     use_redc_feats = ['user_remain_cnt', 'time_redc', 'user_pre5min_cnt', 'batch_photo_cnt']
-    for feat in use_redc_feats:
-        user_like_ave_face_feat = df_train_click.groupby(['user_id'], as_index=False)[feat].agg({'user_like_ave_{}'.format(feat): 'mean'})
-        df_data = pd.merge(df_data, user_like_ave_face_feat, on=['user_id'], how='left')
-
-
+    user_codes, _ = pd.factorize(df_data['user_id'])
+    click = df_data['click'].values == 1
+    true_like = click & (df_data['play_proportion'].values > 0.1)
+    for feats, mask in [(use_face_feats, true_like), (use_redc_feats, click)]:
+        features = segment_stats.feature_matrix(df_data, feats, np.float64)
+        features[np.isnan(features)] = 0
+        mean = segment_stats.user_table(features, user_codes, mask=mask)['mean']
+        for k, feat in enumerate(feats):
+            df_data['user_like_ave_{}'.format(feat)] = mean[user_codes, k]
     return df_data
 
 
@@ -0,0 +1,180 @@
+# coding=utf-8
+"""
+人脸特征: 所有 photo 的人脸 json 拼成一个数组一次解析, 展平成一张人脸表 (每行一张脸) 加上
+photo 偏移数组, 各项统计都用按 photo 分段的归约整列计算, 不再逐个 photo 做列表推导.
+
+人脸表的列: percent (人脸占画面比例), gender (0 / 1), age, appear (颜值)
+"""
+from __future__ import print_function, division
+import json
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+PERCENT, GENDER, AGE, APPEAR = range(4)
+
+# handle_face 输出的 31 列, 顺序与 face_cols_num / face_cols_01 一致
+FACE_COLUMNS = ['face_num_01', 'face_max_percent_01', 'face_whole_percent_01',
+                'face_male_num_01', 'face_famale_num_01', 'face_gender_mix_01',
+                'face_ave_age_01', 'face_max_age', 'face_min_age',
+                'face_max_appear_01', 'face_min_appear_01', 'face_ave_appear_01',
+                'famale_ave_appear', 'famale_max_appear', 'famale_min_appear',
+                'male_ave_appear', 'male_max_appear', 'male_min_appear',
+                'famale_max_percent', 'male_max_percent', 'famle_whole_percent', 'male_whole_percent',
+                'max_percent_appear', 'max_famale_percent_appear', 'max_male_percent_appear',
+                'famale_max_age', 'famale_min_age', 'famale_ave_age',
+                'male_max_age', 'male_min_age', 'male_ave_age',
+                ]
+# 没有对应性别时为 nan 的列, 分箱前用列均值填充
+NAN_COLUMNS = list(range(25, 31))
+
+
+def parse_faces(face_json):
+    """
+    :param face_json: 每个 photo 一个 json 字符串, 形如 [[percent, gender, age, appear], ...]
+    :return: (offsets, faces), 第 i 个 photo 的人脸是 faces[offsets[i]:offsets[i + 1]], faces 为 float64 [num_faces, 4]
+    """
+    parsed = json.loads('[' + ','.join(face_json) + ']')
+    lengths = np.fromiter((len(photo) for photo in parsed), dtype=np.int64, count=len(parsed))
+    offsets = np.zeros([lengths.shape[0] + 1], np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    faces = np.array(list(chain.from_iterable(parsed)), dtype=np.float64).reshape(-1, 4)
+    return offsets, faces
+
+
+def _segment_ids(offsets):
+    return np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+
+
+def _count(seg, num):
+    return np.bincount(seg, minlength=num).astype(np.float64)
+
+
+def _sum(values, seg, num):
+    return np.bincount(seg, weights=values, minlength=num)
+
+
+def _reduce(ufunc, values, seg, num, fill):
+    """
+    seg 有序, 空的分段填 fill
+    """
+    out = np.full(num, fill, np.float64)
+    if values.shape[0]:
+        starts = np.flatnonzero(np.r_[True, seg[1:] != seg[:-1]])
+        out[seg[starts]] = ufunc.reduceat(values, starts)
+    return out
+
+
+def _mean(values, seg, num, fill):
+    count = _count(seg, num)
+    return np.where(count > 0, _sum(values, seg, num) / np.maximum(count, 1), fill)
+
+
+def _value_at_first(values, keys, seg, num, fill, largest):
+    """
+    每段里 keys 最大 (largest) 或最小的第一张脸对应的 values, 与 np.argmax / np.argmin 一致
+    """
+    out = np.full(num, fill, np.float64)
+    if values.shape[0]:
+        order = np.lexsort((np.arange(seg.shape[0]), -keys if largest else keys, seg))
+        first = order[np.r_[True, seg[order][1:] != seg[order][:-1]]]
+        out[seg[first]] = values[first]
+    return out
+
+
+def face_statistics(offsets, faces):
+    """
+    每个 photo 的 31 项人脸统计, 列含义见 FACE_COLUMNS
+    :return: float64 [num_photos, 31]
+    """
+    num = offsets.shape[0] - 1
+    seg = _segment_ids(offsets)
+    percent, age, appear = faces[:, PERCENT], faces[:, AGE], faces[:, APPEAR]
+    stats = {}
+    for name, mask in [('all', np.ones(seg.shape[0], bool)), ('male', faces[:, GENDER] == 0),
+                       ('famale', faces[:, GENDER] == 1)]:
+        s = seg[mask]
+        stats[name] = {
+            'num': _count(s, num),
+            'percent_max': _reduce(np.maximum, percent[mask], s, num, 0),
+            'percent_sum': _sum(percent[mask], s, num),
+            'age_max': _reduce(np.maximum, age[mask], s, num, np.nan),
+            'age_min': _reduce(np.minimum, age[mask], s, num, np.nan),
+            'age_mean': _mean(age[mask], s, num, np.nan),
+            'appear_max': _reduce(np.maximum, appear[mask], s, num, 0),
+            'appear_min': _reduce(np.minimum, appear[mask], s, num, 0),
+            'appear_mean': _mean(appear[mask], s, num, 0),
+            'appear_at_max_percent': _value_at_first(appear[mask], percent[mask], s, num, 0, True),
+            'appear_at_min_percent': _value_at_first(appear[mask], percent[mask], s, num, 0, False),
+        }
+    a, m, f = stats['all'], stats['male'], stats['famale']
+    columns = [a['num'], a['percent_max'], a['percent_sum'],
+               m['num'], f['num'], ((m['num'] > 0) & (f['num'] > 0)).astype(np.float64),
+               a['age_mean'], a['age_max'], a['age_min'],
+               a['appear_max'], a['appear_min'], a['appear_mean'],
+               f['appear_max'], f['appear_min'], f['appear_mean'],
+               m['appear_max'], m['appear_min'], m['appear_mean'],
+               f['percent_max'], m['percent_max'], f['percent_sum'], m['percent_sum'],
+               a['appear_at_max_percent'], f['appear_at_max_percent'], m['appear_at_min_percent'],
+               f['age_max'], f['age_min'], f['age_mean'],
+               m['age_max'], m['age_min'], m['age_mean'],
+               ]
+    return np.stack(columns, axis=1)
+
+
+def cut_codes(data, bins=10):
+    """
+    与 pd.cut(data, bins, labels=np.arange(bins)) 相同的等宽分箱, 返回箱号, nan 返回 -1
+    """
+    valid = ~np.isnan(data)
+    if not valid.any():
+        return np.full(data.shape[0], -1, np.int64)
+    mn, mx = data[valid].min(), data[valid].max()
+    if mn == mx:
+        adj = 0.001 * abs(mn) if mn != 0 else 0.001
+        edges = np.linspace(mn - adj, mx + adj, bins + 1)
+    else:
+        edges = np.linspace(mn, mx, bins + 1)
+        edges[0] -= (mx - mn) * 0.001
+    # 右闭区间 (edges[i], edges[i + 1]]
+    codes = np.searchsorted(edges, data, side='left') - 1
+    return np.where(valid, np.clip(codes, 0, bins - 1), -1)
+
+
+def bin_statistics(stats, bins=10, nan_columns=NAN_COLUMNS):
+    """
+    nan_columns 里的 nan 用列均值填充 (原地修改 stats), 然后逐列等宽分箱
+    :return: int8 [num_photos, num_columns]
+    """
+    for col in nan_columns:
+        data = stats[:, col]
+        data[np.isnan(data)] = np.nanmean(data)
+    return np.stack([cut_codes(stats[:, col], bins) for col in range(stats.shape[1])], axis=1).astype(np.int8)
+
+
+def face_summary(offsets, faces):
+    """
+    data_process.trans_face_vec 使用的人脸统计列
+    :return: DataFrame, 与 offsets 的 photo 顺序对齐
+    """
+    num = offsets.shape[0] - 1
+    seg = _segment_ids(offsets)
+    gender, age, percent, appear = faces[:, GENDER], faces[:, AGE], faces[:, PERCENT], faces[:, APPEAR]
+    face_num = _count(seg, num)
+    female_num = _sum(gender, seg, num)
+    # 注意 trans_face_vec 里 male/female 的 proportion 和 max_face_score 按 gender == 1 / 0 取, 与 num 的含义相反
+    g1, g0 = gender == 1, gender == 0
+    return pd.DataFrame({
+        'female_num': female_num,
+        'male_num': face_num - female_num,
+        'max_age': _reduce(np.maximum, age, seg, num, np.nan),
+        'min_age': _reduce(np.minimum, age, seg, num, np.nan),
+        'male_face_proportion': np.trunc(100 * _sum(percent[g1], seg[g1], num)).astype(np.int64),
+        'female_face_proportion': np.trunc(100 * _sum(percent[g0], seg[g0], num)).astype(np.int64),
+        'min_face_score': _reduce(np.minimum, appear, seg, num, np.nan),
+        'mean_face_score': _mean(appear, seg, num, np.nan),
+        'male_max_face_score': np.maximum(_reduce(np.maximum, appear[g1], seg[g1], num, 0), 0),
+        'female_max_face_score': np.maximum(_reduce(np.maximum, appear[g0], seg[g0], num, 0), 0),
+    }, columns=['female_num', 'male_num', 'max_age', 'min_age', 'male_face_proportion', 'female_face_proportion',
+                'min_face_score', 'mean_face_score', 'male_max_face_score', 'female_max_face_score'])
@@ -0,0 +1,385 @@
+# coding=utf-8
+"""
+列式特征存储: 每张表一个目录, 列按需通过 np.memmap 打开, 不再整表 pickle.
+
+目录布局:
+    meta.json                 num_rows, 以及每列的 kind / dtype / shape
+    <col>.bin                 flat 列, [num_rows] + shape, C order
+    <col>.offsets.bin         ragged 列的行偏移, int64 [num_rows + 1]
+    <col>.values.bin          ragged 列所有行的值拼接在一起
+
+flat 列用于标量列和定长数组列 (face_cols_01, topics, visual, ...),
+ragged 列用于变长数组列 (words, ...). 读取端只打开需要的列, 数据由
+page cache 在多个进程之间共享, 不会每个进程各自持有一份. 训练和预测用 read_frame,
+定长数组列展开成标量列, 不会产生逐行的 Python 对象.
+"""
+from __future__ import print_function, division
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+META_FILE = 'meta.json'
+FLAT = 'flat'
+RAGGED = 'ragged'
+
+
+def _flat_path(path, name):
+    return os.path.join(path, '{}.bin'.format(name))
+
+
+def _offsets_path(path, name):
+    return os.path.join(path, '{}.offsets.bin'.format(name))
+
+
+def _values_path(path, name):
+    return os.path.join(path, '{}.values.bin'.format(name))
+
+
+def _is_missing(cell):
+    return cell is None or (isinstance(cell, float) and np.isnan(cell))
+
+
+def _infer_column(ser, ragged=False):
+    """
+    推断一列的存储方式
+    :param ragged: 强制按变长列存储
+    :return: (kind, dtype, shape)
+    """
+    if ser.dtype != object:
+        return FLAT, np.asarray(ser).dtype, ()
+    lengths = set()
+    dtype = None
+    for cell in ser:
+        if _is_missing(cell):
+            # 缺失和空数组含义不同, 不替调用方决定填充值
+            raise ValueError('column {} has missing cells, fill them before writing'.format(ser.name))
+        arr = np.asarray(cell)
+        if arr.dtype == object or arr.dtype.kind in 'USV':
+            raise ValueError('column {} holds unsupported cells of type {}'.format(ser.name, type(cell)))
+        lengths.add(arr.shape[0] if arr.ndim else -2)
+        dtype = arr.dtype if dtype is None else np.promote_types(dtype, arr.dtype)
+    if dtype is None:
+        raise ValueError('column {} has no non-missing cells'.format(ser.name))
+    if -2 in lengths:
+        raise ValueError('column {} mixes scalar and array cells'.format(ser.name))
+    if not ragged and len(lengths) == 1:
+        return FLAT, dtype, (lengths.pop(),)
+    return RAGGED, dtype, ()
+
+
+def _column_values(ser, kind, dtype, shape):
+    if kind == FLAT and not shape:
+        return np.ascontiguousarray(np.asarray(ser), dtype=dtype), None
+    if kind == RAGGED or ser.dtype == object:
+        missing = [i for i, cell in enumerate(ser) if _is_missing(cell)]
+        if missing:
+            raise ValueError('column {} has {} missing cells (first at row {!r}), fill them before writing'
+                             .format(ser.name, len(missing), ser.index[missing[0]]))
+    if kind == FLAT:
+        cells = [np.asarray(cell) for cell in ser]
+        bad = [i for i, cell in enumerate(cells) if cell.shape != shape]
+        if bad:
+            raise ValueError('column {} was stored with fixed shape {} from the first chunk, but row {!r} has shape {}; '
+                             'pass it in ragged if its length varies'.format(ser.name, shape, ser.index[bad[0]],
+                                                                             cells[bad[0]].shape))
+        return np.asarray(cells, dtype=dtype).reshape((-1,) + shape), None
+    cells = [np.asarray(cell, dtype=dtype) for cell in ser]
+    lengths = np.array([cell.shape[0] for cell in cells], dtype=np.int64)
+    values = np.concatenate(cells) if cells else np.array([], dtype=dtype)
+    return values, lengths
+
+
+class StoreWriter(object):
+    """
+    按块写入一张表, 每块是一个 DataFrame, 列集合和列类型由第一块决定.
+    第一块里恰好等长的变长列需要通过 ragged 显式指定, 否则之后的块遇到不同长度的行时报错;
+    数组列不能有缺失值 (NaN / None), 写入前由调用方填充.
+    append=True 时接着已有的表往后写, 列集合和列类型沿用已有的 meta
+    """
+
+    def __init__(self, path, columns=None, ragged=(), append=False):
+        self.path = path
+        self.columns = columns
+        self.ragged = set(ragged)
+        self.meta = None
+        self.num_rows = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        elif append and os.path.exists(os.path.join(path, META_FILE)):
+            self._reopen()
+
+    def _reopen(self):
+        with open(os.path.join(self.path, META_FILE)) as fin:
+            self.meta = json.load(fin)
+        self.columns = self.meta['order']
+        self.num_rows = self.meta['num_rows']
+        self._ragged_ends = {}
+        for col in self.columns:
+            info = self.meta['columns'][col]
+            if info['kind'] == FLAT:
+                self._truncate(_flat_path(self.path, col), self.num_rows * np.dtype(info['dtype']).itemsize *
+                               int(np.prod(info['shape'])))
+            else:
+                offsets_path = _offsets_path(self.path, col)
+                self._truncate(offsets_path, (self.num_rows + 1) * 8)
+                end = int(np.fromfile(offsets_path, np.int64)[-1])
+                self._truncate(_values_path(self.path, col), end * np.dtype(info['dtype']).itemsize)
+                self._ragged_ends[col] = end
+
+    @staticmethod
+    def _truncate(file_path, size):
+        # 上次写到一半失败时, 数据文件可能比 meta 记录的长, 截回 meta 记录的位置
+        with open(file_path, 'ab') as fout:
+            fout.truncate(size)
+
+    def _open(self, df):
+        columns = self.columns if self.columns is not None else list(df.columns)
+        meta_cols = {}
+        for col in columns:
+            kind, dtype, shape = _infer_column(df[col], col in self.ragged)
+            meta_cols[col] = {'kind': kind, 'dtype': np.dtype(dtype).str, 'shape': list(shape)}
+            if kind == FLAT:
+                open(_flat_path(self.path, col), 'wb').close()
+            else:
+                with open(_offsets_path(self.path, col), 'wb') as fout:
+                    np.zeros([1], np.int64).tofile(fout)
+                open(_values_path(self.path, col), 'wb').close()
+        self.columns = columns
+        self.meta = {'num_rows': 0, 'columns': meta_cols, 'order': columns}
+        self._ragged_ends = dict((col, 0) for col in columns if meta_cols[col]['kind'] == RAGGED)
+
+    def append(self, df):
+        if self.meta is None:
+            self._open(df)
+        for col in self.columns:
+            info = self.meta['columns'][col]
+            values, lengths = _column_values(df[col], info['kind'], np.dtype(info['dtype']), tuple(info['shape']))
+            if info['kind'] == FLAT:
+                with open(_flat_path(self.path, col), 'ab') as fout:
+                    values.tofile(fout)
+            else:
+                offsets = self._ragged_ends[col] + np.cumsum(lengths)
+                with open(_offsets_path(self.path, col), 'ab') as fout:
+                    offsets.tofile(fout)
+                with open(_values_path(self.path, col), 'ab') as fout:
+                    values.tofile(fout)
+                if offsets.shape[0]:
+                    self._ragged_ends[col] = int(offsets[-1])
+        self.num_rows += df.shape[0]
+        self.meta['num_rows'] = self.num_rows
+
+    def close(self):
+        if self.meta is None:
+            raise ValueError('nothing was written to {}'.format(self.path))
+        # meta 最后写, 中途失败的目录打不开, 不会读到半张表
+        with open(os.path.join(self.path, META_FILE), 'w') as fout:
+            json.dump(self.meta, fout, indent=1, sort_keys=True)
+
+
+def write_frame(df, path, columns=None, ragged=(), chunk_rows=2 ** 20):
+    """
+    把 DataFrame 写成特征存储目录, 数组列分块转换, 不会一次性展开整列
+    :param df: DataFrame
+    :param path: 存储目录
+    :param columns: 要写的列, 默认全部
+    :param ragged: 强制按变长存储的列
+    :param chunk_rows: 每块行数
+    """
+    writer = StoreWriter(path, columns, ragged)
+    for start in range(0, max(df.shape[0], 1), chunk_rows):
+        writer.append(df.iloc[start:start + chunk_rows])
+    writer.close()
+    print('wrote {} rows to {}'.format(writer.num_rows, path))
+
+
+class RaggedColumn(object):
+    """
+    变长数组列: 第 i 行是 values[offsets[i]:offsets[i + 1]]
+    """
+
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    @classmethod
+    def from_list(cls, cells, dtype=np.int64):
+        """
+        由逐行数组构造, 只做一次 concatenate
+        """
+        lengths = np.fromiter((len(cell) for cell in cells), dtype=np.int64, count=len(cells))
+        offsets = np.zeros([lengths.shape[0] + 1], np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.concatenate(cells).astype(dtype) if offsets[-1] else np.array([], dtype)
+        return cls(offsets, values)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def take(self, rows):
+        """
+        取出若干行, 返回一个新的 (内存中的) RaggedColumn
+        """
+        rows = np.asarray(rows)
+        starts = self.offsets[:-1][rows]
+        lengths = self.offsets[1:][rows] - starts
+        offsets = np.zeros([rows.shape[0] + 1], np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # 每个输出位置对应的源位置 = 所在行的起点 + 行内偏移
+        positions = np.arange(offsets[-1], dtype=np.int64) + np.repeat(starts - offsets[:-1], lengths)
+        return RaggedColumn(offsets, np.asarray(self.values[positions]))
+
+    def coo_indices(self):
+        """
+        把整列看作稀疏矩阵 [num_rows, max_value + 1], 返回非零元的 int64 下标 [nnz, 2]
+        """
+        row_ids = np.repeat(np.arange(len(self), dtype=np.int64), self.lengths())
+        return np.stack([row_ids, np.asarray(self.values, dtype=np.int64)], axis=1)
+
+    def tolist(self):
+        return [self.values[self.offsets[i]:self.offsets[i + 1]] for i in range(len(self))]
+
+
+class FeatureStore(object):
+    """
+    只读打开一张表, 列在第一次访问时才 memmap
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as fin:
+            self.meta = json.load(fin)
+        self.num_rows = self.meta['num_rows']
+        self.columns = self.meta['order']
+        self._cache = {}
+
+    def __contains__(self, name):
+        return name in self.meta['columns']
+
+    def __len__(self):
+        return self.num_rows
+
+    def _memmap(self, file_path, dtype, shape):
+        if shape[0] == 0 or os.path.getsize(file_path) == 0:
+            return np.zeros(shape, dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r', shape=shape)
+
+    def __getitem__(self, name):
+        if name in self._cache:
+            return self._cache[name]
+        if name not in self:
+            raise KeyError('{} not in feature store {}'.format(name, self.path))
+        info = self.meta['columns'][name]
+        dtype = np.dtype(info['dtype'])
+        if info['kind'] == FLAT:
+            column = self._memmap(_flat_path(self.path, name), dtype, (self.num_rows,) + tuple(info['shape']))
+        else:
+            offsets = self._memmap(_offsets_path(self.path, name), np.int64, (self.num_rows + 1,))
+            column = RaggedColumn(offsets, self._memmap(_values_path(self.path, name), dtype, (int(offsets[-1]),)))
+        self._cache[name] = column
+        return column
+
+    def is_ragged(self, name):
+        return self.meta['columns'][name]['kind'] == RAGGED
+
+    def take(self, name, rows):
+        column = self[name]
+        if isinstance(column, RaggedColumn):
+            return column.take(rows)
+        return np.asarray(column[rows])
+
+
+def align_table(keys, df, key_col, value_col, fill=0):
+    """
+    把 df 里以 key_col 为键的定长数组列排成稠密表, 第 i 行对应 keys[i]
+    :param keys: 目标行顺序, 如 photo 表的 pid 列
+    :param fill: df 里没有的键填充的值
+    :return: np.ndarray [len(keys)] + 数组形状
+    """
+    df = df.drop_duplicates(key_col)
+    positions = pd.Index(df[key_col].values).get_indexer(np.asarray(keys))
+    values = np.asarray(df[value_col].tolist())
+    table = np.full((positions.shape[0],) + values.shape[1:], fill, values.dtype)
+    found = positions >= 0
+    table[found] = values[positions[found]]
+    return table
+
+
+def matrix_column_names(name, width):
+    return ['{}[{}]'.format(name, i) for i in range(width)]
+
+
+def frame_matrix(df, name):
+    """
+    取回 DataFrame 里的定长数组列, [num_rows, k]: read_frame 展开的 name[0] .. name[k - 1] 标量列,
+    或 load_frame 读出的逐行数组列
+    """
+    if name in df:
+        return np.asarray(df[name].tolist())
+    prefix = '{}['.format(name)
+    cols = [col for col in df.columns if str(col).startswith(prefix)]
+    if not cols:
+        raise KeyError('{} not in frame'.format(name))
+    return df[cols].values
+
+
+def read_frame(path, columns=None, rows=None):
+    """
+    训练 / 预测用的读取: 标量列直接取 memmap 上的数组; 定长数组列 col 展开成 col[0] .. col[k - 1] 个标量列,
+    整列是一块数值, 没有逐行的 Python 对象, 用 frame_matrix(df, col) 取回 [num_rows, k].
+    变长列放不进这样的 DataFrame, 用 FeatureStore(path)[col] 按行 take (如按 photo_indices 取 words)
+    :param columns: 需要的列, 默认全部非变长列
+    :param rows: 行号或布尔掩码, 默认全部行
+    """
+    store = FeatureStore(path)
+    columns = [col for col in store.columns if not store.is_ragged(col)] if columns is None else columns
+    index = None if rows is None else np.arange(store.num_rows)[rows]
+    blocks = []
+    for col in columns:
+        if col not in store:
+            raise KeyError('{} not in feature store {}'.format(col, path))
+        if store.is_ragged(col):
+            raise ValueError('{} is a ragged column, read it with FeatureStore({!r})[{!r}]'.format(col, path, col))
+        column = store[col] if index is None else store.take(col, index)
+        if column.ndim == 1:
+            blocks.append(pd.DataFrame({col: column}))
+        else:
+            column = column.reshape(column.shape[0], -1)
+            blocks.append(pd.DataFrame(column, columns=matrix_column_names(col, column.shape[1])))
+    df = pd.concat(blocks, axis=1) if blocks else pd.DataFrame(index=range(store.num_rows if index is None
+                                                                             else index.shape[0]))
+    print('loaded {} rows, {} columns from {}'.format(df.shape[0], len(columns), path))
+    return df
+
+
+def load_frame(path, columns=None, rows=None):
+    """
+    调试和小表用的便捷读取: 返回 DataFrame, 数组列是指向 memmap 的逐行视图.
+    每行每个数组列都是一个 Python 对象, 大表常驻内存会成倍增加, 训练和预测用 read_frame / FeatureStore
+    :param path: 存储目录
+    :param columns: 需要的列, 默认全部
+    :param rows: 行号或布尔掩码, 默认全部行
+    """
+    store = FeatureStore(path)
+    columns = store.columns if columns is None else columns
+    data = {}
+    for col in columns:
+        column = store[col]
+        if rows is not None:
+            column = store.take(col, np.arange(store.num_rows)[rows])
+        if isinstance(column, RaggedColumn):
+            data[col] = column.tolist()
+        elif column.ndim > 1:
+            data[col] = list(column)
+        else:
+            data[col] = column
+    df = pd.DataFrame(data, columns=columns)
+    print('loaded {} rows, {} columns from {}'.format(df.shape[0], len(columns), path))
+    return df
@@ -7,6 +7,10 @@ from joblib import Parallel, delayed
 from sklearn.preprocessing import LabelEncoder
 import numpy as np
 
+import feature_store
+import key_index
+import segment_stats
+
 N_JOBS = multiprocessing.cpu_count()
 print('N_JOBS:', N_JOBS)
 
@@ -44,25 +48,24 @@ def func3(lst):
     return np.asarray(sorted(lst.tolist()))
 
 def get_user_like(data):
-
-    temp = data[data['click'] == 1]
-    features = [np.array(feat.tolist()) for feat in [temp['face_cols_num'], temp['topics']]]
-    features.append(temp[[col for col in temp if 'ctx_' in col and '01_' not in col]].values)
-    temp['concated_feature'] = [np.array(lst) for lst in np.concatenate(features, axis=1).tolist()]
-    user_like_mean = [[uid, np.array(value['concated_feature'].tolist()).mean(axis=0).astype(np.float32)] for uid, value in temp.groupby(['uid'])]
-    user_like_mean = pd.DataFrame(user_like_mean, columns=['uid', 'user_like_mean'])
-    del temp['concated_feature']
-    data = pd.merge(data, user_like_mean, 'left', ['uid'])
-    return data
+    """
+    每个用户点击过的 photo 的特征均值
+    :return: float32 [num_users, dim], 第 i 行对应 user_indices == i (与 LabelEncoder 对 uid 编码的顺序相同)
+    """
+    ctx_cols = [col for col in data if 'ctx_' in col and '01_' not in col]
+    user_indices = LabelEncoder().fit_transform(data['uid'])
+    clicked = data['click'].values == 1
+    features = segment_stats.feature_matrix(data[clicked], ['face_cols_num', 'topics'] + ctx_cols)
+    return segment_stats.user_table(features, user_indices[clicked], user_indices.max() + 1)['mean']
 
 if __name__ == '__main__':
-    df = pd.read_pickle('../data/interaction_features_1.pkl')
+    df = feature_store.load_frame('../data/interaction_features_1')
     print('loaded data...')
     print(df.columns)
 
     # 添加连续特征
 
-    df_ctx = pd.read_pickle('../data/context_feature.pkl')
+    df_ctx = feature_store.load_frame('../data/context_feature')
     df = pd.merge(df, df_ctx, 'left', left_on=['uid','pid'], right_on=['user_id', 'photo_id'])
     print('context feature concated...')
 
@@ -73,9 +76,10 @@ if __name__ == '__main__':
     df['topics'] = df['topics'].apply(lambda lst: empty if pd.isna(lst) is True else lst)
     print('text lda concated...')
 
-    # 求用户平均偏好
-    df = get_user_like(df)
-    print(df['user_like_mean'])
+    # 求用户平均偏好, 存成按 user_indices 排列的表, 没有点击的用户为 0
+    user_like_mean = np.nan_to_num(get_user_like(df))
+    np.save('../data/user_like_mean.npy', user_like_mean)
+    print(user_like_mean.shape)
     print('get user_like_mean...')
 
 
@@ -87,21 +91,28 @@ if __name__ == '__main__':
         if 'ctx_01_hour' in col:
             df[col] = encoder.fit_transform(df[col])
             df[col] = df[col].astype(np.int8)
+    # photo 级别的特征每个 photo 只存一份, 第 i 行对应 photo_indices == i, 训练时按 photo_indices 取
+    photo_df = df[['photo_indices', 'pid', 'words', 'topics', 'face_cols_01', 'face_cols_num']]
+    photo_df = photo_df.drop_duplicates('photo_indices').sort_values('photo_indices')
+    feature_store.write_frame(photo_df.drop('photo_indices', axis=1), '../data/photo_features', ragged=['words'])
     tr_df = df[(df['is_test'] == False) & (df['is_val'] == False)]
     val_df = df[df['is_val'] == True]
     te_df = df[df['is_test'] == True]
     for d in [tr_df, te_df, val_df]:
         del d['is_test'], d['is_val']
     # del tr_df['uid']
-    tr_df.to_pickle('../data/train_data.pkl')
+    feature_store.write_frame(tr_df, '../data/train_data', ragged=['words'])
     print(tr_df)
     print(tr_df.columns)
-    val_df.to_pickle('../data/val_data.pkl')
+    feature_store.write_frame(val_df, '../data/val_data', ragged=['words'])
     print(val_df)
     print(val_df.columns)
-    te_df.to_pickle('../data/test_data.pkl')
+    feature_store.write_frame(te_df, '../data/test_data', ragged=['words'])
     print(te_df)
     print(te_df.columns)
+    # 按 (uid, time) 排序的行索引, load_and_pred 逐用户预测时直接切片
+    for path in ['../data/val_data', '../data/test_data']:
+        key_index.build_store_index(path, 'uid', 'time')
 
 
     # text_df = pd.read_pickle('../data/text_lda_6.pkl')
@@ -1,17 +1,16 @@
 import pandas as pd
 from joblib import Parallel, delayed
 
+import key_index
+
 
 def yeild_udf(inter):
-    uids = set(inter['uid'])
-    total = len(uids)
-    count = 0
-    for uid in uids:
-        df_u = inter[inter['uid'] == uid]
+    index = key_index.KeyIndex.build(inter['uid'].values)
+    total = len(index)
+    for count, (uid, rows) in enumerate(index):
         if count % 100 == 0:
             print(count / total)
-        count += 1
-        yield df_u
+        yield inter.iloc[rows]
 
 
 def get_val_set(df_u, val_rate):
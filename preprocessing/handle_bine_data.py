@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 
+import feature_store
+
 
 def read_bine_data(bine_path):
     dic = {'uid': [], 'user_emb': []}
@@ -16,6 +18,6 @@ def read_bine_data(bine_path):
 if __name__ == '__main__':
     bine_path = '../data/vector_u.dat'
     df_bine = read_bine_data(bine_path)
-    df_test = pd.read_pickle('../data/test_data.pkl')
+    df_test = feature_store.load_frame('../data/test_data', ['uid', 'user_indices'])
     df = pd.merge(df_bine, df_test, 'left', 'uid')
     df[['uid', 'user_indices', 'user_emb']].to_pickle('../model/bine_emb.pkl')
\ No newline at end of file
@@ -0,0 +1,68 @@
+# coding=utf-8
+"""
+流式导入原始交互数据: 按固定行数分块读 txt, 每块直接以紧凑类型追加进特征存储,
+内存占用与文件大小无关. 新一天的数据只需要再追加一次, 不用重读之前的数据.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import feature_store
+
+TRAIN_SCHEMA = [('uid', np.int32), ('pid', np.int32), ('click', np.uint8), ('like', np.uint8),
+                ('follow', np.uint8), ('time', np.int64), ('playing_time', np.float32),
+                ('duration_time', np.float32)]
+TEST_SCHEMA = [('uid', np.int32), ('pid', np.int32), ('time', np.int64), ('duration_time', np.float32)]
+
+
+def _source_key(txt_path):
+    """
+    判断文件是否导入过的键: 不同目录下的同名文件, 或原地更新过的文件都算新的来源
+    """
+    stat = os.stat(txt_path)
+    return {'path': os.path.abspath(txt_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def ingest(txt_path, store_path, schema, chunk_rows=2 ** 21):
+    """
+    把一个 tab 分隔的交互文件追加进 store_path
+    :param txt_path: 原始 txt 文件
+    :param store_path: 特征存储目录, 不存在则新建
+    :param schema: [(列名, dtype)]
+    :param chunk_rows: 每块行数
+    :return: 本次导入的行数
+    """
+    writer = feature_store.StoreWriter(store_path, append=True)
+    source = os.path.basename(txt_path)
+    source_key = _source_key(txt_path)
+    if writer.meta is not None and source_key in writer.meta.get('sources', []):
+        print(source, 'already ingested into', store_path)
+        return 0
+    names = [name for name, _ in schema]
+    reader = pd.read_csv(txt_path, sep='\t', header=None, names=names, dtype=dict(schema),
+                         chunksize=chunk_rows)
+    start_time = time.time()
+    total = 0
+    for chunk in reader:
+        writer.append(chunk)
+        total += chunk.shape[0]
+        elapsed = time.time() - start_time
+        print('{}: {} rows, {:.0f} rows/sec'.format(source, total, total / max(elapsed, 1e-6)))
+    if writer.meta is None:
+        print(source, 'is empty')
+        return 0
+    writer.meta.setdefault('sources', []).append(source_key)
+    writer.close()
+    print('{} ingested, {} rows in {}'.format(source, writer.num_rows, store_path))
+    return total
+
+
+if __name__ == '__main__':
+    # python ingest_interaction.py train ../data/train_interaction.txt [../data/train_interaction]
+    kind, txt_path = sys.argv[1], sys.argv[2]
+    store_path = sys.argv[3] if len(sys.argv) > 3 else '../data/{}_interaction'.format(kind)
+    ingest(txt_path, store_path, TRAIN_SCHEMA if kind == 'train' else TEST_SCHEMA)
@@ -0,0 +1,105 @@
+# coding=utf-8
+"""
+按键分段的行索引 (CSR): 表的行按 (key, sort_by) 排序得到 order, 唯一键 keys 升序,
+第 i 个键的行号是 order[offsets[i]:offsets[i + 1]]. 在预处理阶段建一次, 存在数据目录旁边,
+逐用户 / 逐 photo 的处理直接切片, 不再每个键扫描一遍整表.
+
+目录布局:
+    keys.npy      唯一键, 升序
+    offsets.npy   int64 [len(keys) + 1]
+    order.npy     int64 [num_rows], 原表的行号
+"""
+from __future__ import print_function, division
+import os
+
+import numpy as np
+
+import feature_store
+
+
+class KeyIndex(object):
+    def __init__(self, keys, offsets, order):
+        self.keys = keys
+        self.offsets = offsets
+        self.order = order
+
+    @classmethod
+    def build(cls, keys, sort_by=None):
+        """
+        :param keys: 每行的键, 如 uid 列
+        :param sort_by: 同一个键内部的排序列, 如 time; 为 None 时保持原来的行顺序
+        """
+        keys = np.asarray(keys)
+        if sort_by is None:
+            order = np.argsort(keys, kind='mergesort')
+        else:
+            order = np.lexsort((np.asarray(sort_by), keys))
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if keys.shape[0] else \
+            np.zeros([0], np.int64)
+        offsets = np.append(starts, keys.shape[0]).astype(np.int64)
+        return cls(sorted_keys[starts], offsets, order.astype(np.int64))
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def __iter__(self):
+        """
+        按键升序产出 (key, rows)
+        """
+        for i in range(len(self)):
+            yield self.keys[i], self.rows_at(i)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def positions(self, keys):
+        """
+        :return: 每个键在 self.keys 里的位置, 不存在的为 -1
+        """
+        keys = np.asarray(keys)
+        if not len(self):
+            return np.full(keys.shape, -1, np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self) - 1)
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+    def rows_at(self, i):
+        """
+        第 i 个键的行号
+        """
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+    def rows(self, key):
+        pos = int(self.positions(np.asarray([key]))[0])
+        if pos < 0:
+            raise KeyError(key)
+        return self.rows_at(pos)
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ['keys', 'offsets', 'order']:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(*[np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                     for name in ['keys', 'offsets', 'order']])
+
+
+def index_path(store_path, key):
+    return os.path.join(store_path, 'index_{}'.format(key))
+
+
+def build_store_index(store_path, key, sort_by=None):
+    """
+    为特征存储建按 key 的索引, 存在存储目录下的 index_<key>
+    """
+    store = feature_store.FeatureStore(store_path)
+    index = KeyIndex.build(np.asarray(store[key]), None if sort_by is None else np.asarray(store[sort_by]))
+    index.save(index_path(store_path, key))
+    return index
+
+
+def load_store_index(store_path, key, mmap_mode='r'):
+    return KeyIndex.load(index_path(store_path, key), mmap_mode)
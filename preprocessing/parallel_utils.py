@@ -1,31 +1,134 @@
 import multiprocessing
+import os
+import shutil
+import tempfile
+
 import numpy as np
 
 import pandas as pd
-from joblib import Parallel, delayed
 
 N_JOBS = multiprocessing.cpu_count()
 """=============================================================="""
+# 并行 map 引擎: 输入只发布一次, 数值数组写成 memmap 文件, 其余 (object 数组, DataFrame)
+# 放在模块级的 _SHARED 里由 fork 出来的 worker 直接继承. 每个任务只传 (名字, 行区间),
+# 不再把数据块 pickle 给 worker.
+
+_SHARED = {}
+
+
+def _publish(name, data, tmp_dir):
+    if isinstance(data, np.ndarray) and data.dtype != object:
+        path = os.path.join(tmp_dir, '{}.bin'.format(name))
+        out = np.memmap(path, dtype=data.dtype, mode='w+', shape=data.shape)
+        out[:] = data
+        out.flush()
+        data = np.memmap(path, dtype=data.dtype, mode='r', shape=data.shape)
+    _SHARED[name] = data
+
+
+def _split_ranges(n, n_jobs, chunks_per_job=4):
+    # 每个 worker 分几段, 兼顾负载均衡和任务数
+    bounds = np.linspace(0, n, min(n, n_jobs * chunks_per_job) + 1).astype(np.int64)
+    return [(int(lo), int(hi)) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def _run_range(task):
+    name, lo, hi = task
+    func, arg = _SHARED[name + '_func']
+    return func(_SHARED[name], lo, hi, arg)
+
+
+def _fork_pool(n_jobs):
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(n_jobs)
+    return multiprocessing.Pool(n_jobs)
+
+
+def parallel_ranges(func, data, arg=None, n_jobs=N_JOBS):
+    """
+    把 data 按行切成若干区间, 每个区间在 worker 里执行 func(data, lo, hi, arg).
+    func 和 arg 也随 fork 继承, 可以是 lambda 或很大的字典, 不会被 pickle
+    :param data: np.ndarray / pd.Series / pd.DataFrame
+    :return: 按区间顺序排列的结果列表
+    """
+    if isinstance(data, pd.Series):
+        data = data.values
+    n = data.shape[0]
+    ranges = _split_ranges(n, n_jobs)
+    if n_jobs <= 1 or len(ranges) <= 1:
+        return [func(data, lo, hi, arg) for lo, hi in ranges]
+    tmp_dir = tempfile.mkdtemp(prefix='parallel_utils_')
+    name = 'data_{}'.format(len(_SHARED))
+    try:
+        _publish(name, data, tmp_dir)
+        _SHARED[name + '_func'] = (func, arg)
+        # worker 在发布之后才 fork, 继承 _SHARED
+        pool = _fork_pool(n_jobs)
+        try:
+            return pool.map(_run_range, [(name, lo, hi) for lo, hi in ranges])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _SHARED.pop(name, None)
+        _SHARED.pop(name + '_func', None)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def group_reduce(keys, values=None, how='count'):
+    """
+    按 keys 排序一次, 用 reduceat 对每个分组做归约, 不再每组一个任务
+    :param keys: [np.ndarray], 一个或多个分组键, 键为空值的行不参与 (与 groupby 一致)
+    :param values: np.ndarray, how='count' 时统计非空个数, 为 None 时统计行数
+    :param how: 'count' / 'sum' / 'mean' / 'max' / 'min'
+    :return: (每个分组的键 [np.ndarray], 归约结果), 分组按键升序
+    """
+    codes, uniques = zip(*[pd.factorize(np.asarray(key), sort=True) for key in keys])
+    keep = np.logical_and.reduce([c >= 0 for c in codes])
+    codes = [c[keep] for c in codes]
+    order = np.lexsort(codes[::-1])
+    codes = [c[order] for c in codes]
+    n = order.shape[0]
+    if n == 0:
+        return [u[:0] for u in uniques], np.zeros([0])
+    change = np.zeros(n, bool)
+    change[0] = True
+    for c in codes:
+        change[1:] |= c[1:] != c[:-1]
+    starts = np.flatnonzero(change)
+    group_keys = [u[c[starts]] for u, c in zip(uniques, codes)]
+    if values is None:
+        return group_keys, np.diff(np.r_[starts, n])
+    values = np.asarray(values)[keep][order]
+    if how == 'count':
+        return group_keys, np.add.reduceat(pd.notnull(values).astype(np.int64), starts)
+    if how == 'sum':
+        return group_keys, np.add.reduceat(values, starts)
+    if how == 'mean':
+        return group_keys, np.add.reduceat(values, starts) / np.diff(np.r_[starts, n])
+    if how == 'max':
+        return group_keys, np.maximum.reduceat(values, starts)
+    if how == 'min':
+        return group_keys, np.minimum.reduceat(values, starts)
+    raise ValueError('unknown reduction {}'.format(how))
+
 
-def get_kv(name_group):
-    name, group = name_group
-    return name, group.count()
+"""=============================================================="""
 
 
 def count_dict(grouped, count_col):
-    lst = Parallel(n_jobs=N_JOBS)(
-        delayed(get_kv)((name, group[count_col])) for name, group in grouped)
-    return dict(lst)
+    return grouped[count_col].count().to_dict()
 
 
 """=============================================================="""
 
 
-def dec_series_func(ser, fuc, arg=None):
+def dec_series_func(values, lo, hi, func_arg):
+    func, arg = func_arg
     if arg is None:
-        return ser.apply(fuc).tolist()
+        return [func(x) for x in values[lo:hi]]
     else:
-        return ser.apply(fuc, args=(arg,)).tolist()
+        return [func(x, arg) for x in values[lo:hi]]
 
 
 def split_str(x):
@@ -78,27 +181,23 @@ def get_cnt(x, dic):
 
 
 def series_map(ser, func, arg=None):
-    lst = Parallel(n_jobs=N_JOBS)(
-        delayed(dec_series_func)(ele, func, arg) for ele in np.array_split(ser, N_JOBS*100))
+    lst = parallel_ranges(dec_series_func, ser, (func, arg))
     return np.concatenate(lst)
 
 def series_map_2(ser, func, arg=None):
-    if arg is None:
-        lst = Parallel(n_jobs=N_JOBS)(
-            delayed(func)(ele,) for ele in ser)
-    else:
-        lst = Parallel(n_jobs=N_JOBS)(
-            delayed(func)(ele, arg) for ele in ser)
-    return np.concatenate(lst)
+    lst = parallel_ranges(dec_series_func, ser, (func, arg))
+    return np.concatenate([ele for part in lst for ele in part])
 
 """=============================================================="""
 
 
-def dec_frame_func(df, fuc, arg=None):
+def dec_frame_func(df, lo, hi, func_arg):
+    func, arg = func_arg
+    rows = df.iloc[lo:hi]
     if arg is None:
-        return df.apply(fuc, axis=1, reduce=True).tolist()
+        return rows.apply(func, axis=1).tolist()
     else:
-        return df.apply(fuc, axis=1, reduce=True, args=(arg, )).tolist()
+        return rows.apply(func, axis=1, args=(arg, )).tolist()
 
 def get_df_cnt(x, args):
     col1, col2, dic = args
@@ -108,18 +207,12 @@ def div(x, args):
     return x[args[0]] / x[args[1]]
 
 
-def join_func(df, cnt, on):
-    return pd.merge(df, cnt, 'left', on=on)
-
-
 def left_join(df, cnt, on):
-    lst = Parallel(n_jobs=N_JOBS)(
-        delayed(join_func)(rows, cnt, on) for rows in np.array_split(df, N_JOBS))
-    return pd.concat(lst)
+    # 按行切块并行 merge 只会增加序列化开销, 单次 merge 结果的行序与原来一致
+    return pd.merge(df, cnt, 'left', on=on)
 
 def dataframe_map(df, func, arg=None):
-    lst = Parallel(n_jobs=N_JOBS)(
-        delayed(dec_frame_func)(rows, func, arg) for rows in np.array_split(df, N_JOBS))
+    lst = parallel_ranges(dec_frame_func, df, (func, arg))
     return np.concatenate(lst)
 
 
@@ -130,24 +223,14 @@ def comb_str(s1, s2):
     return s1 + s2
 
 def combline_series(ser1, ser2):
-    lst = Parallel(n_jobs=N_JOBS)(
-        delayed(comb_str)(i, j) for i, j in zip(ser1, ser2))
-    return lst
+    return (np.asarray(ser1, dtype=object) + np.asarray(ser2, dtype=object)).tolist()
 
 
 """=============================================================="""
 
 
-def get_row(args):
-    name, group, col = args
-    cnt = group[col].count()
-    name = [name] if isinstance(name, int) else name
-    return list(name) + [cnt]
-
-
 def group_count(df, by, col, cnt_name):
-    lst = Parallel(n_jobs=N_JOBS)(
-        delayed(get_row)((name, group, col)) for name, group in df.groupby(by=by))
-    res_df = pd.DataFrame(lst, columns=by + [cnt_name])
+    keys, cnt = group_reduce([df[key].values for key in by], df[col].values, how='count')
+    res_df = pd.DataFrame(dict(zip(by, keys)), columns=by)
+    res_df[cnt_name] = cnt
     return res_df
-
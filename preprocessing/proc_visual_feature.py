@@ -1,106 +1,149 @@
+# coding=utf-8
+"""
+从 visual zip 包里抽取视觉特征.
+
+zip 的中央目录只读一次, 得到每个成员在文件里的偏移; 成员按固定行数切成分片, 多个进程
+直接按偏移读成员数据, 写进预先分配好的 memmap 矩阵 [num_photos, 2048]. 每完成一个分片
+就记进 manifest.json, 中途失败重新运行时只处理没完成的分片.
+
+输出目录:
+    pids.npy        第 i 行对应的 pid
+    visual.npy      float32 [num_photos, dim], 用 np.load(path, mmap_mode='r') 读
+    manifest.json   分片划分和完成情况
+"""
+from __future__ import print_function, division
+import io
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import zipfile
+import zlib
+
 import numpy as np
-import pandas as pd
-from joblib import Parallel, delayed
-
-
-# for iter,(key, value) in enumerate(train_visual.iteritems()):
-#     lst.append([key[train_str_length:], value])
-#     if iter % 427868 == 0:
-#         pd.DataFrame(lst, columns=['pid', 'visual']).to_pickle('../data/train_visual_feature_{}.pkl'.format(iter+1))
-#         lst = []
-# if lst:
-#     pd.DataFrame(lst, columns=['pid', 'visual']).to_pickle('../data/train_visual_feature_11.pkl')
-
-# lst_test = []
-#
-# for iter, (key, value) in enumerate(test_visual.iteritems()):
-#     lst_test.append([key[test_str_length:], value])
-# pd.DataFrame(lst_test, columns=['pid', 'visual']).to_pickle('../data/test_visual_feature.pkl')
-#
-# df = pd.DataFrame()
-#
-# for i in range(1, 12):
-#     train_visual_sample = pd.read_pickle('../data/train_visual_feature_{}.pkl'.format(i))
-#     df = pd.concat(df, train_visual_sample)
-
-def yield_keys1(visual):
-    keys = []
-    cnt = 0
-    visual = np.load(visual)
-    lenth = len(visual.keys())
-
-    for iter, key in enumerate(visual.keys()[1:]):
-        keys.append(key)
-        if iter % 20000 == 0 or iter == lenth - 1:
-            print(iter/7560366)
-            if 340 < cnt <= 360:
-                yield keys[:]
-            keys = []
-            cnt += 1
-    # if keys:
-    #     yield keys[:]
-
-def yield_keys2(visual):
-    keys = []
-    cnt = 0
-    visual = np.load(visual)
-    for iter, key in enumerate(visual.keys()[1:]):
-        keys.append(key)
-        if cnt % 20000 == 0:
-            print(cnt/895846)
-            yield keys[:]
-            keys = []
-        cnt += 1
-    if keys:
-        yield keys[:]
-
-def to_pickle1(visual, it, keys, length):
-    print(it)
-    visual = np.load(visual)
-    lst = []
-    for key in keys:
-        lst.append([int(key[length:]), visual[key][0]])
-    pd.DataFrame(lst, columns=['pid', 'visual']).to_pickle('../data/visual/train_visual_feature_17_{}.pkl'.format(it))
-    return None
-
-def to_pickle2(visual, it, keys, length):
-    visual = np.load(visual)
-    lst = []
-    for key in keys:
-        lst.append([int(key[length:]), visual[key][0]])
-    pd.DataFrame(lst, columns=['pid', 'visual']).to_pickle('../data/visual/test_visual_feature_{}.pkl'.format(it))
-    # return pd.DataFrame(lst, columns=['key', 'visual'])
-
-# def fun1(visual,lst, length):
-#     for iter, key in enumerate(visual.keys()):
-#         lst.append([key[length:], visual[key]])
-#         cnt = 0
-#         if iter % 427868 == 0:
-#             pd.DataFrame(lst, columns=['pid', 'visual']).to_pickle('../data/train_visual_feature_{}.pkl'.format(cnt))
-#             cnt += 1
-#             lst = []
-#     if lst:
-#         pd.DataFrame(lst, columns=['pid', 'visual']).to_pickle('../data/train_visual_feature_11.pkl')
-#         lst = []
-
-def proc_visual(visual, length, yield_keys, to_pickle, name):
-    lst = Parallel(n_jobs=15, backend='multiprocessing')(
-        delayed(to_pickle)(visual, it, keys, length) for it, keys in enumerate(yield_keys(visual)))
-    # lst = pd.concat(lst, ignore_index=True)
-    # lst['key'] = lst['key'].astype('int')
-    # lst.to_pickle(
-    #     '../data/visual/visual_feature_{}.pkl'.format(name))
-    print(name, 'finished...')
-
-if __name__== "__main__":
-    # train_visual = np.load('../data/train_visual.zip')
-    # test_visual = np.load('../data/test_visual.zip')
-    train_visual = '../data/visual/train_visual.zip'
-    test_visual = '../data/visual/test_visual.zip'
-
-    train_str_length = len('final_visual_train/')
-    test_str_length = len('final_visual_test/')
-
-    proc_visual(train_visual, train_str_length, yield_keys1, to_pickle1, 'train')
-    print('*******train_completed!**********')
-    # proc_visual(test_visual, test_str_length, yield_keys2, to_pickle2, 'test')
+
+MANIFEST_FILE = 'manifest.json'
+_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+
+
+def list_members(zip_path, prefix_length):
+    """
+    :return: (pids, members), members 为 [(header_offset, compress_size, compress_type)]
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        infos = [info for info in zf.infolist() if info.filename.endswith('.npy')]
+    pids = np.array([int(info.filename[prefix_length:-len('.npy')]) for info in infos], np.int64)
+    members = [(info.header_offset, info.compress_size, info.compress_type) for info in infos]
+    return pids, members
+
+
+def read_member(fin, member):
+    """
+    按本地文件头直接读出一个成员的数据, 不经过 zipfile 的中央目录
+    """
+    header_offset, compress_size, compress_type = member
+    fin.seek(header_offset)
+    header = _LOCAL_HEADER.unpack(fin.read(_LOCAL_HEADER.size))
+    name_length, extra_length = header[-2], header[-1]
+    fin.seek(header_offset + _LOCAL_HEADER.size + name_length + extra_length)
+    raw = fin.read(compress_size)
+    if compress_type == zipfile.ZIP_STORED:
+        return raw
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(raw, -15)
+    raise ValueError('unsupported compression type {}'.format(compress_type))
+
+
+def _load_vector(fin, member):
+    return np.load(io.BytesIO(read_member(fin, member))).reshape(-1)
+
+
+def _extract_shard(task):
+    zip_path, out_path, shard_id, lo, members = task
+    out = np.load(out_path, mmap_mode='r+')
+    with open(zip_path, 'rb') as fin:
+        for row, member in enumerate(members, lo):
+            out[row] = _load_vector(fin, member)
+    out.flush()
+    del out
+    return shard_id
+
+
+def _write_manifest(out_dir, manifest):
+    # 先写临时文件再改名, 中途失败不会留下半个 manifest
+    tmp_path = os.path.join(out_dir, MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w') as fout:
+        json.dump(manifest, fout, indent=1)
+    os.rename(tmp_path, os.path.join(out_dir, MANIFEST_FILE))
+
+
+def _load_manifest(out_dir, zip_path, num_members, shard_rows):
+    path = os.path.join(out_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        manifest = json.load(fin)
+    if (manifest['zip'] != os.path.abspath(zip_path) or manifest['num_photos'] != num_members or
+            manifest['shard_rows'] != shard_rows):
+        raise ValueError('{} was written for a different extraction, remove it to start over'.format(path))
+    return manifest
+
+
+def extract(zip_path, out_dir, prefix_length, shard_rows=20000, n_jobs=15):
+    """
+    抽取一个 visual zip 包, 可以反复运行, 已完成的分片会跳过
+    :param prefix_length: 成员名里 pid 之前的目录前缀长度, 如 len('final_visual_train/')
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    pids, members = list_members(zip_path, prefix_length)
+    out_path = os.path.join(out_dir, 'visual.npy')
+    manifest = _load_manifest(out_dir, zip_path, len(members), shard_rows)
+    if manifest is None:
+        with open(zip_path, 'rb') as fin:
+            first = _load_vector(fin, members[0])
+        np.save(os.path.join(out_dir, 'pids.npy'), pids)
+        np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(len(members), first.shape[0]))
+        manifest = {'zip': os.path.abspath(zip_path), 'num_photos': len(members), 'shard_rows': shard_rows,
+                    'dim': int(first.shape[0]), 'done': []}
+        _write_manifest(out_dir, manifest)
+    done = set(manifest['done'])
+    num_shards = (len(members) + shard_rows - 1) // shard_rows
+    tasks = [(zip_path, out_path, shard_id, shard_id * shard_rows,
+              members[shard_id * shard_rows:(shard_id + 1) * shard_rows])
+             for shard_id in range(num_shards) if shard_id not in done]
+    print('{}: {} of {} shards left'.format(zip_path, len(tasks), num_shards))
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        for shard_id in pool.imap_unordered(_extract_shard, tasks):
+            manifest['done'].append(shard_id)
+            _write_manifest(out_dir, manifest)
+            print('{}: shard {} done, {}/{}'.format(zip_path, shard_id, len(manifest['done']), num_shards))
+    finally:
+        pool.close()
+        pool.join()
+    print(out_dir, 'finished...')
+
+
+def load_visual(out_dir):
+    """
+    :return: (pids, visual), visual 为只读 memmap
+    """
+    with open(os.path.join(out_dir, MANIFEST_FILE)) as fin:
+        manifest = json.load(fin)
+    num_shards = (manifest['num_photos'] + manifest['shard_rows'] - 1) // manifest['shard_rows']
+    if len(set(manifest['done'])) != num_shards:
+        raise ValueError('{} is incomplete, rerun the extraction'.format(out_dir))
+    return np.load(os.path.join(out_dir, 'pids.npy')), np.load(os.path.join(out_dir, 'visual.npy'), mmap_mode='r')
+
+
+if __name__ == "__main__":
+    # python proc_visual_feature.py [train|test]
+    kinds = sys.argv[1:] or ['train', 'test']
+    if 'train' in kinds:
+        extract('../data/visual/train_visual.zip', '../data/visual/train', len('final_visual_train/'))
+        print('*******train_completed!**********')
+    if 'test' in kinds:
+        extract('../data/visual/test_visual.zip', '../data/visual/test', len('final_visual_test/'))
+        print('*******test_completed!**********')
@@ -0,0 +1,77 @@
+# coding=utf-8
+"""
+用户最近观看历史: 按 (uid, time) 排序一次, 每行的历史是排序后同一用户的前 N 行,
+整块用下标矩阵取出, 不再逐用户过滤. 历史 pid 的词展开成 CSR, 同样是整块 gather.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+import feature_store
+
+
+def recent_pids(uids, times, pids, recent_num=30, pad=-1, chunk_rows=2 ** 22):
+    """
+    每行之前 (同一用户, 按时间) 最近的 recent_num 个 pid, 由旧到新排列, 不足的在末尾补 pad
+    :param uids: [n_rows]
+    :param times: [n_rows], 时间相同的行保持输入顺序
+    :param pids: [n_rows]
+    :param chunk_rows: 每次处理的行数, 控制 [chunk_rows, recent_num] 临时下标矩阵的大小
+    :return: np.ndarray int32 [n_rows, recent_num], 与输入行对齐
+    """
+    uids, times, pids = [np.asarray(x) for x in (uids, times, pids)]
+    n = pids.shape[0]
+    order = np.lexsort((times, uids))
+    sorted_pids = pids[order].astype(np.int32)
+    sorted_uids = uids[order]
+    # 每行在本用户内的序号 = 行号 - 本用户第一行的行号
+    user_start = np.r_[True, sorted_uids[1:] != sorted_uids[:-1]]
+    starts = np.flatnonzero(user_start)
+    rank = np.arange(n) - starts[np.cumsum(user_start) - 1]
+    num_hist = np.minimum(rank, recent_num)
+
+    result = np.empty([n, recent_num], np.int32)
+    steps = np.arange(recent_num)
+    for lo in range(0, n, chunk_rows):
+        hi = min(lo + chunk_rows, n)
+        rows = np.arange(lo, hi)
+        # 第 k 列取排序后第 row - num_hist + k 行, k >= num_hist 的位置补 pad
+        idx = (rows - num_hist[lo:hi])[:, None] + steps
+        valid = steps < num_hist[lo:hi, None]
+        result[order[lo:hi]] = np.where(valid, sorted_pids[np.minimum(idx, n - 1)], pad)
+    return result
+
+
+def recent_words(history, pids, words, missing=(0,)):
+    """
+    把历史 pid 矩阵展开成每行的 (历史位置, 词) 对, CSR 形式
+    :param history: [n_rows, recent_num] pid 矩阵, 如 recent_pids 的结果
+    :param pids: photo 表的 pid 列
+    :param words: 与 pids 对齐的 RaggedColumn
+    :param missing: photo 表里没有的 pid (包括补位的 pad) 使用的词
+    :return: (offsets, positions, values), 第 i 行的词是 values[offsets[i]:offsets[i + 1]],
+        对应的历史位置是 positions[offsets[i]:offsets[i + 1]]
+    """
+    history = np.asarray(history)
+    n, recent_num = history.shape
+    pids = np.asarray(pids)
+    order = np.argsort(pids, kind='mergesort')
+    sorted_pids = pids[order]
+    flat = history.ravel()
+    pos = np.minimum(np.searchsorted(sorted_pids, flat), max(sorted_pids.shape[0] - 1, 0))
+    found = sorted_pids[pos] == flat if sorted_pids.shape[0] else np.zeros(flat.shape, bool)
+    # 在词表末尾追加一行 missing, 找不到的 pid 都指向这一行
+    missing = np.asarray(missing, dtype=words.values.dtype)
+    table = feature_store.RaggedColumn(np.r_[np.asarray(words.offsets), words.offsets[-1] + missing.shape[0]],
+                                       np.concatenate([np.asarray(words.values), missing]))
+    cells = table.take(np.where(found, order[pos], len(words)))
+    offsets = cells.offsets[::recent_num]
+    positions = np.repeat(np.tile(np.arange(recent_num, dtype=np.int32), n), cells.lengths())
+    return offsets, positions, cells.values
+
+
+def recent_words_coo(offsets, positions, values):
+    """
+    转成 [nnz, 3] 的稀疏下标 (行, 历史位置, 词), 与模型里 recent_words_indices_a 的格式一致
+    """
+    row_ids = np.repeat(np.arange(offsets.shape[0] - 1, dtype=np.int64), np.diff(offsets))
+    return np.stack([row_ids, positions.astype(np.int64), values.astype(np.int64)], axis=1)
@@ -0,0 +1,76 @@
+# coding=utf-8
+"""
+批量句向量: word2vec 词向量一次性导出成与词 id 对齐的 float32 矩阵, 所有 photo 的平均句向量
+由特征存储里的 CSR 词矩阵与词向量矩阵相乘一次得到, 结果按块写入可 mmap 的 .npy 文件.
+"""
+from __future__ import print_function, division
+import sys
+
+import numpy as np
+import scipy.sparse as sp
+
+import feature_store
+
+
+def load_word2vec(path):
+    from gensim.models.word2vec import Word2Vec
+    return Word2Vec.load(path)
+
+
+def export_vectors(wv, tokens):
+    """
+    :param wv: gensim 的 KeyedVectors (model.wv), 词以字符串为键
+    :param tokens: 词 id 数组, 第 i 行向量对应 tokens[i]
+    :return: (vectors, known), vectors 为 float32 [len(tokens), vector_size], 不在 word2vec 词表里的行为 0
+    """
+    keys = [str(token) for token in tokens]
+    vocab = wv.key_to_index if hasattr(wv, 'key_to_index') else wv.vocab
+    known = np.array([key in vocab for key in keys], dtype=bool)
+    vectors = np.zeros([len(keys), wv.vector_size], np.float32)
+    if known.any():
+        vectors[known] = wv[[key for key, k in zip(keys, known) if k]]
+    return vectors, known
+
+
+def mean_pool(offsets, ids, vectors, known=None):
+    """
+    每行词向量的平均, 只算 known 的词, 没有可用词的行为 0
+    :param offsets: CSR 行偏移 [num_rows + 1]
+    :param ids: 词 id, 即 vectors 的行号
+    :return: float32 [num_rows, dim]
+    """
+    num_rows = offsets.shape[0] - 1
+    weights = np.ones(ids.shape[0], np.float32) if known is None else known[ids].astype(np.float32)
+    mat = sp.csr_matrix((weights, ids, offsets - offsets[0]), shape=(num_rows, vectors.shape[0]))
+    counts = np.asarray(mat.sum(axis=1)).ravel()
+    return (mat.dot(vectors) / np.maximum(counts, 1)[:, None]).astype(np.float32)
+
+
+def embed_to_file(path, offsets, ids, vectors, known=None, chunk_rows=2 ** 20):
+    """
+    按块计算句向量写入 .npy, 读取时用 np.load(path, mmap_mode='r')
+    :return: 写入的 memmap
+    """
+    num_rows = offsets.shape[0] - 1
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(num_rows, vectors.shape[1]))
+    for lo in range(0, num_rows, chunk_rows):
+        hi = min(lo + chunk_rows, num_rows)
+        out[lo:hi] = mean_pool(offsets[lo:hi + 1], ids[offsets[lo]:offsets[hi]], vectors, known)
+    out.flush()
+    return out
+
+
+if __name__ == '__main__':
+    # python sentence_embedding.py [../data/word2vec/word2vec.model]
+    # 直接用 photo 表的词 CSR (第 i 行对应 photo_indices == i), 词向量矩阵按词 id 排, 不再重新切分原始文本
+    w2v_path = sys.argv[1] if len(sys.argv) > 1 else '../data/word2vec/word2vec.model'
+    photo_store = feature_store.FeatureStore('../data/photo_features')
+    words = photo_store['words']
+    # 第 i 个元素是词 id i 的原始 token, 由 get_input_data.handle_text 写出
+    vocab = np.load('../data/word_vocab.npy')
+    vectors, known = export_vectors(load_word2vec(w2v_path).wv, vocab)
+    print('{} of {} words not in vocabulary'.format(np.sum(~known), known.shape[0]))
+    embed_to_file('../data/word2vec/sentence_vec.npy', np.asarray(words.offsets), np.asarray(words.values),
+                  vectors, known)
+    np.save('../data/word2vec/sentence_vec_pids.npy', np.asarray(photo_store['pid']))
+    print('wrote', len(words), 'sentence vectors')
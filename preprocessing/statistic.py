@@ -1,5 +1,8 @@
+import numpy as np
 import pandas as pd
 
+import text_ingest
+
 if __name__ == '__main__':
     # tr_df = pd.read_pickle('../data/train_interaction.pkl')
     # tr_df.columns = ['uid', 'pid', 'click', 'like', 'follow', 'time', 'playing_time', 'duration_time']
@@ -21,10 +24,7 @@ if __name__ == '__main__':
     # print(te_photo.drop_duplicates().shape[0])
     ser_text1 = pd.read_pickle('../data/train_text.pkl')[1]
     ser_text2 = pd.read_pickle('../data/test_text.pkl')[1]
-    s = set()
-    for text in ser_text1:
-        s.update([int(x) for x in text.split(',')])
-    for text in ser_text2:
-        s.update([int(x) for x in text.split(',')])
+    _, tokens = text_ingest.tokenize(pd.concat([ser_text1, ser_text2]).tolist())
+    s = np.unique(tokens)
     print(len(s))
-    print(max(list(s)))
\ No newline at end of file
+    print(s.max())
\ No newline at end of file
@@ -0,0 +1,89 @@
+# coding=utf-8
+"""
+photo 文本导入: 原始文本是逗号分隔的词 id 串. 整块切分成一个扁平的 token 数组加每个 photo 的偏移,
+词频统计和重新编号都用 np.unique 完成, 可以按块处理, 最后输出 CSR 形式的词列和词表大小.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+import feature_store
+
+
+def tokenize(texts):
+    """
+    :param texts: 逗号分隔的词 id 字符串序列
+    :return: (offsets, tokens), 第 i 行的 token 是 tokens[offsets[i]:offsets[i + 1]], tokens 为 int64
+    """
+    texts = [text.strip() for text in texts]
+    lengths = np.fromiter((text.count(',') + 1 if text else 0 for text in texts), dtype=np.int64, count=len(texts))
+    offsets = np.zeros([lengths.shape[0] + 1], np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    joined = ','.join(text for text in texts if text)
+    tokens = np.array(joined.split(','), dtype=np.int64) if joined else np.array([], np.int64)
+    return offsets, tokens
+
+
+def count_tokens(tokens, counts=None):
+    """
+    统计 token 出现次数, 可以与之前块的结果 counts = (uniques, counts) 合并
+    :return: (uniques, counts), uniques 升序
+    """
+    uniques, block_counts = np.unique(tokens, return_counts=True)
+    if counts is None:
+        return uniques, block_counts
+    uniques, inverse = np.unique(np.concatenate([counts[0], uniques]), return_inverse=True)
+    return uniques, np.bincount(inverse, weights=np.concatenate([counts[1], block_counts]),
+                                minlength=uniques.shape[0]).astype(np.int64)
+
+
+def build_vocab(uniques, counts, min_count=2, drop=(0,)):
+    """
+    出现次数不少于 min_count 且不在 drop 里的 token 组成词表, 新 id 是 token 在词表中的位置
+    :return: 升序的原始 token 数组
+    """
+    keep = (counts >= min_count) & ~np.isin(uniques, drop)
+    return uniques[keep]
+
+
+def encode(offsets, tokens, vocab):
+    """
+    把 token 换成词表里的新 id, 去掉不在词表里的 token, 每行内部按 id 排序
+    :return: RaggedColumn, 值为 int32
+    """
+    num_rows = offsets.shape[0] - 1
+    row_ids = np.repeat(np.arange(num_rows), np.diff(offsets))
+    pos = np.minimum(np.searchsorted(vocab, tokens), max(vocab.shape[0] - 1, 0))
+    found = vocab[pos] == tokens if vocab.shape[0] else np.zeros(tokens.shape, bool)
+    row_ids, ids = row_ids[found], pos[found]
+    order = np.lexsort((ids, row_ids))
+    lengths = np.bincount(row_ids, minlength=num_rows)
+    new_offsets = np.zeros([num_rows + 1], np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    return feature_store.RaggedColumn(new_offsets, ids[order].astype(np.int32))
+
+
+def ingest_text(texts, min_count=2, drop=(0,), chunk_rows=2 ** 20, vocab_path=None):
+    """
+    两遍扫描: 第一遍按块统计词频, 第二遍按块编码
+    :param texts: 逗号分隔的词 id 字符串序列
+    :param vocab_path: 给出时把词表 (第 i 个元素是新 id i 对应的原始 token) 存成 .npy
+    :return: (words, num_words), words 是与 texts 对齐的 RaggedColumn
+    """
+    texts = list(texts)
+    counts = None
+    for start in range(0, len(texts), chunk_rows):
+        _, tokens = tokenize(texts[start:start + chunk_rows])
+        counts = count_tokens(tokens, counts)
+    if counts is None:
+        return feature_store.RaggedColumn(np.zeros([1], np.int64), np.array([], np.int32)), 0
+    print('before filtering', counts[0].shape[0])
+    vocab = build_vocab(counts[0], counts[1], min_count, drop)
+    print('after filtering', vocab.shape[0])
+    if vocab_path is not None:
+        np.save(vocab_path, vocab)
+    offsets, values = [np.zeros([1], np.int64)], []
+    for start in range(0, len(texts), chunk_rows):
+        words = encode(*(tokenize(texts[start:start + chunk_rows]) + (vocab,)))
+        offsets.append(words.offsets[1:] + offsets[-1][-1])
+        values.append(words.values)
+    return feature_store.RaggedColumn(np.concatenate(offsets), np.concatenate(values)), vocab.shape[0]
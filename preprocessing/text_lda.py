@@ -9,9 +9,10 @@
 from __future__ import print_function, division
 import pandas as pd
 import numpy as np
-import collections
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.decomposition import LatentDirichletAllocation
+
+import feature_store
+import text_ingest
+import topic_model
 
 
 def text_lda(max_iter, n_topics):
@@ -25,44 +26,35 @@ def text_lda(max_iter, n_topics):
     print('num of photo_id with text', len(df_text))
 
     # count sentence
-    df_sentences = df_text['text'].apply(lambda t: t.split(','))
-    df_slen = pd.DataFrame(df_sentences.apply(lambda t: len(t)))
+    offsets, tokens = text_ingest.tokenize(df_text['text'].tolist())
+    df_slen = pd.DataFrame(np.diff(offsets))
     print('sentence len:', df_slen.describe())
 
     # count word
-    word_box = []
-    for sentence in df_sentences.values:
-        word_box.extend(sentence)
-    word_counter = collections.Counter(word_box)
-
-    df_word = pd.DataFrame(list(zip(word_counter.keys(), word_counter.values())), columns=['word', 'count'])
+    words, counts = np.unique(tokens, return_counts=True)
+    df_word = pd.DataFrame({'word': words, 'count': counts}, columns=['word', 'count'])
     print('word count:', df_word.describe())
-    # print(df_word.head())
-    # print(df_text['text'].tolist())
 
     #lda
-    corpus = df_text['text'].tolist()
-    cntVector = CountVectorizer(max_df=0.95, min_df=2,
-                                # max_features=100000
-                                )
-    cntTf = cntVector.fit_transform(corpus)
-    print(len(cntVector.get_feature_names()))
-
-    lda = LatentDirichletAllocation(n_topics=n_topics,
-                                    max_iter=max_iter,
-                                    learning_method='batch',
-                                    evaluate_every=5,
-                                    n_jobs=10,
-                                    verbose=1)
-    docres = lda.fit_transform(cntTf)
+    vocab = topic_model.doc_freq_vocab(offsets, tokens, min_df=2, max_df=0.95)
+    print(len(vocab))
+    # token 列写进特征存储, 训练时按块从磁盘读
+    feature_store.write_frame(pd.DataFrame({'pid': df_text['pid'].values,
+                                            'tokens': feature_store.RaggedColumn(offsets, tokens).tolist()}),
+                              '../data/text_tokens', ragged=['tokens'])
+    lda = topic_model.fit_online('../data/text_tokens', vocab, n_topics, passes=max_iter,
+                                 evaluate_every=5, verbose=1)
+    topic_model.save_model(lda, vocab, '../model/text_lda_{}.model'.format(n_topics))
+    docres = topic_model.transform(lda, vocab, offsets, tokens, n_jobs=10)
     print(docres.shape)
     # print(docres)
+    cntTf = topic_model.doc_term_matrix(text_ingest.encode(offsets, tokens, vocab), vocab.shape[0])
     print(lda.perplexity(cntTf))
     # print(lda.components_)
     # column_names = ['topic_' + str(i) for i in range(1, n_topics+1)]
 
     df_text_lda = pd.DataFrame()
-    df_text_lda['topics'] = [np.asarray(lst, dtype=np.float32) for lst in docres.tolist()]
+    df_text_lda['topics'] = list(docres)
     df_text_lda['pid'] = df_text['pid']
     df_text_lda.to_pickle('../data/text_lda_{}.pkl'.format(n_topics))
     print('doc size:', docres.shape)
@@ -72,5 +64,6 @@ def text_lda(max_iter, n_topics):
 
 if __name__ == '__main__':
 
-    text_lda(max_iter=1500, n_topics=6)
+    # online 训练, max_iter 为遍历语料的次数
+    text_lda(max_iter=20, n_topics=6)
     print('text lda finish')
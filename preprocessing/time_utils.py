@@ -7,6 +7,9 @@ import pandas as pd
 import numpy as np
 from joblib import Parallel, delayed
 
+import feature_store
+import key_index
+
 
 def _timestamp_datetime(value):
     format = '%Y-%m-%d %H:%M:%S'
@@ -24,24 +27,25 @@ def trans_time(df_data):
     return df_data
 
 
-def yield_uid(df_data):
-    total = df_data.shape[0]
-    temp = df_data[['user_id', 'photo_id', 'realtime']]
-    temp = temp.sort_values(['user_id', 'realtime'], ascending=[1, 1])
+def _sorted_groups(df_data, key):
+    """
+    按 (key, realtime) 排序, 返回排好的表和每组的行偏移
+    """
+    index = key_index.KeyIndex.build(df_data[key].values, df_data['realtime'].values)
+    temp = df_data[['user_id', 'photo_id', 'realtime']].iloc[index.order]
     temp.index = range(temp.shape[0])
-    index = 0
-    last_uid = temp.loc[0, 'user_id']
-    for i in temp.index:
-        if temp.iloc[i, 0] != last_uid:
-            print(temp.iloc[i])
-            print('===========', index / total, last_uid, index, i)
-            yield temp.iloc[index:i, :]
-            print('yield', index, i - 1)
-            index = i
-            last_uid = temp.iloc[i, 0]
-    yield temp.iloc[index:, :]
+    return temp, index.offsets
+
+
+def yield_uid(df_data):
+    temp, offsets = _sorted_groups(df_data, 'user_id')
+    total = temp.shape[0]
+    for i in range(offsets.shape[0] - 1):
+        print('===========', offsets[i] / total, temp.iloc[offsets[i], 0], offsets[i], offsets[i + 1])
+        yield temp.iloc[offsets[i]:offsets[i + 1], :]
     print('finished yield')
 
+
 def handle_uid(df_uid):
     df_uid['start_time'] = df_uid['realtime'] - pd.Timedelta(minutes=8)
     df_uid['end_time'] = df_uid['realtime'] + pd.Timedelta(minutes=8)
@@ -126,25 +130,15 @@ def user_batch_cnt_pre8min(df_data):
 
 
 def yield_pid(df_data):
-    total = df_data.shape[0]
-    temp = df_data[['user_id', 'photo_id', 'realtime']]
-    temp = temp.sort_values(['photo_id', 'realtime'], ascending=[1, 1])
-    temp.index = range(temp.shape[0])
-    index = 0
-    cnt = 0
-    last_pid = temp.iloc[0, 1]
-    for i in temp.index:
-        if temp.iloc[i, 1] != last_pid:
-            cnt += 1
-            if cnt % 2000 == 0:
-                print('===========', index / total, last_pid)
-            if i - 1 > index:
-                yield temp.iloc[index:i, :]
-                if cnt % 2000 == 0:
-                    print('yield', index, i - 1)
-            index = i
-            last_pid = temp.iloc[i, 1]
-    yield temp.iloc[index:, :]
+    temp, offsets = _sorted_groups(df_data, 'photo_id')
+    total = temp.shape[0]
+    last = offsets.shape[0] - 2
+    for i in range(last + 1):
+        if i % 2000 == 0:
+            print('===========', offsets[i] / total, temp.iloc[offsets[i], 1])
+        # 只看过一次的 photo 没有前后的批次, 跳过 (最后一组总是产出)
+        if offsets[i + 1] - offsets[i] > 1 or i == last:
+            yield temp.iloc[offsets[i]:offsets[i + 1], :]
     print('finished yield')
 
 
@@ -326,36 +320,148 @@ def user_photo_total_cnt(df_data):
     return df_data
 
 
-if __name__ == '__main__':
-    train_inter = pd.read_pickle('../data/train_interaction.pkl')
-    train_inter.columns = ['user_id', 'photo_id', 'click', 'like', 'follow', 'time', 'playing_time', 'duration_time']
-    test_inter = pd.read_pickle('../data/test_interaction.pkl')
-    test_inter.columns = ['user_id', 'photo_id', 'time', 'duration_time']
-    inter = pd.concat([train_inter, test_inter], ignore_index=True, sort=False)
-    inter = inter.drop(columns=['like', 'follow', 'playing_time', 'duration_time'])
-    inter = trans_time(inter)
-
-    inter = parallel_user_cnt_pre8min(inter)
-    inter[['user_id','photo_id','user_pre8min_cnt','user_aft8min_cnt']].to_pickle('../data/context_feature/user_cnt_pre8min.pkl')
-
-    inter = user_batch_cnt_pre8min(inter)
-    inter[['user_id','photo_id','user_batch_cnt_pre8min','user_batch_cnt_aft8min']].to_pickle('../data/context_feature/user_batch_cnt_pre8min.pkl')
-
-    inter = parallel_photo_batch_cnt_pre1day(inter)
-    inter[['user_id','photo_id','photo_batch_cnt_pre1day','photo_batch_cnt_aft1day']].to_pickle('../data/context_feature/photo_batch_cnt_pre1day.pkl')
-
-    inter = next_time_diff(inter)
-    inter[['user_id', 'photo_id', 'next_time_diff']].to_pickle(
-        '../data/context_feature/next_time_diff.pkl')
-
-    inter = pre_time_diff(inter)
-    inter[['user_id', 'photo_id', 'pre_time_diff']].to_pickle(
-        '../data/context_feature/pre_time_diff.pkl')
-
-    inter = user_photo_total_cnt(inter)
-    inter[['user_id', 'photo_id', 'photo_total_cnt', 'user_total_cnt', 'user_total_batch_cnt']].to_pickle(
-        '../data/context_feature/user_photo_total_cnt.pkl')
+"""=============================================================="""
+
+SECOND = 1000
+MINUTE = 60 * SECOND
+DAY = 24 * 60 * MINUTE
+
+# (列名, key 类型, 窗口宽度(ms), 方向, 是否按批次去重)
+CONTEXT_WINDOWS = [
+    ('user_pre8min_cnt', 'user', 8 * MINUTE, 'pre', False),
+    ('user_aft8min_cnt', 'user', 8 * MINUTE, 'aft', False),
+    ('user_batch_cnt_pre8min', 'user', 8 * MINUTE, 'pre', True),
+    ('user_batch_cnt_aft8min', 'user', 8 * MINUTE, 'aft', True),
+    ('photo_batch_cnt_pre1day', 'photo', DAY // 2, 'pre', False),
+    ('photo_batch_cnt_aft1day', 'photo', DAY // 2, 'aft', False),
+]
+
+
+class WindowCounter(object):
+    """
+    按 (key, time) 只排一次序, 把 key 的名次和时间拼成一个单调的 int64 复合键,
+    之后任意宽度、任意方向的窗口计数都只是对复合键的两次全局 searchsorted.
+    同一 key 同一时刻的多条记录算一个批次 (一次刷新).
+    """
+
+    def __init__(self, keys, times, max_window):
+        keys = np.asarray(keys)
+        times = np.asarray(times, dtype=np.int64)
+        self.num_rows = keys.shape[0]
+        self.max_window = max_window
+        self.order = np.lexsort((times, keys))
+        sorted_keys = keys[self.order]
+        self.key_start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+        key_codes = np.cumsum(self.key_start) - 1
+        self.sorted_times = times[self.order]
+        offset_times = self.sorted_times - self.sorted_times.min() if self.num_rows else self.sorted_times
+        # 步长大于 时间跨度 + 最大窗口, 窗口边界不会越过相邻 key
+        stride = (int(offset_times.max()) if self.num_rows else 0) + max_window + 1
+        self.comp = key_codes * np.int64(stride) + offset_times
+        self.batch_start = np.r_[True, self.comp[1:] != self.comp[:-1]]
+        self.batch_comp = self.comp[self.batch_start]
+        self.batch_index = np.cumsum(self.batch_start) - 1
+        self.batch_key_start = self.key_start[self.batch_start]
+
+    def _unsort(self, sorted_values):
+        values = np.empty_like(sorted_values)
+        values[self.order] = sorted_values
+        return values
+
+    def count(self, window, direction='pre', distinct=False):
+        """
+        :param window: 窗口宽度, 与 times 同单位
+        :param direction: 'pre' 统计 [t - window, 当前) 的条数, 'aft' 统计 [当前, t + window) 的条数
+        :param distinct: True 时按批次计数
+        :return: 与输入行对齐的 int64 数组
+        """
+        if window > self.max_window:
+            raise ValueError('window {} exceeds max_window {}'.format(window, self.max_window))
+        if direction not in ('pre', 'aft'):
+            raise ValueError("direction must be 'pre' or 'aft'")
+        if distinct:
+            positions, targets = self.batch_index, self.batch_comp
+        else:
+            positions, targets = np.arange(self.num_rows), self.comp
+        if direction == 'pre':
+            counts = positions - np.searchsorted(targets, self.comp - window, side='left')
+        else:
+            counts = np.searchsorted(targets, self.comp + window, side='left') - positions
+        return self._unsort(counts)
+
+    def _broadcast(self, starts, per_group):
+        return self._unsort(per_group[np.cumsum(starts) - 1])
+
+    def key_size(self):
+        starts = np.flatnonzero(self.key_start)
+        return self._broadcast(self.key_start, np.diff(np.r_[starts, self.num_rows]))
+
+    def batch_size(self):
+        starts = np.flatnonzero(self.batch_start)
+        return self._broadcast(self.batch_start, np.diff(np.r_[starts, self.num_rows]))
+
+    def key_batch_count(self):
+        starts = np.flatnonzero(self.batch_key_start)
+        per_key = np.diff(np.r_[starts, self.batch_key_start.shape[0]])
+        return self._broadcast(self.key_start, per_key)
+
+    def batch_time_diff(self, direction='next', fill=2):
+        """
+        同一 key 相邻批次的时间差 (秒), 没有相邻批次时填 fill
+        """
+        batch_times = self.sorted_times[self.batch_start]
+        diffs = np.full(batch_times.shape[0], fill, dtype=np.float64)
+        gap = (batch_times[1:] - batch_times[:-1]) / SECOND
+        same_key = ~self.batch_key_start[1:]
+        if direction == 'next':
+            diffs[:-1][same_key] = gap[same_key]
+        else:
+            diffs[1:][same_key] = gap[same_key]
+        return self._unsort(diffs[self.batch_index])
+
+
+def context_features(df_data, windows=CONTEXT_WINDOWS, user_col='user_id', photo_col='photo_id', time_col='time'):
+    """
+    一次排序算出全部上下文特征, 返回与 df_data 行对齐的 DataFrame, 不需要再 merge
+    :param windows: [(列名, 'user' | 'photo', 窗口宽度(ms), 'pre' | 'aft', 是否按批次去重)]
+    """
+    max_window = max([w[2] for w in windows] + [0])
+    times = df_data[time_col].values
+    counters = {'user': WindowCounter(df_data[user_col].values, times, max_window),
+                'photo': WindowCounter(df_data[photo_col].values, times, max_window)}
+    result = pd.DataFrame({user_col: df_data[user_col].values, photo_col: df_data[photo_col].values},
+                          columns=[user_col, photo_col])
+    for name, key, window, direction, distinct in windows:
+        result[name] = counters[key].count(window, direction, distinct)
+        print(name, 'counted')
+    user_counter, photo_counter = counters['user'], counters['photo']
+    result['next_time_diff'] = user_counter.batch_time_diff('next')
+    result['pre_time_diff'] = user_counter.batch_time_diff('pre')
+    result['photo_total_cnt'] = photo_counter.key_size()
+    result['user_total_cnt'] = user_counter.key_size()
+    result['user_total_batch_cnt'] = user_counter.key_batch_count()
+    result['batch_photo_cnt'] = user_counter.batch_size()
+    return result
 
-    inter = cal_batch_photo_cnt(inter)
-    inter[['user_id', 'photo_id', 'batch_photo_cnt']].to_pickle('../data/context_feature/batch_photo_cnt.pkl')
 
+if __name__ == '__main__':
+    columns = ['uid', 'pid', 'time']
+    train_inter = feature_store.load_frame('../data/train_interaction', columns)
+    test_inter = feature_store.load_frame('../data/test_interaction', columns)
+    inter = pd.concat([train_inter, test_inter], ignore_index=True, sort=False)
+    inter.columns = ['user_id', 'photo_id', 'time']
+
+    # 七个上下文特征来自同一次排序, 行与 inter 对齐
+    ctx = context_features(inter)
+    outputs = [
+        ('user_cnt_pre8min', ['user_pre8min_cnt', 'user_aft8min_cnt']),
+        ('user_batch_cnt_pre8min', ['user_batch_cnt_pre8min', 'user_batch_cnt_aft8min']),
+        ('photo_batch_cnt_pre1day', ['photo_batch_cnt_pre1day', 'photo_batch_cnt_aft1day']),
+        ('next_time_diff', ['next_time_diff']),
+        ('pre_time_diff', ['pre_time_diff']),
+        ('user_photo_total_cnt', ['photo_total_cnt', 'user_total_cnt', 'user_total_batch_cnt']),
+        ('batch_photo_cnt', ['batch_photo_cnt']),
+    ]
+    for name, cols in outputs:
+        ctx[['user_id', 'photo_id'] + cols].to_pickle('../data/context_feature/{}.pkl'.format(name))
+        print(name, 'saved')
@@ -1,13 +1,22 @@
 import os
 import pandas as pd
 
+import ingest_interaction
+
 dir_path = '../data'
 if __name__ == '__main__':
     file_lst = os.listdir(dir_path)
     for file_name in file_lst:
+        # 特征存储是目录, 跳过
+        if os.path.isdir(os.path.join(dir_path, file_name)):
+            continue
         print(file_name)
-        prefix, suffix = file_name.split('.')
-        if suffix == 'txt':
+        prefix, suffix = os.path.splitext(file_name)
+        if suffix == '.txt' and prefix in ('train_interaction', 'test_interaction'):
+            # 交互数据量大, 流式导入特征存储, 不整表读进内存
+            schema = ingest_interaction.TRAIN_SCHEMA if prefix == 'train_interaction' else ingest_interaction.TEST_SCHEMA
+            ingest_interaction.ingest(os.path.join(dir_path, file_name), os.path.join(dir_path, prefix), schema)
+        elif suffix == '.txt':
             pkl_name = '.'.join([prefix, 'pkl'])
             if pkl_name not in file_lst:
                 df = pd.read_csv(os.path.join(dir_path, file_name), sep='\t', header=None)
@@ -0,0 +1,136 @@
+# coding=utf-8
+"""
+文本主题模型: 直接由整数 token 数组构造文档-词 CSR 矩阵, 不再转回字符串交给 CountVectorizer.
+训练用 online LDA 按块 partial_fit, 块从特征存储里流式读取; 保存的模型可以对新 photo
+按块多进程 transform, 新数据只需要一遍推断, 不用重新训练.
+"""
+from __future__ import print_function, division
+import sys
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.decomposition import LatentDirichletAllocation
+
+import feature_store
+import parallel_utils
+import text_ingest
+
+
+def doc_freq_vocab(offsets, tokens, min_df=2, max_df=0.95):
+    """
+    按文档频率筛词, 规则与 CountVectorizer(min_df, max_df) 相同: 整数为文档数, 小数为比例
+    :return: 升序的原始 token 数组
+    """
+    num_docs = offsets.shape[0] - 1
+    row_ids = np.repeat(np.arange(num_docs), np.diff(offsets))
+    # 每个 (文档, token) 只算一次
+    pairs = np.unique(np.stack([row_ids, tokens], axis=1), axis=0)
+    uniques, doc_counts = np.unique(pairs[:, 1], return_counts=True)
+    min_count = min_df if isinstance(min_df, int) else min_df * num_docs
+    max_count = max_df if isinstance(max_df, int) else max_df * num_docs
+    return uniques[(doc_counts >= min_count) & (doc_counts <= max_count)]
+
+
+def doc_term_matrix(words, num_terms):
+    """
+    :param words: RaggedColumn, 值为词表 id
+    :return: scipy.sparse.csr_matrix [num_docs, num_terms], 值为词频
+    """
+    offsets = np.asarray(words.offsets)
+    values = np.ones(offsets[-1] - offsets[0], np.float64)
+    mat = sp.csr_matrix((values, np.asarray(words.values), offsets - offsets[0]),
+                        shape=(len(words), num_terms))
+    mat.sum_duplicates()
+    return mat
+
+
+def iter_chunks(store_path, vocab, column='tokens', chunk_rows=2 ** 16, start=0, stop=None):
+    """
+    从特征存储里按块读 token 列 (memmap) 的 [start, stop) 行, 逐块产出文档-词矩阵
+    """
+    tokens = feature_store.FeatureStore(store_path)[column]
+    stop = len(tokens) if stop is None else stop
+    for lo in range(start, stop, chunk_rows):
+        chunk = tokens.take(np.arange(lo, min(lo + chunk_rows, stop)))
+        yield doc_term_matrix(text_ingest.encode(chunk.offsets, chunk.values, vocab), vocab.shape[0])
+
+
+def fit_online(store_path, vocab, n_topics, passes=10, chunk_rows=2 ** 16, seed=2018, evaluate_every=-1,
+               holdout_rows=None, **lda_params):
+    """
+    online LDA, 每遍按块流式读取并 partial_fit
+    :param passes: 遍历语料的次数
+    :param evaluate_every: 大于 0 时最后 holdout_rows 行 (默认一块) 留出不参与训练, 每隔这么多遍打印它的困惑度
+    """
+    total = len(feature_store.FeatureStore(store_path))
+    train_rows = total
+    holdout = None
+    if evaluate_every > 0:
+        holdout_rows = chunk_rows if holdout_rows is None else holdout_rows
+        if not 0 < holdout_rows < total:
+            raise ValueError('holdout_rows must be in (0, {}), got {}'.format(total, holdout_rows))
+        train_rows = total - holdout_rows
+        holdout = next(iter_chunks(store_path, vocab, chunk_rows=holdout_rows, start=train_rows))
+    lda = LatentDirichletAllocation(n_components=n_topics, learning_method='online', total_samples=train_rows,
+                                    random_state=seed, **lda_params)
+    for epoch in range(passes):
+        for mat in iter_chunks(store_path, vocab, chunk_rows=chunk_rows, stop=train_rows):
+            lda.partial_fit(mat)
+        print('pass {} finished'.format(epoch))
+        if holdout is not None and (epoch + 1) % evaluate_every == 0:
+            print('pass {} held-out perplexity: {:.4f}'.format(epoch, lda.perplexity(holdout)))
+    return lda
+
+
+def save_model(lda, vocab, path):
+    joblib.dump({'lda': lda, 'vocab': vocab}, path)
+
+
+def load_model(path):
+    model = joblib.load(path)
+    return model['lda'], model['vocab']
+
+
+def _transform_range(rows, lo, hi, arg):
+    lda, vocab, offsets, tokens = arg
+    chunk = feature_store.RaggedColumn(offsets, tokens).take(rows[lo:hi])
+    mat = doc_term_matrix(text_ingest.encode(chunk.offsets, chunk.values, vocab), vocab.shape[0])
+    return lda.transform(mat).astype(np.float32)
+
+
+def transform(lda, vocab, offsets, tokens, n_jobs=parallel_utils.N_JOBS):
+    """
+    已训练的模型推断每篇文档的主题分布, 按行区间分给多个进程
+    :return: float32 [num_docs, n_topics]
+    """
+    rows = np.arange(offsets.shape[0] - 1)
+    parts = parallel_utils.parallel_ranges(_transform_range, rows, (lda, vocab, offsets, tokens), n_jobs=n_jobs)
+    if not parts:
+        return np.zeros([0, lda.components_.shape[0]], np.float32)
+    return np.concatenate(parts)
+
+
+def infer_topics(model_path, text, n_jobs=parallel_utils.N_JOBS):
+    """
+    :param text: DataFrame, 列 pid, text (逗号分隔的词 id)
+    :return: DataFrame, 列 topics, pid, 与 text_lda 的输出格式相同
+    """
+    lda, vocab = load_model(model_path)
+    offsets, tokens = text_ingest.tokenize(text['text'].tolist())
+    docres = transform(lda, vocab, offsets, tokens, n_jobs)
+    df_text_lda = pd.DataFrame()
+    df_text_lda['topics'] = list(docres)
+    df_text_lda['pid'] = text['pid'].values
+    return df_text_lda
+
+
+if __name__ == '__main__':
+    # 新一天的 photo: python topic_model.py ../model/text_lda_6.model new_text.pkl ../data/text_lda_6_new.pkl
+    model_path, text_path, out_path = sys.argv[1:4]
+    new_text = pd.read_pickle(text_path)
+    new_text.columns = ['pid', 'text']
+    df_topics = infer_topics(model_path, new_text)
+    df_topics.to_pickle(out_path)
+    print(df_topics)
@@ -2,6 +2,9 @@
 import pandas as pd
 import numpy as np
 
+import feature_store
+import segment_stats
+
 
 # def cnt_user_like_feats(df_data):
 #     print('cnt_user_like_face_feats')
@@ -24,23 +27,38 @@ import numpy as np
 #     return df_data
 
 def get_user_like(data, test_data):
-    features = [np.array(feat.tolist()) for feat in [data['context'], data['face_cols_num'], data['topics']]]
-    data['concated_feature'] = [np.array(lst) for lst in np.concatenate(features, axis=1).tolist()]
-    user_like_mean = [[uid, np.array(value['concated_feature'].tolist()).mean(axis=0)] for uid, value in data.groupby(['uid'])]
-    user_like_mean = pd.DataFrame(user_like_mean, columns=['uid', 'user_like_mean'])
+    """
+    每个用户的 context / face_cols_num / topics 均值
+    :return: DataFrame, 列 uid, user_like_mean, user_indices
+    """
+    uids, codes = np.unique(data['uid'].values, return_inverse=True)
+    features = segment_stats.feature_matrix(data, ['context', 'face_cols_num', 'topics'])
+    mean = segment_stats.user_table(features, codes, uids.shape[0])['mean']
+    user_like_mean = pd.DataFrame({'uid': uids, 'user_like_mean': list(mean)}, columns=['uid', 'user_like_mean'])
     data = pd.merge(user_like_mean, test_data[['uid', 'user_indices']], 'left', ['uid'])
     return data
 
 
+def user_like_table(user_like, num_users):
+    """
+    :return: float32 [num_users, dim], 第 i 行对应 user_indices == i, 没有数据的用户为 0
+    """
+    user_like = user_like.dropna(subset=['user_indices']).drop_duplicates('user_indices')
+    mean = np.asarray(user_like['user_like_mean'].tolist(), np.float32)
+    table = np.zeros([num_users, mean.shape[1]], np.float32)
+    table[user_like['user_indices'].values.astype(np.int64)] = mean
+    return table
+
+
 if __name__ == '__main__':
-    df = pd.read_pickle('../data/interaction_features_1.pkl')
+    df = feature_store.load_frame('../data/interaction_features_1')
     print('loaded data...')
     print(df.columns)
     # 添加连续特征
     df = df[df['click'] == 1]
 
 
-    df_ctx = pd.read_pickle('../data/context_feature.pkl')
+    df_ctx = feature_store.load_frame('../data/context_feature')
     df = pd.merge(df, df_ctx, 'left', left_on=['uid', 'pid'], right_on=['user_id', 'photo_id'])
     print('context feature concated...')
 
@@ -52,8 +70,10 @@ if __name__ == '__main__':
     print('text lda concated...')
 
     # 求用户平均偏好
-    test_data = pd.read_pickle('../data/test_data.pkl')
+    test_data = feature_store.load_frame('../data/test_data', ['uid', 'user_indices'])
     user_like = get_user_like(df, test_data)
     user_like.to_pickle('../model/user_like_mean_2.pkl')
+    # 模型里按 user_indices 直接取的表
+    np.save('../model/user_like_mean.npy', user_like_table(user_like, int(test_data['user_indices'].max()) + 1))
     print(user_like['user_like_mean'])
     print('get user_like_mean...')
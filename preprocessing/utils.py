@@ -44,6 +44,27 @@ def new_variable_initializer(sess):
     # sess.run(init_new_vars_op)
 
 
+REG_MODES = ('full', 'batch', 'batch_freq')
+
+
+def embedding_l2_loss(params, ids=None, reg_mode='full'):
+    """
+    embedding 表的 L2 正则
+    :param ids: batch 里取到的行号, 为 None 时按整表算
+    :param reg_mode: full 整表; batch 只算 batch 里出现过的行, 每行一次;
+        batch_freq 每次出现算一次, 即按行在 batch 里出现的次数加权.
+        后两种的梯度是 IndexedSlices, 每步的开销只和 batch 大小有关
+    """
+    if reg_mode not in REG_MODES:
+        raise ValueError('reg_mode must be one of {}, got {}'.format(REG_MODES, reg_mode))
+    if ids is None or reg_mode == 'full':
+        return tf.nn.l2_loss(params)
+    ids = tf.reshape(ids, [-1])
+    if reg_mode == 'batch':
+        ids, _ = tf.unique(ids)
+    return tf.nn.l2_loss(tf.gather(params, ids))
+
+
 def get_sample_num(x):
     if isinstance(x, list):
         return x[0].shape[0]
@@ -1,23 +1,28 @@
-from gensim.models.word2vec import Word2Vec
 import pandas as pd
 import numpy as np
 import json
 import time
 
+import sentence_embedding
+
 
 W2V_PATH = '../../model/word2vec/word2vec.model'
+_model = None
+
+
+def load_model():
+    # 模型只加载一次
+    global _model
+    if _model is None:
+        _model = sentence_embedding.load_word2vec(W2V_PATH)
+    return _model
+
 
 def sentence2vec(sentence):
-    model = Word2Vec.load(W2V_PATH)
-    words_vecters = []
-    for word in sentence:
-        try:
-            words_vecters.append(model.wv[word])
-        except KeyError:
-            print(word, "not in vocabulary")
-            continue
-    sentence_vec = np.mean(words_vecters, axis=0)
-    return sentence_vec
+    vectors, known = sentence_embedding.export_vectors(load_model().wv, sentence)
+    # 一行的 CSR, 没有词在词表里时得到 0 向量
+    offsets = np.array([0, len(vectors)], np.int64)
+    return sentence_embedding.mean_pool(offsets, np.arange(len(vectors)), vectors, known)[0]
 
 if __name__ == '__main__':
     